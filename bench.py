@@ -0,0 +1,483 @@
+"""Offline micro-benchmarks for MultiGPT hot paths.
+
+Usage: python bench.py [name ...]   (runs every benchmark when no name is given)
+No network access or real credentials are needed.
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from aiohttp import ClientSession, web
+
+os.environ.setdefault("DISCORD_TOKEN", "bench")
+os.environ.setdefault("GROQ_API_KEY", "bench")
+os.environ.setdefault("DB_PATH", ":memory:")
+
+import main
+
+ARCHIVE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "archives.txt")
+
+SAMPLE_PROMPTS = [
+    "what happened in the war of the pen?",
+    "tell me about ink co",
+    "who burned ink co and why",
+    "what is the usf",
+    "explain the pen evolution timeline",
+    "breadmint reveal the pen lore",
+    "write me a python function to reverse a list",
+    "what's the weather like today",
+    "who is agent pen",
+    "what is the nscw black folder",
+    "skibidi toilet gyatt",
+    "what was the last known archive",
+]
+
+def bench_archive():
+    """Prompt-size reduction from retrieving archive sections instead of injecting the whole file."""
+    with open(ARCHIVE_PATH, encoding="utf-8") as f:
+        text = f.read()
+    start = time.perf_counter()
+    index = main.ArchiveIndex(text)
+    build_ms = (time.perf_counter() - start) * 1000
+    full_tokens = main.estimate_tokens(text)
+    print(f"archive: {len(index.chunks)} sections, ~{full_tokens} tokens, index built in {build_ms:.2f} ms")
+    print(f"top_k={main.ARCHIVE_TOP_K}, budget={main.ARCHIVE_TOKEN_BUDGET} tokens")
+    print(f"{'prompt':<48} {'tokens':>7} {'saved':>7}")
+    total = 0
+    for prompt in SAMPLE_PROMPTS:
+        tokens = main.estimate_tokens(index.context_for(prompt))
+        total += tokens
+        print(f"{prompt[:48]:<48} {tokens:>7} {100 - tokens * 100 / full_tokens:>6.1f}%")
+    mean = total / len(SAMPLE_PROMPTS)
+    print(f"mean archive tokens per call: {mean:.0f} vs {full_tokens} ({100 - mean * 100 / full_tokens:.1f}% smaller)")
+    rounds = 2000
+    start = time.perf_counter()
+    for i in range(rounds):
+        index.context_for(SAMPLE_PROMPTS[i % len(SAMPLE_PROMPTS)])
+    print(f"retrieval: {(time.perf_counter() - start) * 1e6 / rounds:.1f} us/query")
+
+def _list_turn(memory, chat, prompt, reply, memory_cap, chat_cap):
+    """One chat turn with the original list-based history code."""
+    chat.append(("user", prompt))
+    if len(chat) > chat_cap:
+        chat = chat[-chat_cap:]
+    memory.append(("user", prompt))
+    if len(memory) > memory_cap:
+        memory.pop(0)
+    messages = []
+    seen = set()
+    for role, content in memory[-memory_cap:] + chat:
+        if (role, content) not in seen:
+            seen.add((role, content))
+            messages.append({"role": role, "content": content})
+    chat.append(("assistant", reply))
+    memory.append(("assistant", reply))
+    if len(memory) > memory_cap:
+        memory.pop(0)
+    return memory, chat, messages
+
+def _buffer_turn(memory, chat, prompt, reply):
+    """The same turn with HistoryBuffer."""
+    chat.append("user", prompt)
+    memory.append("user", prompt)
+    messages = memory.payloads()
+    messages += chat.payloads(exclude=memory)
+    chat.append("assistant", reply)
+    memory.append("assistant", reply)
+    return messages
+
+def bench_history():
+    """Per-turn cost of list-based history vs HistoryBuffer at MAX_MEMORY and larger windows."""
+    print(f"{'window':>7} {'list us/turn':>13} {'buffer us/turn':>15} {'speedup':>8}")
+    for window in (main.MAX_MEMORY, 500, 5000):
+        rounds = 20000 if window <= 500 else 2000
+        prompts = [f"message {i % (window // 2 or 1)}" for i in range(rounds)]  # some repeats to dedup
+
+        memory, chat = [], []
+        start = time.perf_counter()
+        for prompt in prompts:
+            memory, chat, _ = _list_turn(memory, chat, prompt, "ok " + prompt, window, window)
+        list_us = (time.perf_counter() - start) * 1e6 / rounds
+
+        memory_buf, chat_buf = main.HistoryBuffer(window), main.HistoryBuffer(window)
+        start = time.perf_counter()
+        for prompt in prompts:
+            _buffer_turn(memory_buf, chat_buf, prompt, "ok " + prompt)
+        buffer_us = (time.perf_counter() - start) * 1e6 / rounds
+
+        print(f"{window:>7} {list_us:>13.1f} {buffer_us:>15.1f} {list_us / buffer_us:>7.1f}x")
+
+IMAGE_WORDS = [
+    "a", "cat", "wearing", "sunglasses", "on", "the", "beach", "classic", "painting", "of", "massive",
+    "castle", "at", "sunset", "cyberpunk", "city", "glass", "assassin", "butterfly", "cocktail", "bar",
+    "scrabble", "tiles", "adulthood", "portrait", "pen", "ink", "explosion", "dragon", "bikini", "nude",
+    "red", "sports", "car", "watercolor", "forest", "compass", "pass", "dickens", "novel", "cover",
+]
+
+def _image_corpus(size: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(IMAGE_WORDS) for _ in range(rng.randint(4, 16))) for _ in range(size)]
+
+DERIVED_FORMS = [
+    "sexual", "pornographic", "pornography", "erotica", "stripper", "boobies", "asshole", "fucker",
+    "porn123", "nsfw_art", "nude_photo", "Stripping", "NAKED!", "porno", "fucking"
+]
+SAFE_WORDS = [
+    "assistant", "assassin", "butterfly", "button", "stripes", "cocktail", "cumulative", "Dickens",
+    "class", "document", "Essex", "adulthood", "bass guitar", "peacock"
+]
+
+def bench_safety():
+    """Forbidden-keyword matching: per-keyword substring scan vs one compiled whole-word regex."""
+    keywords = main.bot.forbidden_keywords
+    pattern = main.compile_keyword_pattern(keywords)
+    corpus = _image_corpus(5000) + SAMPLE_PROMPTS + DERIVED_FORMS + SAFE_WORDS
+    rounds = 20
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        legacy = [any(keyword in prompt.lower() for keyword in keywords) for prompt in corpus]
+    legacy_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        compiled = [pattern.search(prompt.lower()) is not None for prompt in corpus]
+    compiled_s = time.perf_counter() - start
+
+    checks = rounds * len(corpus)
+    print(f"{len(keywords)} keywords, {len(corpus)} prompts")
+    print(f"{'matcher':<10} {'prompts/s':>12} {'us/prompt':>10} {'flagged':>8}")
+    print(f"{'substring':<10} {checks / legacy_s:>12.0f} {legacy_s * 1e6 / checks:>10.2f} {sum(legacy):>8}")
+    print(f"{'regex':<10} {checks / compiled_s:>12.0f} {compiled_s * 1e6 / checks:>10.2f} {sum(compiled):>8}")
+    print(f"speedup {legacy_s / compiled_s:.1f}x")
+
+    caught = [word for word in DERIVED_FORMS if not pattern.search(word.lower())]
+    passed = [word for word in SAFE_WORDS if pattern.search(word.lower())]
+    print(f"{'PASS' if not caught else 'FAIL'}: listed derived forms are still blocked"
+          f"{f' (missed {caught})' if caught else ''}")
+    print(f"{'PASS' if not passed else 'FAIL'}: safe words sharing a keyword's letters pass"
+          f"{f' (blocked {passed})' if passed else ''}")
+
+async def _media_download(size_mb: int):
+    block = os.urandom(1024 * 1024)
+
+    async def serve(request):
+        resp = web.StreamResponse(headers={"Content-Type": "video/mp4"})
+        await resp.prepare(request)
+        try:
+            for _ in range(size_mb):
+                await resp.write(block)
+            await resp.write_eof()
+        except ConnectionError:
+            pass  # the client aborted over the size limit
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/video.mp4", serve)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/video.mp4"
+    aborted = "not aborted"
+    try:
+        async with ClientSession() as session:
+            # Streaming first: memory freed after the buffered read may not go back to the OS
+            base = main.current_rss_bytes()
+            async with session.get(url) as resp:
+                media = await main.spool_response(resp, limit=1 << 40, label="bench")
+            streamed = main.current_rss_bytes() - base
+            media.close()
+
+            base = main.current_rss_bytes()
+            async with session.get(url) as resp:
+                body = await resp.read()
+            buffered = main.current_rss_bytes() - base
+            del body
+
+            try:
+                async with session.get(url) as resp:
+                    await main.spool_response(resp, limit=8 * 1024 * 1024, label="bench")
+            except main.MediaTooLarge as e:
+                aborted = str(e)
+    finally:
+        await runner.cleanup()
+    return streamed, buffered, aborted
+
+def bench_media():
+    """RSS growth while downloading a large video: buffered read() vs chunked spooling."""
+    size_mb = 64
+    streamed, buffered, aborted = asyncio.run(_media_download(size_mb))
+    print(f"{size_mb} MB download, spool keeps {main.MEDIA_SPOOL_BYTES // 1048576} MB in RAM before disk")
+    print(f"buffered read(): RSS +{buffered / 1048576:.1f} MB")
+    print(f"spooled chunks:  RSS +{streamed / 1048576:.1f} MB")
+    print(f"8 MB limit: aborted early ({aborted})")
+
+BOT_MENTION = "<@1000>"
+
+def _chat_messages(count: int, users: int, addressed_every: int, channels: int = 20) -> list:
+    """Busy ping-only guild traffic: many speakers, few messages addressed to the bot."""
+    rng = random.Random(11)
+    guild = SimpleNamespace(id=1)
+    channels = [SimpleNamespace(id=100 + i) for i in range(channels)]
+    messages = []
+    for i in range(count):
+        content = "lol did you see that" if i % addressed_every else f"{BOT_MENTION} what is ink co"
+        messages.append(SimpleNamespace(
+            author=SimpleNamespace(id=rng.randrange(users)), guild=guild,
+            channel=rng.choice(channels), content=content
+        ))
+    return messages
+
+async def _legacy_filter(messages, sessions, clock):
+    """The original on_message preamble: cooldown write for every author, then the session lookup."""
+    cooldowns = {}
+    answered = 0
+    for i, message in enumerate(messages):
+        now = clock(i)
+        if now - cooldowns.get(message.author.id, 0) < main.USER_COOLDOWN_SECONDS:
+            continue
+        cooldowns[message.author.id] = now
+        session = await sessions.for_message(message)
+        if session.ping_only and BOT_MENTION not in message.content:
+            continue
+        if message.content.replace(BOT_MENTION, "").strip():
+            answered += 1
+    return answered, len(cooldowns)
+
+async def _load_filter(messages, sessions, clock):
+    """Load the session to settle ping-only, then the cooldown."""
+    cooldowns = main.ExpiringCooldowns(main.USER_COOLDOWN_SECONDS)
+    answered = 0
+    for i, message in enumerate(messages):
+        mentioned = BOT_MENTION in message.content
+        key = sessions.key_for_message(message)
+        if not mentioned:
+            session = sessions.peek(key) or await sessions.get(key)
+            if session.ping_only:
+                continue
+        prompt = message.content.replace(BOT_MENTION, "").strip() if mentioned else message.content.strip()
+        if not prompt or cooldowns.hit(message.author.id, clock(i)):
+            continue
+        await sessions.get(key)
+        answered += 1
+    return answered, len(cooldowns)
+
+async def _prefilter(messages, sessions, clock):
+    """The new preamble: reject unaddressed messages before touching any state."""
+    cooldowns = main.ExpiringCooldowns(main.USER_COOLDOWN_SECONDS)
+    answered = 0
+    for i, message in enumerate(messages):
+        mentioned = BOT_MENTION in message.content
+        key = sessions.key_for_message(message)
+        if not mentioned and key not in sessions.listening:
+            continue
+        prompt = message.content.replace(BOT_MENTION, "").strip() if mentioned else message.content.strip()
+        if not prompt or cooldowns.hit(message.author.id, clock(i)):
+            continue
+        await sessions.get(key)
+        answered += 1
+    return answered, len(cooldowns)
+
+def bench_onmessage():
+    """Per-message overhead and cooldown-table size for unaddressed traffic in ping-only channels."""
+    count, users = 200_000, 50_000
+    messages = _chat_messages(count, users, addressed_every=50)
+    clock = lambda i: i * 0.01  # 100 messages/s of simulated traffic
+
+    async def run():
+        results = {}
+        for name, variant in (("legacy", _legacy_filter), ("prefilter", _prefilter)):
+            # Start cold: new sessions load as ping-only, so the first message per channel takes the load path
+            sessions = main.SessionStore(main.bot.persistence, "channel")
+            start = time.perf_counter()
+            answered, entries = await variant(messages, sessions, clock)
+            results[name] = ((time.perf_counter() - start) * 1e6 / count, answered, entries)
+        return results
+
+    results = asyncio.run(run())
+    print(f"{count} messages from {users} users over {clock(count) / 3600:.1f} simulated hours, 2% addressed")
+    print(f"{'path':<10} {'us/msg':>7} {'answered':>9} {'cooldown entries':>17}")
+    for name, (us, answered, entries) in results.items():
+        print(f"{name:<10} {us:>7.2f} {answered:>9} {entries:>17}")
+    # Only mentions may use up a cooldown, so the answered count must match a cooldown over mentions alone
+    cooldowns = main.ExpiringCooldowns(main.USER_COOLDOWN_SECONDS)
+    expected = sum(
+        1 for i, message in enumerate(messages)
+        if BOT_MENTION in message.content and not cooldowns.hit(message.author.id, clock(i))
+    )
+    ok = results["prefilter"][1] == expected
+    print(f"{'PASS' if ok else 'FAIL'}: prefilter answered {results['prefilter'][1]} of the {expected} mentions "
+          f"that clear a mentions-only cooldown")
+
+    # Chatting in a channel whose session is not loaded yet, then mentioning the bot a second later
+    guild = SimpleNamespace(id=2)
+    followups = [
+        SimpleNamespace(author=SimpleNamespace(id=user), guild=guild, channel=SimpleNamespace(id=10_000 + user),
+                        content=content)
+        for user in range(100) for content in ("anyone around?", f"{BOT_MENTION} hello")
+    ]
+    answered, _ = asyncio.run(_prefilter(followups, main.SessionStore(main.bot.persistence, "channel"), lambda i: i))
+    print(f"{'PASS' if answered == 100 else 'FAIL'}: {answered}/100 mentions answered right after chatting "
+          f"in a cold channel")
+
+    _onmessage_disk()
+
+def _onmessage_disk():
+    """Cold sessions on an on-disk database, where loading a session means a flush and SQLite reads."""
+    count, channels, listening = 20_000, 2_000, 50
+    messages = _chat_messages(count, 5_000, addressed_every=50, channels=channels)
+    clock = lambda i: i * 0.01
+    with tempfile.TemporaryDirectory() as tmp:
+        persistence = main.PersistentStore(os.path.join(tmp, "bench.db"))
+        seed = main.SessionStore(persistence, "channel")
+        for channel_id in range(100, 100 + listening):
+            session = main.ChatSession((1, channel_id, 0), seed)
+            session.set_ping_only(False)
+            session.save()
+        asyncio.run(persistence.flush())
+
+        async def run(variant):
+            sessions = main.SessionStore(persistence, "channel", max_sessions=500)  # listening keys come from disk
+            start = time.perf_counter()
+            answered, _ = await variant(messages, sessions, clock)
+            elapsed = time.perf_counter() - start
+            return elapsed * 1e6 / count, answered, len(sessions.sessions) + sessions.evictions, sessions.evictions
+
+        variants = (("load", _load_filter), ("prefilter", _prefilter))
+        results = {name: asyncio.run(run(variant)) for name, variant in variants}
+        persistence.close()
+    print(f"\n{count} messages over {channels} cold channels on a disk database, {listening} not ping-only")
+    print(f"{'path':<10} {'us/msg':>7} {'answered':>9} {'loads':>7} {'evicted':>8}")
+    for name, (us, answered, loads, evicted) in results.items():
+        print(f"{name:<10} {us:>7.2f} {answered:>9} {loads:>7} {evicted:>8}")
+    ok = results["prefilter"][1] == results["load"][1] and results["prefilter"][2] < results["load"][2]
+    print(f"{'PASS' if ok else 'FAIL'}: same replies, sessions loaded only for messages the bot answers")
+
+class _FakeGroq:
+    """Upstream that serves `capacity` requests at once and answers 429 to anything beyond that."""
+
+    def __init__(self, capacity: int, latency: float):
+        self.capacity = capacity
+        self.latency = latency
+        self.in_flight = 0
+        self.calls = 0
+        self.rate_limited = 0
+
+    async def complete(self) -> int:
+        self.calls += 1
+        if self.in_flight >= self.capacity:
+            self.rate_limited += 1
+            await asyncio.sleep(0.01)
+            return 429
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        finally:
+            self.in_flight -= 1
+        return 200
+
+async def _reply(upstream: _FakeGroq) -> bool:
+    # Mirrors _ai_call: a 429 rotates the model and retries straight away
+    for _ in range(main.GROQ_MAX_ATTEMPTS):
+        if await upstream.complete() == 200:
+            return True
+    return False
+
+def _burst(heavy: int, light_users: int, per_light: int, spread: float) -> list:
+    """(arrival offset, user id): one user spamming mentions at once, the rest trickling in."""
+    rng = random.Random(3)
+    arrivals = [(0.0, 0) for _ in range(heavy)]
+    arrivals += [(rng.uniform(0, spread), user) for user in range(1, light_users + 1) for _ in range(per_light)]
+    return sorted(arrivals)
+
+async def _run_burst(arrivals, upstream: _FakeGroq, scheduler):
+    outcomes = []  # (user id, "ok" | "failed" | "shed", latency)
+
+    async def mention(offset: float, user: int):
+        await asyncio.sleep(offset)
+        started = time.perf_counter()
+        try:
+            if scheduler is None:
+                ok = await _reply(upstream)
+            else:
+                async with scheduler.slot(user, 1200):
+                    ok = await _reply(upstream)
+        except main.LoadShed:
+            outcomes.append((user, "shed", time.perf_counter() - started))
+            return
+        outcomes.append((user, "ok" if ok else "failed", time.perf_counter() - started))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(mention(offset, user) for offset, user in arrivals))
+    return outcomes, time.perf_counter() - start
+
+def _percentile(values: list, fraction: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def bench_burst():
+    """Throughput and p95 latency for a mention burst against a 429-ing upstream, with and without the scheduler."""
+    capacity, latency = 8, 0.1
+    arrivals = _burst(heavy=120, light_users=40, per_light=3, spread=1.0)
+    variants = {
+        "unscheduled": lambda: None,
+        "scheduled": lambda: main.LLMScheduler(capacity, quantum=2048, slo=20.0),
+        "tight SLO": lambda: main.LLMScheduler(capacity, quantum=2048, slo=1.0),
+    }
+    print(f"{len(arrivals)} mentions (120 from one user at t=0, 40 users x 3 over 1s), "
+          f"upstream serves {capacity} at once, ~{latency * 1000:.0f} ms each")
+    print(f"{'variant':<12} {'ok':>4} {'failed':>6} {'shed':>5} {'calls':>6} {'429s':>5} {'ok/s':>6} "
+          f"{'p50 ms':>7} {'p95 ms':>7} {'light p95':>10}")
+    results = {}
+    for name, make in variants.items():
+        random.seed(11)
+        upstream = _FakeGroq(capacity, latency)
+        outcomes, elapsed = asyncio.run(_run_burst(arrivals, upstream, make()))
+        ok = [seconds for _, status, seconds in outcomes if status == "ok"]
+        light = [seconds for user, status, seconds in outcomes if status == "ok" and user != 0]
+        heavy = [seconds for user, status, seconds in outcomes if status == "ok" and user == 0]
+        failed = sum(1 for _, status, _ in outcomes if status == "failed")
+        shed = [(user, seconds) for user, status, seconds in outcomes if status == "shed"]
+        results[name] = SimpleNamespace(failed=failed, shed=shed, light=light, heavy=heavy, upstream=upstream)
+        print(f"{name:<12} {len(ok):>4} {failed:>6} {len(shed):>5} {upstream.calls:>6} {upstream.rate_limited:>5} "
+              f"{len(ok) / elapsed:>6.1f} {_percentile(ok, 0.5) * 1000:>7.0f} {_percentile(ok, 0.95) * 1000:>7.0f} "
+              f"{_percentile(light, 0.95) * 1000:>10.0f}")
+
+    scheduled, tight = results["scheduled"], results["tight SLO"]
+    heavy_mentions = sum(1 for _, user in arrivals if user == 0)
+    light_mentions = len(arrivals) - heavy_mentions
+    checks = {
+        "scheduled: no failed replies or upstream 429s": not scheduled.failed and not scheduled.upstream.rate_limited,
+        "scheduled: light users' p95 under half the heavy user's p50":
+            _percentile(scheduled.light, 0.95) < _percentile(scheduled.heavy, 0.5) / 2,
+        "tight SLO: overload is shed": bool(tight.shed),
+        "tight SLO: nobody waits past the SLO to be shed": all(seconds < 1.0 + 0.2 for _, seconds in tight.shed),
+        "tight SLO: light users keep a larger share of replies than the heavy user":
+            len(tight.light) / light_mentions > len(tight.heavy) / heavy_mentions,
+    }
+    for label, passed in checks.items():
+        print(f"{'PASS' if passed else 'FAIL'}: {label}")
+
+BENCHMARKS = {
+    "archive": bench_archive,
+    "history": bench_history,
+    "safety": bench_safety,
+    "media": bench_media,
+    "onmessage": bench_onmessage,
+    "burst": bench_burst,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+        print()
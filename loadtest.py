@@ -0,0 +1,604 @@
+"""Offline load test: local stand-ins for every provider plus a fake Discord front end.
+
+Usage: python loadtest.py [--mentions 300] [--images 40] [--videos 6] [--music 6] [--rate 40] ...
+       (python loadtest.py --help lists every knob)
+
+Stub aiohttp servers for Groq, Hugging Face, Pollinations, SiliconFlow and imgbb are started on
+localhost and main.py is pointed at them through the *_BASE_URL variables. A seeded workload
+is then replayed through on_message and the hybrid command callbacks with fake Discord users,
+channels and messages. The report lists throughput, latency percentiles per request kind and
+upstream call counts, so two runs with the same seed can be compared for regressions.
+No network access, Discord connection or real credentials are needed.
+"""
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+STUB_HOST = "127.0.0.1"
+
+# Smallest valid PNG header plus padding, so the bot's "> 1000 bytes" sanity checks pass
+PNG_BYTES = b"\x89PNG\r\n\x1a\n" + bytes(4096)
+
+PROMPTS = [
+    "what happened in the war of the pen?",
+    "tell me about ink co",
+    "write me a python function to reverse a list",
+    "explain the pen evolution timeline",
+    "who is agent pen",
+    "what is the usf",
+    "give me three fun facts about octopuses",
+    "summarize the plot of hamlet in two lines",
+    "how do i center a div",
+    "what is the nscw black folder",
+]
+IMAGE_PROMPTS = [
+    "a lighthouse at dusk, watercolor",
+    "a cyberpunk street market in the rain",
+    "a corgi astronaut on the moon",
+    "an isometric pixel art castle",
+    "a bowl of ramen, studio lighting",
+]
+MEDIA_PROMPTS = ["ocean waves at sunrise", "lofi beat with rain", "a paper plane over a city", "epic orchestral intro"]
+
+def lognormal(median: float, sigma: float) -> float:
+    return random.lognormvariate(math.log(max(median, 1e-6)), sigma)
+
+# ------------------------------
+# Provider Stubs
+# ------------------------------
+class Stub:
+    """One local provider stand-in; counts every call by route and response status."""
+
+    name = "stub"
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.calls: Counter = Counter()
+        self.runner = None
+        self.base = ""
+
+    def routes(self, app: web.Application):
+        raise NotImplementedError
+
+    @web.middleware
+    async def count(self, request: web.Request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            self.calls[(route, e.status)] += 1
+            raise
+        self.calls[(route, response.status)] += 1
+        return response
+
+    def failure(self) -> bool:
+        return random.random() < self.args.error_rate
+
+    async def start(self) -> str:
+        app = web.Application(middlewares=[self.count])
+        self.routes(app)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, STUB_HOST, 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.base = f"http://{host}:{port}"
+        return self.base
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+class GroqStub(Stub):
+    """OpenAI-style chat completions with per-key request budgets, 429s and SSE streaming."""
+
+    name = "groq"
+
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args)
+        self.buckets = {}  # key -> (tokens, last refill)
+
+    def routes(self, app: web.Application):
+        app.router.add_post("/openai/v1/chat/completions", self.chat)
+
+    def take(self, key: str):
+        """Per-key requests-per-minute budget: (allowed, remaining, seconds until one frees up)."""
+        rpm = self.args.groq_rpm
+        now = time.monotonic()
+        tokens, last = self.buckets.get(key, (rpm, now))
+        tokens = min(rpm, tokens + (now - last) * rpm / 60)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        return allowed, int(tokens), max(0.0, (1 - tokens) * 60 / rpm)
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        allowed, remaining, reset = self.take(request.headers.get("Authorization", ""))
+        headers = {
+            "x-ratelimit-limit-requests": str(self.args.groq_rpm),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": f"{reset:.2f}s",
+        }
+        if not allowed:
+            headers["retry-after"] = f"{max(1, math.ceil(reset))}"
+            return web.json_response({"error": {"message": "Rate limit reached"}}, status=429, headers=headers)
+        if self.failure():
+            await asyncio.sleep(lognormal(self.args.groq_latency / 4, 0.3))
+            return web.json_response({"error": {"message": "Service unavailable"}}, status=503, headers=headers)
+        system = payload["messages"][0]["content"] if payload["messages"] else ""
+        prompt = payload["messages"][-1]["content"]
+        if "image safety checker" in system:
+            reply = "AI:STOPIMAGE" if "forbidden" in prompt else "AI:ACCEPTIMAGE"
+        else:
+            reply = " ".join(f"word{i}" for i in range(self.args.reply_words))
+        if not payload.get("stream"):
+            await asyncio.sleep(lognormal(self.args.groq_latency, 0.4))
+            return web.json_response(
+                {"choices": [{"message": {"role": "assistant", "content": reply}}]}, headers=headers
+            )
+        response = web.StreamResponse(headers={**headers, "Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(lognormal(self.args.groq_latency / 3, 0.4))  # time to first token
+        words = reply.split(" ")
+        per_chunk = self.args.groq_latency * 2 / 3 / max(1, len(words) / 8)
+        for start in range(0, len(words), 8):
+            delta = " ".join(words[start:start + 8]) + " "
+            chunk = {"choices": [{"delta": {"content": delta}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(per_chunk)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+class HuggingFaceStub(Stub):
+    """Inference API with a cold-start loading window, 503s while loading and slow renders."""
+
+    name = "hf"
+
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args)
+        self.loaded_at = time.monotonic() + args.hf_cold_start
+
+    def routes(self, app: web.Application):
+        app.router.add_get("/status/{model:.+}", self.status)
+        app.router.add_post("/models/{model:.+}", self.infer)
+
+    def loading(self) -> float:
+        return max(0.0, self.loaded_at - time.monotonic())
+
+    async def status(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(lognormal(0.05, 0.3))
+        return web.json_response({"state": "Loading" if self.loading() else "Loaded"})
+
+    async def infer(self, request: web.Request) -> web.Response:
+        await request.read()
+        remaining = self.loading()
+        if remaining:
+            return web.json_response(
+                {"error": f"Model {request.match_info['model']} is currently loading", "estimated_time": remaining},
+                status=503
+            )
+        if self.failure():
+            return web.json_response({"error": "Internal error"}, status=503)
+        await asyncio.sleep(lognormal(self.args.hf_latency, 0.35))
+        return web.Response(body=PNG_BYTES + os.urandom(16), content_type="image/png")
+
+class PollinationsStub(Stub):
+    """Image and audio generation by GET, both returning raw bytes."""
+
+    name = "pollinations"
+
+    def routes(self, app: web.Application):
+        app.router.add_get("/prompt/{prompt:.+}", self.image)
+        app.router.add_get("/audio/{prompt:.+}", self.audio)
+
+    async def image(self, request: web.Request) -> web.Response:
+        if self.failure():
+            return web.Response(status=502, text="bad gateway")
+        await asyncio.sleep(lognormal(self.args.pollinations_latency, 0.35))
+        return web.Response(body=PNG_BYTES + request.match_info["prompt"].encode(), content_type="image/jpeg")
+
+    async def audio(self, request: web.Request) -> web.Response:
+        if self.failure():
+            return web.Response(status=502, text="bad gateway")
+        await asyncio.sleep(lognormal(self.args.music_latency, 0.3))
+        return web.Response(body=os.urandom(self.args.audio_kb * 1024), content_type="audio/mpeg")
+
+class SiliconFlowStub(Stub):
+    """Video jobs that move InQueue -> InProgress -> Succeed on a clock, plus the file host."""
+
+    name = "siliconflow"
+
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args)
+        self.jobs = {}  # requestId -> (submitted, queued seconds, running seconds)
+
+    def routes(self, app: web.Application):
+        app.router.add_post("/v1/video/submit", self.submit)
+        app.router.add_post("/v1/video/status", self.status)
+        app.router.add_get("/files/{name}", self.file)
+
+    async def submit(self, request: web.Request) -> web.Response:
+        await request.json()
+        if random.random() < self.args.error_rate:
+            return web.json_response({"message": "rate limited"}, status=429)
+        await asyncio.sleep(lognormal(0.2, 0.3))
+        request_id = uuid.uuid4().hex
+        self.jobs[request_id] = (
+            time.monotonic(), lognormal(self.args.video_queued, 0.3), lognormal(self.args.video_running, 0.3)
+        )
+        return web.json_response({"requestId": request_id})
+
+    async def status(self, request: web.Request) -> web.Response:
+        request_id = (await request.json()).get("requestId")
+        if request_id not in self.jobs:
+            return web.json_response({"status": "Failed", "reason": "unknown requestId"})
+        submitted, queued, running = self.jobs[request_id]
+        elapsed = time.monotonic() - submitted
+        if elapsed < queued:
+            return web.json_response({"status": "InQueue"})
+        if elapsed < queued + running:
+            return web.json_response({"status": "InProgress"})
+        url = f"{self.base}/files/{request_id}.mp4"
+        return web.json_response({"status": "Succeed", "results": {"videos": [{"url": url}]}})
+
+    async def file(self, request: web.Request) -> web.Response:
+        return web.Response(body=os.urandom(self.args.video_kb * 1024), content_type="video/mp4")
+
+class ImgbbStub(Stub):
+    """Image hosting: stores nothing, returns a stable URL per image body."""
+
+    name = "imgbb"
+
+    def routes(self, app: web.Application):
+        app.router.add_post("/1/upload", self.upload)
+
+    async def upload(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        image = form["image"].file.read()
+        if self.failure():
+            return web.json_response({"success": False, "error": {"message": "upload failed"}}, status=500)
+        await asyncio.sleep(lognormal(self.args.imgbb_latency, 0.3))
+        digest = hashlib.sha1(image).hexdigest()[:12]
+        return web.json_response({"success": True, "data": {"url": f"{self.base}/i/{digest}.png"}})
+
+# ------------------------------
+# Fake Discord
+# ------------------------------
+current_request: contextvars.ContextVar = contextvars.ContextVar("current_request", default=None)
+message_ids = itertools.count(10_000_000)
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.filesize_limit = 25 * 1024 * 1024
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", author: FakeUser, content: str):
+        self.id = next(message_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.files = 0
+        self.edits = 0
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel.harness.discord_call("edit")
+        if content is not None:
+            self.content = content
+        self.edits += 1
+        return self
+
+class FakeChannel:
+    def __init__(self, harness: "Harness", channel_id: int, guild: FakeGuild):
+        self.harness = harness
+        self.id = channel_id
+        self.guild = guild
+        self.messages = {}
+
+    async def send(self, content=None, file=None, **kwargs) -> FakeMessage:
+        await self.harness.discord_call("send_file" if file is not None else "send")
+        message = FakeMessage(self, self.harness.bot_user, content or "")
+        if file is not None:
+            message.files += 1
+            file.close()
+        self.messages[message.id] = message
+        request = current_request.get()
+        if request is not None:
+            if request.kind in ("video", "music") and not request.replies:
+                self.harness.by_status_message[message.id] = request  # the media job reports through it
+            request.replies.append(message)
+        return message
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        return self.messages[message_id]
+
+class FakeContext:
+    """Just enough of commands.Context for the hybrid command callbacks."""
+
+    def __init__(self, author: FakeUser, channel: FakeChannel):
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.interaction = None
+
+    async def send(self, content=None, **kwargs) -> FakeMessage:
+        return await self.channel.send(content, **kwargs)
+
+# ------------------------------
+# Load Generator
+# ------------------------------
+class Request:
+    __slots__ = ("kind", "user", "channel", "prompt", "offset", "started", "finished", "replies", "outcome")
+
+    def __init__(self, kind: str, user: FakeUser, channel: FakeChannel, prompt: str, offset: float):
+        self.kind = kind
+        self.user = user
+        self.channel = channel
+        self.prompt = prompt
+        self.offset = offset
+        self.started = 0.0
+        self.finished = None
+        self.replies = []
+        self.outcome = "pending"
+
+    def classify(self) -> str:
+        if not self.replies:
+            return "dropped"  # cooldown or otherwise ignored
+        if self.kind in ("video", "music"):
+            # replies[0] is the status message; the job sends the file (or a link) as a follow-up
+            if "maximum number" in self.replies[0].content:
+                return "rejected"
+            if any(message.files or "here's a link" in message.content for message in self.replies[1:]):
+                return "ok"
+            return "error"
+        text = self.replies[-1].content
+        if text.startswith("🥵"):
+            return "shed"
+        if text.startswith("🚫"):
+            return "blocked"
+        if "❌" in text:
+            return "error"
+        return "ok"
+
+class Harness:
+    def __init__(self, main, args: argparse.Namespace):
+        self.main = main
+        self.args = args
+        self.bot_user = FakeUser(1, "MultiGPT")
+        self.bot_user.bot = True
+        guild = FakeGuild(500)
+        self.channels = {600 + i: FakeChannel(self, 600 + i, guild) for i in range(args.channels)}
+        self.users = [FakeUser(1000 + i, f"user{i}") for i in range(args.users)]
+        self.discord_calls: Counter = Counter()
+        self.by_status_message = {}
+
+    async def discord_call(self, kind: str):
+        self.discord_calls[kind] += 1
+        await asyncio.sleep(lognormal(self.args.discord_latency, 0.3))
+
+    def install(self):
+        bot = self.main.bot
+        bot._connection.user = self.bot_user
+        bot.get_channel = self.channels.get
+
+        async def no_prefix_commands(message):
+            return None  # prefix parsing is discord.py's; the load test drives commands directly
+
+        bot.process_commands = no_prefix_commands
+        for kind, handler in list(bot.media_queue.handlers.items()):
+            bot.media_queue.handlers[kind] = self.timed_handler(handler)
+
+    def timed_handler(self, handler):
+        async def run(job):
+            request = self.by_status_message.get(job.message_id)
+            # Job tasks inherit whichever context dispatched them, so attribute sends explicitly
+            current_request.set(request)
+            try:
+                await handler(job)
+            finally:
+                if request is not None:
+                    request.finished = time.perf_counter()
+        return run
+
+    def workload(self) -> list:
+        args = self.args
+        rng = random.Random(args.seed)
+        kinds = ["mention"] * args.mentions + ["image"] * args.images + ["video"] * args.videos + ["music"] * args.music
+        rng.shuffle(kinds)
+        requests, offset = [], 0.0
+        for kind in kinds:
+            offset += rng.expovariate(args.rate)
+            pool = {"mention": PROMPTS, "image": IMAGE_PROMPTS}.get(kind, MEDIA_PROMPTS)
+            prompt = rng.choice(pool)
+            if rng.random() >= args.repeat:
+                prompt = f"{prompt} #{rng.randrange(10 ** 6)}"
+            channel = self.channels[600 + rng.randrange(args.channels)]
+            requests.append(Request(kind, rng.choice(self.users), channel, prompt, offset))
+        return requests
+
+    async def drive(self, request: Request):
+        await asyncio.sleep(request.offset)
+        current_request.set(request)
+        main = self.main
+        request.started = time.perf_counter()
+        try:
+            if request.kind == "mention":
+                content = f"{self.bot_user.mention} {request.prompt}"
+                await main.on_message(FakeMessage(request.channel, request.user, content))
+            else:
+                ctx = FakeContext(request.user, request.channel)
+                command = {"image": main.image_command, "video": main.video_command, "music": main.music_command}
+                await command[request.kind].callback(ctx, request.prompt)
+                if request.kind in ("video", "music") and request.replies and request.replies[0].id in self.by_status_message:
+                    if "maximum number" not in request.replies[0].content:
+                        return  # finished by the media queue
+        except Exception as e:
+            request.outcome = f"crash: {type(e).__name__}"
+        request.finished = time.perf_counter()
+
+    async def wait_for_media(self, timeout: float):
+        queue = self.main.bot.media_queue
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            busy = any(queue.running[kind] or queue.waiting[kind] for kind in queue.running)
+            if not busy:
+                return True
+            await asyncio.sleep(0.2)
+        return False
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def report(requests: list, elapsed: float, stubs: list, harness: Harness, main) -> dict:
+    summary = {"elapsed_seconds": round(elapsed, 2), "kinds": {}, "upstream": {}, "discord": dict(harness.discord_calls)}
+    print(f"\n{len(requests)} requests in {elapsed:.1f}s")
+    print(f"{'kind':<8} {'sent':>5} {'ok':>5} {'other outcomes':<34} {'ok/s':>6} "
+          f"{'p50 s':>7} {'p90 s':>7} {'p95 s':>7} {'p99 s':>7} {'max s':>7}")
+    completed = 0
+    for kind in ("mention", "image", "video", "music"):
+        batch = [request for request in requests if request.kind == kind]
+        if not batch:
+            continue
+        for request in batch:
+            if request.outcome == "pending":
+                request.outcome = request.classify() if request.finished is not None else "unfinished"
+        outcomes = Counter(request.outcome for request in batch)
+        latencies = [request.finished - request.started for request in batch if request.outcome == "ok"]
+        completed += len(latencies)
+        other = ", ".join(f"{name} {count}" for name, count in outcomes.items() if name != "ok") or "-"
+        row = {
+            "sent": len(batch), "outcomes": dict(outcomes), "throughput": len(latencies) / elapsed,
+            **{name: percentile(latencies, fraction) for name, fraction in
+               (("p50", 0.5), ("p90", 0.9), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))}
+        }
+        summary["kinds"][kind] = row
+        print(f"{kind:<8} {len(batch):>5} {outcomes['ok']:>5} {other[:34]:<34} {row['throughput']:>6.2f} "
+              f"{row['p50']:>7.2f} {row['p90']:>7.2f} {row['p95']:>7.2f} {row['p99']:>7.2f} {row['max']:>7.2f}")
+    summary["throughput"] = completed / elapsed
+    print(f"overall: {completed} completed, {summary['throughput']:.2f} req/s")
+    print("\nupstream calls:")
+    for stub in stubs:
+        for (route, status), count in sorted(stub.calls.items()):
+            summary["upstream"][f"{stub.name} {route} {status}"] = count
+            print(f"  {stub.name:<12} {route:<36} {status:>4} {count:>6}")
+    print("discord calls: " + ", ".join(f"{kind} {count}" for kind, count in sorted(harness.discord_calls.items())))
+    print("\nbot stats:")
+    for line in main.bot.stats_summary():
+        print(f"  {line}")
+    return summary
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    workload = parser.add_argument_group("workload")
+    workload.add_argument("--mentions", type=int, default=300)
+    workload.add_argument("--images", type=int, default=40)
+    workload.add_argument("--videos", type=int, default=6)
+    workload.add_argument("--music", type=int, default=6)
+    workload.add_argument("--users", type=int, default=500)
+    workload.add_argument("--channels", type=int, default=8)
+    workload.add_argument("--rate", type=float, default=40.0, help="mean arrivals per second (Poisson)")
+    workload.add_argument("--repeat", type=float, default=0.3, help="share of prompts repeated verbatim")
+    workload.add_argument("--seed", type=int, default=1)
+    workload.add_argument("--media-timeout", type=float, default=120.0, help="seconds to wait for media jobs")
+    upstream = parser.add_argument_group("upstream behaviour")
+    upstream.add_argument("--groq-latency", type=float, default=0.8, help="median seconds per completion")
+    upstream.add_argument("--groq-rpm", type=int, default=300, help="requests per minute per Groq key")
+    upstream.add_argument("--reply-words", type=int, default=120)
+    upstream.add_argument("--hf-latency", type=float, default=3.0)
+    upstream.add_argument("--hf-cold-start", type=float, default=5.0, help="seconds the HF model reports loading")
+    upstream.add_argument("--pollinations-latency", type=float, default=2.0)
+    upstream.add_argument("--music-latency", type=float, default=3.0)
+    upstream.add_argument("--audio-kb", type=int, default=256)
+    upstream.add_argument("--video-queued", type=float, default=2.0)
+    upstream.add_argument("--video-running", type=float, default=4.0)
+    upstream.add_argument("--video-kb", type=int, default=2048)
+    upstream.add_argument("--imgbb-latency", type=float, default=0.3)
+    upstream.add_argument("--discord-latency", type=float, default=0.05)
+    upstream.add_argument("--error-rate", type=float, default=0.02, help="share of 5xx/429 failures per provider")
+    output = parser.add_argument_group("output")
+    output.add_argument("--json", help="also write the report to this file")
+    output.add_argument("--verbose", action="store_true", help="keep the bot's INFO logs and JSON traces")
+    return parser.parse_args(argv)
+
+async def run(args: argparse.Namespace) -> dict:
+    random.seed(args.seed)
+    stubs = [GroqStub(args), HuggingFaceStub(args), PollinationsStub(args), SiliconFlowStub(args), ImgbbStub(args)]
+    groq, hf, pollinations, siliconflow, imgbb = [await stub.start() for stub in stubs]
+    # main.py reads its configuration at import, so the environment has to be in place first
+    os.environ.update({
+        "DISCORD_TOKEN": "loadtest",
+        "GROQ_API_KEY": "loadtest-groq-1",
+        "GROQ_API_KEY2": "loadtest-groq-2",
+        "HF_TOKEN": "loadtest-hf",
+        "SILICONFLOW_API_KEY": "loadtest-siliconflow",
+        "HF_IMAGES": "loadtest-imgbb",
+        "DB_PATH": ":memory:",
+        "GROQ_BASE_URL": f"{groq}/openai/v1",
+        "HF_BASE_URL": hf,
+        "POLLINATIONS_IMAGE_BASE_URL": pollinations,
+        "POLLINATIONS_AUDIO_BASE_URL": pollinations,
+        "SILICONFLOW_BASE_URL": f"{siliconflow}/v1",
+        "IMGBB_BASE_URL": f"{imgbb}/1",
+        "VIDEO_POLL_QUEUED_SECONDS": "0.5",
+        "VIDEO_POLL_RUNNING_SECONDS": "0.5",
+        "VIDEO_POLL_MAX_SECONDS": "2",
+        "TRACE_LOG": "true" if args.verbose else "false",
+    })
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    if not args.verbose:
+        main.logger.setLevel(logging.ERROR)
+
+    harness = Harness(main, args)
+    harness.install()
+    persistence = asyncio.create_task(main.persistence_loop())
+    requests = harness.workload()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(harness.drive(request) for request in requests))
+        if not await harness.wait_for_media(args.media_timeout):
+            print(f"media jobs still running after {args.media_timeout:.0f}s", file=sys.stderr)
+        elapsed = time.perf_counter() - started
+        return report(requests, elapsed, stubs, harness, main)
+    finally:
+        persistence.cancel()
+        await main.bot.http_pool.close()
+        for stub in stubs:
+            await stub.stop()
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    result = asyncio.run(run(arguments))
+    if arguments.json:
+        with open(arguments.json, "w") as f:
+            json.dump(result, f, indent=2, default=str)
@@ -6,12 +6,25 @@ import aiohttp
 import time
 import random
 import json
-import io
 import logging
+import signal
+import hashlib
+import uuid
+import tempfile
+import resource
+import sqlite3
+import threading
+import contextvars
+import hmac
+import sys
+import contextlib
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 import calendar
-from typing import Optional, Dict, List, Tuple
+import math
+import bisect
+from collections import Counter, OrderedDict, deque
+from typing import Optional, Dict, List, Tuple, NamedTuple, Iterable, Iterator, Any, Awaitable, Callable, Hashable
 
 import discord
 from discord.ext import commands
@@ -26,6 +39,13 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger('MultiGPT')
+# Request traces are one bare JSON object per line so log tooling can parse them directly
+trace_logger = logging.getLogger('MultiGPT.trace')
+_trace_handler = logging.StreamHandler()
+_trace_handler.setFormatter(logging.Formatter('%(message)s'))
+trace_logger.addHandler(_trace_handler)
+trace_logger.propagate = False
+STARTUP_STARTED = time.perf_counter()
 
 # ------------------------------
 # Configuration
@@ -62,14 +82,2468 @@ if not SILICONFLOW_API_KEYS:
 IMGBB_API_KEY = os.getenv("HF_IMAGES")
 POLLINATIONS_API_KEY = os.getenv("POLLINATIONS_API_KEY") or "sk_e9Gh0E5vQH0UQUhiZ9gRdJCmTYspFtB9"
 
+# Provider base URLs (overridable, e.g. to point the bot at loadtest.py's local stubs)
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL", "https://api.groq.com/openai/v1").rstrip("/")
+HF_BASE_URL = os.getenv("HF_BASE_URL", "https://api-inference.huggingface.co").rstrip("/")
+POLLINATIONS_IMAGE_BASE_URL = os.getenv("POLLINATIONS_IMAGE_BASE_URL", "https://image.pollinations.ai").rstrip("/")
+POLLINATIONS_AUDIO_BASE_URL = os.getenv("POLLINATIONS_AUDIO_BASE_URL", "https://gen.pollinations.ai").rstrip("/")
+SILICONFLOW_BASE_URL = os.getenv("SILICONFLOW_BASE_URL", "https://api.siliconflow.com/v1").rstrip("/")
+IMGBB_BASE_URL = os.getenv("IMGBB_BASE_URL", "https://api.imgbb.com/1").rstrip("/")
+
 # Constants
-GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
-POLLINATIONS_AUDIO_URL = "https://gen.pollinations.ai/audio"
+GROQ_API_URL = f"{GROQ_BASE_URL}/chat/completions"
+HF_MODELS_URL = f"{HF_BASE_URL}/models"
+HF_STATUS_URL = f"{HF_BASE_URL}/status"
+POLLINATIONS_IMAGE_URL = f"{POLLINATIONS_IMAGE_BASE_URL}/prompt"
+POLLINATIONS_AUDIO_URL = f"{POLLINATIONS_AUDIO_BASE_URL}/audio"
+IMGBB_UPLOAD_URL = f"{IMGBB_BASE_URL}/upload"
+ARCHIVE_URL = os.getenv(
+    "ARCHIVE_URL", "https://raw.githubusercontent.com/Pen-123/upd-multigpt/refs/heads/main/archives.txt"
+)
+BUNDLED_ARCHIVE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "archives.txt")
+ARCHIVE_CACHE_PATH = os.getenv("ARCHIVE_CACHE_PATH", ".archive_cache.json")
+ARCHIVE_REFRESH_SECONDS = int(os.getenv("ARCHIVE_REFRESH_SECONDS", 3600))
 MAX_SAVED = 5
 MAX_MEMORY = 50
 TZ_UAE = ZoneInfo("Asia/Dubai")
 USER_COOLDOWN_SECONDS = 5
 COOLDOWN_DURATION = 40
+HF_IMAGE_PARAMETERS = {
+    "height": 384,
+    "width": 384,
+    "num_inference_steps": 30,
+    "guidance_scale": 7.5,
+}
+
+# HTTP connection pools, one per upstream provider: (max connections, total timeout seconds)
+HTTP_POOL_LIMITS = {
+    "groq": (int(os.getenv("GROQ_POOL_LIMIT", 20)), 120),
+    "hf": (int(os.getenv("HF_POOL_LIMIT", 8)), 150),
+    "pollinations": (int(os.getenv("POLLINATIONS_POOL_LIMIT", 10)), 300),
+    "siliconflow": (int(os.getenv("SILICONFLOW_POOL_LIMIT", 10)), 60),
+    "imgbb": (int(os.getenv("IMGBB_POOL_LIMIT", 5)), 60),
+    "media": (int(os.getenv("MEDIA_POOL_LIMIT", 4)), 600),  # video downloads from provider CDNs
+    "github": (2, 30),
+}
+HTTP_KEEPALIVE_SECONDS = 60
+HTTP_DNS_CACHE_SECONDS = 300
+
+# Media downloads are streamed into spooled temp files (RAM up to MEDIA_SPOOL_BYTES, then disk)
+MEDIA_CHUNK_BYTES = int(os.getenv("MEDIA_CHUNK_BYTES", 256 * 1024))
+MEDIA_SPOOL_BYTES = int(os.getenv("MEDIA_SPOOL_BYTES", 4 * 1024 * 1024))
+DISCORD_DEFAULT_UPLOAD_LIMIT = 10 * 1024 * 1024  # DMs and unboosted guilds
+
+# Streaming replies
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.2))  # seconds between message edits
+DISCORD_MESSAGE_LIMIT = 2000
+
+# Credential pools (health scoring + circuit breakers for every provider's keys)
+KEY_FAILURE_THRESHOLD = int(os.getenv("KEY_FAILURE_THRESHOLD", 3))  # consecutive failures before the circuit opens
+KEY_CIRCUIT_OPEN_SECONDS = float(os.getenv("KEY_CIRCUIT_OPEN_SECONDS", 60))
+KEY_AUTH_OPEN_SECONDS = float(os.getenv("KEY_AUTH_OPEN_SECONDS", 900))  # after a 401/403
+KEY_RATE_LIMIT_COOLDOWN = float(os.getenv("KEY_RATE_LIMIT_COOLDOWN", 10))
+
+# LLM response cache (only for stateless turns: saved memory off and no saved chat open)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 600))
+RESPONSE_CACHE_MAX = int(os.getenv("RESPONSE_CACHE_MAX", 500))
+RESPONSE_CACHE_SKIP_MODES = {
+    mode.strip() for mode in os.getenv("RESPONSE_CACHE_SKIP_MODES", "").split(",") if mode.strip()
+}
+
+# Image safety verdicts from the LLM checker, keyed by normalized prompt
+SAFETY_CACHE_MAX = int(os.getenv("SAFETY_CACHE_MAX", 5000))
+SAFETY_CACHE_TTL = float(os.getenv("SAFETY_CACHE_TTL", 24 * 3600))
+SAFETY_VERDICTS = ("AI:STOPIMAGE", "AI:ACCEPTIMAGE")
+
+# Smart-mode images: start rendering while the safety check runs (never uploaded before approval)
+SPECULATIVE_IMAGES = os.getenv("SPECULATIVE_IMAGES", "false").lower() in ("1", "true", "yes")
+# Race Pollinations against HF once HF has taken this long (0 disables hedging)
+IMAGE_HEDGE_SECONDS = float(os.getenv("IMAGE_HEDGE_SECONDS", 25))
+
+# Hugging Face warm-keeper: track model load state and keep it loaded while people are using it
+HF_WARM_KEEPER = os.getenv("HF_WARM_KEEPER", "true").lower() in ("1", "true", "yes")
+HF_WARM_INTERVAL = float(os.getenv("HF_WARM_INTERVAL", 300))  # max seconds between keep-warm cycles
+HF_WARM_MIN_INTERVAL = float(os.getenv("HF_WARM_MIN_INTERVAL", 60))
+HF_WARM_IDLE_SECONDS = float(os.getenv("HF_WARM_IDLE_SECONDS", 1800))  # stop pinging after this long unused
+HF_WARM_TRUST_SECONDS = float(os.getenv("HF_WARM_TRUST_SECONDS", 600))  # how long a "ready" observation is trusted
+
+# SiliconFlow video polling (one poller for every outstanding requestId)
+SILICONFLOW_VIDEO_SUBMIT_URL = f"{SILICONFLOW_BASE_URL}/video/submit"
+SILICONFLOW_VIDEO_STATUS_URL = f"{SILICONFLOW_BASE_URL}/video/status"
+VIDEO_POLL_QUEUED_SECONDS = float(os.getenv("VIDEO_POLL_QUEUED_SECONDS", 20))
+VIDEO_POLL_RUNNING_SECONDS = float(os.getenv("VIDEO_POLL_RUNNING_SECONDS", 8))
+VIDEO_POLL_MAX_SECONDS = float(os.getenv("VIDEO_POLL_MAX_SECONDS", 60))
+VIDEO_JOB_TIMEOUT = float(os.getenv("VIDEO_JOB_TIMEOUT", 20 * 60))
+
+# Durable media job queue (video via SiliconFlow, music via Pollinations)
+MEDIA_WORKERS = {
+    "video": int(os.getenv("VIDEO_WORKERS", 3)),
+    "music": int(os.getenv("MUSIC_WORKERS", 2)),
+}
+MEDIA_DEFAULT_DURATIONS = {"video": 480.0, "music": 60.0}  # seconds, until real jobs have been timed
+MEDIA_MAX_JOBS_PER_USER = int(os.getenv("MEDIA_MAX_JOBS_PER_USER", 3))  # per kind, queued + running
+
+# Groq rate limiting
+GROQ_MAX_QUEUE_WAIT = float(os.getenv("GROQ_MAX_QUEUE_WAIT", 5))  # seconds a request may wait for headroom
+GROQ_MAX_ATTEMPTS = int(os.getenv("GROQ_MAX_ATTEMPTS", 4))
+
+# LLM admission scheduling (fair queuing in front of mention replies)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))  # replies generating at once, across all keys
+LLM_PER_KEY_CONCURRENCY = int(os.getenv("LLM_PER_KEY_CONCURRENCY", 4))  # in-flight requests per Groq key
+LLM_FAIR_SCOPE = os.getenv("LLM_FAIR_SCOPE", "user")  # "user" or "channel": who shares a fair-queue flow
+LLM_DRR_QUANTUM = int(os.getenv("LLM_DRR_QUANTUM", 2048))  # estimated tokens credited to a flow per round
+LLM_QUEUE_SLO_SECONDS = float(os.getenv("LLM_QUEUE_SLO_SECONDS", 20))  # longest a reply may wait for a slot
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 200))
+LLM_POSITION_INTERVAL = 2.0  # seconds between queue position updates
+
+# Conversation sessions
+SESSION_SCOPE = os.getenv("SESSION_SCOPE", "channel")  # "guild", "channel" or "user"
+SESSION_MAX = int(os.getenv("SESSION_MAX", 5000))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", 64 * 1024 * 1024))
+STATS_LOG_SECONDS = int(os.getenv("STATS_LOG_SECONDS", 600))
+
+# Persistence (SQLite in WAL mode)
+DB_PATH = os.getenv("DB_PATH", "multigpt.db")
+LEGACY_CHATS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "savedchats.json")
+PERSIST_FLUSH_SECONDS = float(os.getenv("PERSIST_FLUSH_SECONDS", 0.25))
+PERSIST_COMPACT_SECONDS = int(os.getenv("PERSIST_COMPACT_SECONDS", 300))
+CHAT_CACHE_MAX = int(os.getenv("CHAT_CACHE_MAX", 1000))
+
+# Hosted image cache (request -> URL and image bytes -> URL; imgbb links don't expire)
+IMAGE_CACHE_MAX = int(os.getenv("IMAGE_CACHE_MAX", 2000))
+IMAGE_CACHE_DISK_MAX = int(os.getenv("IMAGE_CACHE_DISK_MAX", 50000))
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", 7 * 24 * 3600))
+
+# Pen archive retrieval
+ARCHIVE_TOP_K = int(os.getenv("ARCHIVE_TOP_K", 3))
+ARCHIVE_TOKEN_BUDGET = int(os.getenv("ARCHIVE_TOKEN_BUDGET", 900))
+
+# Metrics (/metrics on the web server)
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LOOP_LAG_INTERVAL = 0.5  # seconds between event loop lag samples
+
+# Request tracing and the /debug endpoints (disabled unless DEBUG_TOKEN is set)
+TRACE_LOG = os.getenv("TRACE_LOG", "true").lower() in ("1", "true", "yes")  # one JSON line per request
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", 10))
+TRACE_SLOW_BUFFER = int(os.getenv("TRACE_SLOW_BUFFER", 50))  # slow traces kept for /debug/traces
+TRACE_MAX_SPANS = 200
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_MAX_SECONDS = 30
+
+# ------------------------------
+# Metrics
+# ------------------------------
+def format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def format_value(value: float) -> str:
+    """Exact sample value: whole numbers as integers, never the 6-digit exponent form of :g."""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is one bisect and two adds, cumulative counts are built at scrape time."""
+
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def lines(self, name: str, labels: Dict[str, Any]) -> Iterator[str]:
+        cumulative = 0
+        for bound, count in zip((*self.bounds, "+Inf"), self.counts):
+            cumulative += count
+            yield f"{name}_bucket{format_labels({**labels, 'le': bound})} {cumulative}"
+        yield f"{name}_sum{format_labels(labels)} {self.total:.6f}"
+        yield f"{name}_count{format_labels(labels)} {self.count}"
+
+class MetricFamily(NamedTuple):
+    name: str
+    kind: str  # "counter" or "gauge"
+    help: str
+    samples: List[Tuple[Dict[str, Any], float]]
+
+class CallTimer:
+    """Times one upstream call (and adds it as a span to the current trace).
+
+    Set .status from the response; exceptions without one count as "error".
+    """
+
+    __slots__ = ("metrics", "provider", "operation", "status", "started", "recorded")
+
+    def __init__(self, metrics: "Metrics", provider: str, operation: str):
+        self.metrics = metrics
+        self.provider = provider
+        self.operation = operation
+        self.status: Optional[int] = None
+        self.started = 0.0
+        self.recorded = False
+
+    def __enter__(self) -> "CallTimer":
+        self.started = time.perf_counter()
+        return self
+
+    def finish(self, failed: bool = False):
+        """Record now, e.g. before a retry sleep that should not count as upstream latency."""
+        if self.recorded:
+            return
+        self.recorded = True
+        if self.status is not None:
+            outcome = str(self.status)
+        else:
+            outcome = "error" if failed else "ok"
+        seconds = time.perf_counter() - self.started
+        self.metrics.record(self.provider, self.operation, outcome, seconds)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(f"{self.provider}.{self.operation}", self.started, seconds, {"outcome": outcome})
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(failed=exc_type is not None)
+        return False
+
+class Metrics:
+    """Process-wide upstream call counters, latency histograms and event-loop lag.
+
+    Only the event loop thread records, so updates are plain dict and integer operations with no
+    locks. Gauges that other objects already track (queues, caches, key health) are not copied
+    here; they are read from their owners when /metrics is scraped.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Tuple[str, str, str], int] = {}  # (provider, operation, outcome) -> count
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.loop_lag = Histogram(LOOP_LAG_BUCKETS)
+        self.loop_lag_last = 0.0
+        self.started = time.time()
+
+    def call(self, provider: str, operation: str) -> CallTimer:
+        return CallTimer(self, provider, operation)
+
+    def record(self, provider: str, operation: str, outcome: str, seconds: float):
+        key = (provider, operation, outcome)
+        self.calls[key] = self.calls.get(key, 0) + 1
+        histogram = self.latency.get((provider, operation))
+        if histogram is None:
+            histogram = self.latency[(provider, operation)] = Histogram(METRICS_LATENCY_BUCKETS)
+        histogram.observe(seconds)
+
+    def observe_loop_lag(self, seconds: float):
+        self.loop_lag_last = seconds
+        self.loop_lag.observe(seconds)
+
+    def render(self, families: Iterable[MetricFamily] = ()) -> str:
+        """Everything in the Prometheus text exposition format."""
+        lines = [
+            "# HELP multigpt_upstream_requests_total Upstream provider calls by outcome (HTTP status, ok or error).",
+            "# TYPE multigpt_upstream_requests_total counter",
+        ]
+        for (provider, operation, outcome), count in sorted(self.calls.items()):
+            labels = {"provider": provider, "operation": operation, "outcome": outcome}
+            lines.append(f"multigpt_upstream_requests_total{format_labels(labels)} {count}")
+        lines += [
+            "# HELP multigpt_upstream_latency_seconds Upstream provider call latency.",
+            "# TYPE multigpt_upstream_latency_seconds histogram",
+        ]
+        for (provider, operation), histogram in sorted(self.latency.items()):
+            lines += histogram.lines(
+                "multigpt_upstream_latency_seconds", {"provider": provider, "operation": operation}
+            )
+        lines += [
+            "# HELP multigpt_event_loop_lag_seconds How late the event loop woke a sleeping task.",
+            "# TYPE multigpt_event_loop_lag_seconds histogram",
+            *self.loop_lag.lines("multigpt_event_loop_lag_seconds", {}),
+            "# HELP multigpt_event_loop_lag_last_seconds Most recent event loop lag sample.",
+            "# TYPE multigpt_event_loop_lag_last_seconds gauge",
+            f"multigpt_event_loop_lag_last_seconds {self.loop_lag_last:.6f}",
+            "# HELP multigpt_start_time_seconds Unix time the process started.",
+            "# TYPE multigpt_start_time_seconds gauge",
+            f"multigpt_start_time_seconds {self.started:.0f}",
+        ]
+        for family in families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for labels, value in family.samples:
+                lines.append(f"{family.name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# ------------------------------
+# Tracing and Profiling
+# ------------------------------
+current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """Stage timings for one user request; spans are appended by whatever runs in its context."""
+
+    __slots__ = ("trace_id", "name", "attrs", "started", "wall_started", "spans", "dropped", "status")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.spans: List[dict] = []
+        self.dropped = 0
+        self.status = "ok"
+
+    def add(self, name: str, started: float, seconds: float, attrs: Dict[str, Any]):
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append({
+            "name": name,
+            "at_ms": round((started - self.started) * 1000, 1),
+            "ms": round(seconds * 1000, 1),
+            **attrs
+        })
+
+    def record(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start": datetime.fromtimestamp(self.wall_started).isoformat(timespec="milliseconds"),
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "status": self.status,
+            **self.attrs,
+            "spans": self.spans,
+            **({"dropped_spans": self.dropped} if self.dropped else {})
+        }
+
+class Span:
+    __slots__ = ("trace", "name", "attrs", "started")
+
+    def __init__(self, trace: Trace, name: str, attrs: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.started = 0.0
+
+    def __enter__(self) -> "Span":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.trace.add(self.name, self.started, time.perf_counter() - self.started, self.attrs)
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NO_SPAN = _NoSpan()
+
+def span(name: str, **attrs):
+    """Time a stage of the current request; a no-op outside a trace (background loops)."""
+    trace = current_trace.get()
+    return NO_SPAN if trace is None else Span(trace, name, attrs)
+
+def trace_status(status: str):
+    """Record the current request's outcome when it is handled rather than raised."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.status = status[:200]
+
+async def traced_sleep(name: str, seconds: float):
+    with span(name, seconds=seconds):
+        await asyncio.sleep(seconds)
+
+class Tracer:
+    """Starts traces, logs each finished one as a JSON line and keeps the slowest recent ones."""
+
+    def __init__(self, slow_seconds: float = TRACE_SLOW_SECONDS, buffer_size: int = TRACE_SLOW_BUFFER):
+        self.slow_seconds = slow_seconds
+        self.slow: deque = deque(maxlen=buffer_size)
+        self.stats = {"traces": 0, "slow": 0}
+
+    @contextlib.contextmanager
+    def trace(self, name: str, **attrs) -> Iterator[Trace]:
+        trace = Trace(name, attrs)
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        except asyncio.CancelledError:
+            trace.status = "cancelled"
+            raise
+        except BaseException as e:
+            trace.status = f"error: {type(e).__name__}"
+            raise
+        finally:
+            current_trace.reset(token)
+            self.finish(trace)
+
+    def finish(self, trace: Trace):
+        record = trace.record()
+        self.stats["traces"] += 1
+        if record["total_ms"] >= self.slow_seconds * 1000:
+            self.stats["slow"] += 1
+            self.slow.append(record)
+        if TRACE_LOG:
+            trace_logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+    def summary(self) -> str:
+        slowest = max((record["total_ms"] for record in self.slow), default=0.0)
+        return (
+            f"{self.stats['traces']} traces, {self.stats['slow']} slower than {self.slow_seconds:.0f}s "
+            f"({len(self.slow)} kept, slowest {slowest / 1000:.1f}s)"
+        )
+
+class SamplingProfiler:
+    """Samples one thread's Python stack from a helper thread and counts folded stacks.
+
+    The output is the "folded" format flamegraph.pl and speedscope read: frames joined by ";"
+    followed by a sample count. Run it with asyncio.to_thread so the event loop keeps serving.
+    Samples land when the sampled thread hands over the GIL, so CPU bursts shorter than the
+    interpreter's 5 ms switch interval are under-counted.
+    """
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+
+    def run(self, seconds: float) -> Counter:
+        stacks: Counter = Counter()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if frames:
+                stacks[";".join(reversed(frames))] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    @staticmethod
+    def report(stacks: Counter, seconds: float, top: int) -> str:
+        total = sum(stacks.values())
+        self_counts: Counter = Counter()
+        for stack, count in stacks.items():
+            self_counts[stack.rsplit(";", 1)[-1]] += count
+        lines = [f"# {total} samples over {seconds:.1f}s; top {top} functions by self samples:"]
+        for function, count in self_counts.most_common(top):
+            lines.append(f"# {count / total * 100:5.1f}%  {function}")
+        lines.append("# folded stacks:")
+        lines += [f"{stack} {count}" for stack, count in stacks.most_common()]
+        return "\n".join(lines) + "\n"
+
+# ------------------------------
+# HTTP Client Pool
+# ------------------------------
+class HTTPClientPool:
+    """Long-lived aiohttp sessions, one keep-alive connection pool per provider."""
+
+    def __init__(self):
+        self.sessions: Dict[str, aiohttp.ClientSession] = {}
+        self.closed = False
+        self.stats: Dict[str, Dict[str, int]] = {
+            name: {"requests": 0, "new_connections": 0, "reused_connections": 0}
+            for name in HTTP_POOL_LIMITS
+        }
+
+    def _trace_config(self, provider: str) -> aiohttp.TraceConfig:
+        stats = self.stats[provider]
+
+        async def on_request_start(session, ctx, params):
+            stats["requests"] += 1
+
+        async def on_connection_create_end(session, ctx, params):
+            stats["new_connections"] += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            stats["reused_connections"] += 1
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace
+
+    def get(self, provider: str) -> aiohttp.ClientSession:
+        """Return the shared session for a provider, creating it on first use."""
+        if self.closed:
+            # Late callers during shutdown would otherwise open sessions nobody closes
+            raise RuntimeError(f"HTTP pools are closed; no {provider} session")
+        session = self.sessions.get(provider)
+        if session is None or session.closed:
+            limit, total_timeout = HTTP_POOL_LIMITS[provider]
+            connector = aiohttp.TCPConnector(
+                limit=limit,
+                limit_per_host=limit,
+                ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+                keepalive_timeout=HTTP_KEEPALIVE_SECONDS
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=total_timeout, connect=15),
+                trace_configs=[self._trace_config(provider)]
+            )
+            self.sessions[provider] = session
+        return session
+
+    async def open(self):
+        for provider in HTTP_POOL_LIMITS:
+            self.get(provider)
+        logger.info(f"HTTP pools opened for: {', '.join(HTTP_POOL_LIMITS)}")
+
+    async def close(self):
+        self.closed = True
+        for session in self.sessions.values():
+            if not session.closed:
+                await session.close()
+        self.sessions.clear()
+
+    def summary(self) -> str:
+        parts = []
+        for provider, stats in self.stats.items():
+            if not stats["requests"]:
+                continue
+            connections = stats["new_connections"] + stats["reused_connections"]
+            reuse = stats["reused_connections"] / connections * 100 if connections else 0.0
+            parts.append(
+                f"{provider}: {stats['requests']} reqs, {stats['new_connections']} new / "
+                f"{stats['reused_connections']} reused conns ({reuse:.0f}% reuse)"
+            )
+        return "; ".join(parts) or "no requests"
+
+# ------------------------------
+# Media Downloads
+# ------------------------------
+def current_rss_bytes() -> int:
+    """Resident set size right now (Linux), falling back to the process peak elsewhere."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def upload_limit_for(channel) -> int:
+    guild = getattr(channel, "guild", None)
+    return guild.filesize_limit if guild is not None else DISCORD_DEFAULT_UPLOAD_LIMIT
+
+class MediaTooLarge(Exception):
+    def __init__(self, size: int, limit: int):
+        super().__init__(f"media is over the {limit / 1048576:.0f} MB upload limit")
+        self.size = size
+        self.limit = limit
+
+class SpooledMedia:
+    """A downloaded file held in a spooled temp file; share it by sending under `lock`.
+
+    Holders call release() when done; the temp file is closed when the last reference goes.
+    """
+
+    __slots__ = ("file", "size", "lock", "refs")
+
+    def __init__(self, file: tempfile.SpooledTemporaryFile, size: int):
+        self.file = file
+        self.size = size
+        self.lock = asyncio.Lock()
+        self.refs = 1
+
+    def discord_file(self, filename: str) -> discord.File:
+        self.file.seek(0)
+        return discord.File(self.file, filename=filename)
+
+    def release(self):
+        self.refs -= 1
+        if self.refs <= 0:
+            self.close()
+
+    def close(self):
+        self.file.close()
+
+async def spool_response(resp: aiohttp.ClientResponse, limit: int, label: str) -> SpooledMedia:
+    """Stream a response body to a spooled temp file, aborting as soon as it exceeds `limit` bytes."""
+    if resp.content_length is not None and resp.content_length > limit:
+        raise MediaTooLarge(resp.content_length, limit)
+    rss_before = peak_rss = current_rss_bytes()
+    spool = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_BYTES)
+    size = 0
+    try:
+        async for chunk in resp.content.iter_chunked(MEDIA_CHUNK_BYTES):
+            size += len(chunk)
+            if size > limit:
+                raise MediaTooLarge(size, limit)
+            spool.write(chunk)
+            peak_rss = max(peak_rss, current_rss_bytes())
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    logger.info(
+        f"Downloaded {label}: {size / 1048576:.1f} MB in {MEDIA_CHUNK_BYTES // 1024} KB chunks, "
+        f"peak RSS +{(peak_rss - rss_before) / 1048576:.1f} MB"
+    )
+    return SpooledMedia(spool, size)
+
+# ------------------------------
+# Request Coalescing
+# ------------------------------
+def normalize_prompt(prompt: str) -> str:
+    """Case- and whitespace-insensitive form of a prompt, for keying identical requests."""
+    return " ".join(prompt.casefold().split())
+
+def _consume_exception(future: asyncio.Future):
+    # Followers may all have gone away; don't warn about an exception nobody retrieved
+    if not future.cancelled():
+        future.exception()
+
+class SingleFlight:
+    """Coalesces concurrent identical upstream calls: the first caller runs, the rest share its result."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.flights: Dict[Hashable, asyncio.Future] = {}
+        self.holders: Dict[asyncio.Future, int] = {}  # run_shared callers per flight, until it completes
+        self.stats = {"upstream": 0, "saved": 0}
+
+    def join(self, key: Hashable) -> Optional[asyncio.Future]:
+        """The in-flight result for key, if another caller is already fetching it."""
+        future = self.flights.get(key)
+        if future is not None:
+            self.stats["saved"] += 1
+        return future
+
+    def begin(self, key: Hashable) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        self.flights[key] = future
+        self.stats["upstream"] += 1
+        return future
+
+    def complete(self, key: Hashable, future: asyncio.Future, result: Any = None, error: Optional[BaseException] = None):
+        if self.flights.get(key) is future:
+            del self.flights[key]
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        future = self.join(key)
+        if future is not None:
+            # Shielded so one follower giving up doesn't cancel the call for everyone else
+            return await asyncio.shield(future)
+        future = self.begin(key)
+        try:
+            result = await factory()
+        except Exception as e:
+            self.complete(key, future, error=e)
+            raise
+        except BaseException:
+            self.complete(key, future, error=Exception(f"shared {self.name} request was cancelled"))
+            raise
+        self.complete(key, future, result)
+        return result
+
+    async def run_shared(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """run() for results holding a resource (SpooledMedia): every caller handed the result must release() it.
+
+        Callers are counted as they join, so the result starts with one reference per caller still waiting
+        and a quick caller can't free it before slower ones pick it up.
+        """
+        future = self.join(key)
+        leading = future is None
+        if leading:
+            future = self.begin(key)
+        self.holders[future] = self.holders.get(future, 0) + 1
+        if leading:
+            try:
+                result = await factory()
+            except BaseException as e:
+                self.holders.pop(future, None)
+                if not isinstance(e, Exception):
+                    e = Exception(f"shared {self.name} request was cancelled")
+                self.complete(key, future, error=e)
+                raise
+            result.refs = self.holders.pop(future)
+            self.complete(key, future, result)
+            return result
+        try:
+            return await asyncio.shield(future)
+        except BaseException:
+            if future in self.holders:
+                self.holders[future] -= 1  # gave up before the result existed
+            elif future.done() and not future.cancelled() and future.exception() is None:
+                future.result().release()  # counted in, but cancelled before picking it up
+            raise
+
+    def summary(self) -> str:
+        return f"{self.name} {self.stats['upstream']} upstream/{self.stats['saved']} saved"
+
+class SpeculativeRender:
+    """An image render started before its safety verdict; the image stays private until approved."""
+
+    __slots__ = ("task", "started", "finished")
+
+    def __init__(self, render: Callable[[], Awaitable[Optional[Tuple[str, bytes]]]]):
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.task = asyncio.create_task(self._run(render))
+        self.task.add_done_callback(_consume_exception)
+
+    async def _run(self, render: Callable[[], Awaitable[Optional[Tuple[str, bytes]]]]) -> Optional[Tuple[str, bytes]]:
+        try:
+            return await render()
+        finally:
+            self.finished = time.perf_counter()
+
+    def overlap(self, until: float) -> float:
+        """Seconds of rendering that ran concurrently with work ending at `until`."""
+        end = min(until, self.finished) if self.finished is not None else until
+        return max(0.0, end - self.started)
+
+    def done(self) -> bool:
+        return self.task.done()
+
+    def cancel(self):
+        if not self.task.done():
+            self.task.cancel()
+
+# ------------------------------
+# Caching
+# ------------------------------
+class TTLCache:
+    """Size-bounded LRU cache whose entries also expire after a TTL."""
+
+    def __init__(self, name: str, max_entries: int, ttl: float):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return value
+            del self.entries[key]
+            self.stats["expired"] += 1
+        self.stats["misses"] += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def hit_ratio(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"{self.name} {len(self.entries)}/{self.max_entries} entries, "
+            f"{self.stats['hits']} hits/{self.stats['misses']} misses ({self.hit_ratio() * 100:.0f}%), "
+            f"{self.stats['evictions']} evicted, {self.stats['expired']} expired"
+        )
+
+class ExpiringCooldowns:
+    """Per-user cooldown windows that are forgotten once they pass, so memory tracks recent senders only."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        # Every window has the same length, so insertion order is also expiry order
+        self.until: "OrderedDict[int, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.until)
+
+    def hit(self, user_id: int, now: Optional[float] = None) -> bool:
+        """True if user_id is still cooling down; otherwise open a new window and return False."""
+        now = time.monotonic() if now is None else now
+        until = self.until
+        while until and next(iter(until.values())) <= now:
+            until.popitem(last=False)
+        if user_id in until:
+            return True
+        until[user_id] = now + self.seconds
+        return False
+
+# ------------------------------
+# Streaming Replies
+# ------------------------------
+class ThinkStripper:
+    """Incrementally removes <think>...</think> sections from streamed text."""
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self.inside = False
+        self.pending = ""
+
+    def feed(self, text: str) -> str:
+        data = self.pending + text
+        self.pending = ""
+        visible = []
+        while data:
+            tag = self.CLOSE_TAG if self.inside else self.OPEN_TAG
+            idx = data.find(tag)
+            if idx == -1:
+                # Hold back a trailing partial tag until the next chunk arrives
+                keep = 0
+                for n in range(min(len(tag) - 1, len(data)), 0, -1):
+                    if tag.startswith(data[-n:]):
+                        keep = n
+                        break
+                if not self.inside:
+                    visible.append(data[:len(data) - keep])
+                self.pending = data[len(data) - keep:]
+                break
+            if not self.inside:
+                visible.append(data[:idx])
+            data = data[idx + len(tag):]
+            self.inside = not self.inside
+        return "".join(visible)
+
+    def flush(self) -> str:
+        rest, self.pending = self.pending, ""
+        return "" if self.inside else rest
+
+def strip_think(text: str) -> str:
+    stripper = ThinkStripper()
+    return (stripper.feed(text) + stripper.flush()).strip()
+
+class StreamingReply:
+    """Progressively edits a Discord message as text streams in, spilling into follow-ups past 2000 chars."""
+
+    def __init__(self, message: discord.Message, interval: float = STREAM_EDIT_INTERVAL):
+        self.messages = [message]
+        self.interval = interval
+        self.text = ""
+        self.offset = 0  # start of the text shown in the last message
+        self.shown = message.content
+        self.last_edit = 0.0
+        self.started = time.monotonic()
+        self.first_visible: Optional[float] = None
+
+    async def push(self, text: str):
+        if not text:
+            return
+        self.text += text
+        if self.first_visible is None and self.text.strip():
+            self.first_visible = time.monotonic() - self.started
+            await self._render()
+        elif time.monotonic() - self.last_edit >= self.interval:
+            await self._render()
+
+    async def finish(self) -> str:
+        """Final render; returns the reply text, or "" when nothing came back (the error is display-only)."""
+        if not self.text.strip():
+            await self._edit("❌ Error: empty response")
+            return ""
+        await self._render()
+        return self.text
+
+    async def _render(self):
+        self.last_edit = time.monotonic()
+        while len(self.text) - self.offset > DISCORD_MESSAGE_LIMIT:
+            chunk = self.text[self.offset:self.offset + DISCORD_MESSAGE_LIMIT]
+            cut = chunk.rfind("\n")
+            if cut > DISCORD_MESSAGE_LIMIT // 2:
+                chunk = chunk[:cut + 1]
+            await self._edit(chunk)
+            self.offset += len(chunk)
+            self.messages.append(await self.messages[-1].channel.send("✏️ ..."))
+            self.shown = "✏️ ..."
+        await self._edit(self.text[self.offset:])
+
+    async def _edit(self, content: str):
+        if content.strip() and content != self.shown:
+            await self.messages[-1].edit(content=content)
+            self.shown = content
+
+# ------------------------------
+# Pen Archive Retrieval
+# ------------------------------
+ARCHIVE_SECTION_RE = re.compile(r"(?im)^(?=archive\s+\d+)")
+WORD_RE = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset(
+    "a an and are as at be but by can do for from has have he her his how i if in is it its me "
+    "my no not of on or our she so that the their them they this to was we were what when where "
+    "which who why will with you your".split()
+)
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for budgeting."""
+    return (len(text) + 3) // 4
+
+def tokenize(text: str) -> List[str]:
+    return [word for word in WORD_RE.findall(text.lower()) if word not in STOP_WORDS]
+
+class ArchiveIndex:
+    """BM25 index over the Pen archive, one document per ARCHIVE NNN section."""
+
+    def __init__(self, text: str, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.chunks = [part.strip() for part in ARCHIVE_SECTION_RE.split(text) if part.strip()]
+        self.chunk_tokens = [estimate_tokens(chunk) for chunk in self.chunks]
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.doc_lengths: List[int] = []
+        for doc_id, chunk in enumerate(self.chunks):
+            terms = Counter(tokenize(chunk))
+            self.doc_lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self.postings.setdefault(term, []).append((doc_id, tf))
+        self.avg_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0.0
+        n = len(self.chunks)
+        self.idf = {
+            term: math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    def search(self, query: str, top_k: int = ARCHIVE_TOP_K) -> List[Tuple[int, float]]:
+        """Return (chunk index, score) pairs for the best matching sections."""
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, tf in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    def context_for(self, query: str, top_k: int = ARCHIVE_TOP_K, token_budget: int = ARCHIVE_TOKEN_BUDGET) -> str:
+        """Relevant archive sections for a prompt, in archive order and within the token budget."""
+        selected = []
+        remaining = token_budget
+        for doc_id, _ in self.search(query, top_k):
+            if self.chunk_tokens[doc_id] <= remaining:
+                selected.append(doc_id)
+                remaining -= self.chunk_tokens[doc_id]
+        return "\n\n".join(self.chunks[doc_id] for doc_id in sorted(selected))
+
+# ------------------------------
+# Prompt Compilation
+# ------------------------------
+# Discord markdown cheat sheet shared by every mode prompt
+DISCORD_SYNTAX_GUIDE = (
+    "**Bold text**: **Yo, this is bold!**\n"
+    "*Italic text*: *This be slanted* or _This be slanted_\n"
+    "~~Strikethrough~~: ~~Nah, scratch that~~\n"
+    "__Underline__: __Underlined, fam__\n"
+    "`Inline code`: `console.log(\"Lit code\")`\n"
+    "```Code block```\n"
+    "```javascript\n"
+    "console.log(\"Bot go brrr\");\n"
+    "```\n"
+)
+
+class CompiledPrompt(NamedTuple):
+    message: dict
+    tokens: int
+
+class PromptCompiler:
+    """Builds the static system prefix once per (mode, model, day) and reuses it verbatim.
+
+    Keeping the prefix byte-identical between calls lets upstream prompt-prefix caching hit;
+    everything that varies per call (history, archive excerpts, the user turn) goes after it.
+    """
+
+    def __init__(self, mode_prompts: Dict[str, str]):
+        self.mode_prompts = mode_prompts
+        self.prefixes: Dict[Tuple[str, str, str], CompiledPrompt] = {}
+        self.token_counts: Dict[str, int] = {}
+
+    def count_tokens(self, text: str) -> int:
+        count = self.token_counts.get(text)
+        if count is None:
+            if len(self.token_counts) >= 4096:
+                self.token_counts.clear()
+            count = self.token_counts[text] = estimate_tokens(text)
+        return count
+
+    def prefix(self, mode: str, model: str) -> CompiledPrompt:
+        day = datetime.now(TZ_UAE).strftime("%Y-%m-%d")
+        key = (mode, model, day)
+        compiled = self.prefixes.get(key)
+        if compiled is None:
+            # Prefixes from previous days will never be requested again
+            self.prefixes = {k: v for k, v in self.prefixes.items() if k[2] == day}
+            mode_prompt = self.mode_prompts.get(mode, self.mode_prompts["chill"])
+            content = f"Today in UAE date: {day}. {mode_prompt}"
+            compiled = CompiledPrompt({"role": "system", "content": content}, self.count_tokens(content))
+            self.prefixes[key] = compiled
+        return compiled
+
+# ------------------------------
+# Prompt Screening
+# ------------------------------
+def _trie_regex(words: Iterable[str]) -> str:
+    """Regex alternation factored by shared prefixes, so each position is tried in one pass."""
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+def compile_keyword_pattern(keywords: Iterable[str]) -> "re.Pattern":
+    """One regex matching any keyword as a whole word; search lowercased text.
+
+    Words end at any non-letter, so "nsfw_art" and "porn123" still match while "class", "assistant"
+    and "cocktail" do not. Derived forms ("sexual", "asshole") must be listed as keywords themselves.
+    """
+    stems = _trie_regex(sorted({keyword.lower() for keyword in keywords}))
+    return re.compile(rf"(?<![a-z]){stems}(?![a-z])")
+
+# ------------------------------
+# Credential Pools
+# ------------------------------
+class KeyHealth:
+    __slots__ = (
+        "successes", "failures", "rate_limited", "unauthorized", "consecutive_failures",
+        "latency_ewma", "cooldown_until", "open_until", "in_flight", "last_status"
+    )
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.unauthorized = 0
+        self.consecutive_failures = 0
+        self.latency_ewma: Optional[float] = None
+        self.cooldown_until = 0.0
+        self.open_until = 0.0  # circuit breaker; half-open (one probe at a time) once this passes
+        self.in_flight = 0
+        self.last_status: Optional[int] = None
+
+    @property
+    def success_rate(self) -> float:
+        total = self.successes + self.failures + self.rate_limited + self.unauthorized
+        return self.successes / total if total else 1.0
+
+    def available_at(self) -> float:
+        return max(self.cooldown_until, self.open_until)
+
+    def usable(self, now: float) -> bool:
+        if self.cooldown_until > now or self.open_until > now:
+            return False
+        # A key whose circuit has been opened gets a single probe request at a time
+        return self.open_until == 0.0 or self.in_flight == 0
+
+class KeyLease:
+    """One request's use of a pooled key; report the outcome with done()."""
+
+    __slots__ = ("pool", "index", "started", "released")
+
+    def __init__(self, pool: "CredentialPool", index: int):
+        self.pool = pool
+        self.index = index
+        self.started = time.monotonic()
+        self.released = False
+
+    @property
+    def key(self) -> str:
+        return self.pool.keys[self.index]
+
+    def done(self, status: int = 0, retry_after: Optional[float] = None):
+        """Report an HTTP status (0 = transport error or timeout). Only the first report counts."""
+        if not self.released:
+            self.released = True
+            self.pool.report(self.index, status, time.monotonic() - self.started, retry_after)
+
+    def abandon(self):
+        """Release without affecting the key's health (e.g. the request was cancelled)."""
+        if not self.released:
+            self.released = True
+            self.pool.health[self.index].in_flight -= 1
+
+class CredentialPool:
+    """API keys for one provider, tracked for health and handed out least-loaded first."""
+
+    def __init__(self, provider: str, keys: List[str]):
+        self.provider = provider
+        self.keys = keys
+        self.health = [KeyHealth() for _ in keys]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def usable_indices(self) -> List[int]:
+        now = time.monotonic()
+        return [i for i, health in enumerate(self.health) if health.usable(now)]
+
+    def acquire(self, candidates: Optional[List[int]] = None) -> KeyLease:
+        if not self.keys:
+            raise Exception(f"No {self.provider} API keys configured")
+        if candidates is None:
+            candidates = self.usable_indices()
+        if candidates:
+            index = min(candidates, key=lambda i: (
+                self.health[i].in_flight,
+                -self.health[i].success_rate,
+                self.health[i].latency_ewma or 0.0
+            ))
+        else:
+            # Everything is cooling down or tripped; use whichever key recovers first
+            index = min(range(len(self.keys)), key=lambda i: self.health[i].available_at())
+        return self.lease(index)
+
+    def lease(self, index: int) -> KeyLease:
+        self.health[index].in_flight += 1
+        return KeyLease(self, index)
+
+    def report(self, index: int, status: int, latency: float, retry_after: Optional[float] = None):
+        health = self.health[index]
+        now = time.monotonic()
+        health.in_flight -= 1
+        health.last_status = status
+        if status == 429:
+            health.rate_limited += 1
+            health.cooldown_until = now + (KEY_RATE_LIMIT_COOLDOWN if retry_after is None else retry_after)
+        elif status in (401, 403):
+            health.unauthorized += 1
+            health.open_until = now + KEY_AUTH_OPEN_SECONDS
+            logger.warning(f"{self.provider} key #{index + 1} unauthorized ({status}), circuit open")
+        elif status == 0 or status >= 500:
+            health.failures += 1
+            health.consecutive_failures += 1
+            if health.consecutive_failures >= KEY_FAILURE_THRESHOLD:
+                health.open_until = now + KEY_CIRCUIT_OPEN_SECONDS
+                logger.warning(f"{self.provider} key #{index + 1} failing repeatedly, circuit open")
+        else:
+            # Other 4xx responses are about the request, not the key
+            health.successes += 1
+            health.consecutive_failures = 0
+            health.open_until = 0.0
+            health.latency_ewma = latency if health.latency_ewma is None else 0.8 * health.latency_ewma + 0.2 * latency
+
+    def status_lines(self) -> List[str]:
+        now = time.monotonic()
+        lines = []
+        for i, health in enumerate(self.health):
+            if health.open_until > now:
+                state = f"🔴 open {health.open_until - now:.0f}s"
+            elif health.cooldown_until > now:
+                state = f"🟡 cooldown {health.cooldown_until - now:.0f}s"
+            elif health.open_until:
+                state = "🟠 half-open"
+            else:
+                state = "🟢 healthy"
+            latency = f"{health.latency_ewma:.2f}s" if health.latency_ewma is not None else "n/a"
+            lines.append(
+                f"{self.provider} #{i + 1}: {state} • {health.success_rate * 100:.0f}% ok • "
+                f"{latency} avg • {health.in_flight} in flight • {health.rate_limited}×429 • "
+                f"{health.failures} errors • last {health.last_status}"
+            )
+        return lines
+
+    def summary(self) -> str:
+        successes = sum(health.successes for health in self.health)
+        rate_limited = sum(health.rate_limited for health in self.health)
+        failures = sum(health.failures + health.unauthorized for health in self.health)
+        return (
+            f"{len(self.usable_indices())}/{len(self.keys)} usable, "
+            f"{successes} ok, {rate_limited} rate limited, {failures} failed"
+        )
+
+# ------------------------------
+# Groq Rate Limiting
+# ------------------------------
+DURATION_PART_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parse Groq's reset headers ("2m59.56s", "7.66s", "120ms") or plain seconds."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART_RE.findall(value)
+    if not parts:
+        return None
+    scale = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(amount) * scale[unit] for amount, unit in parts)
+
+class TokenBucket:
+    """Continuously refilling bucket, calibrated from x-ratelimit-* headers. Unlimited until first observed."""
+
+    __slots__ = ("capacity", "level", "rate", "updated")
+
+    def __init__(self):
+        self.capacity: Optional[float] = None
+        self.level = 0.0
+        self.rate = 0.0
+        self.updated = 0.0
+
+    def level_at(self, now: float) -> float:
+        if self.capacity is None:
+            return math.inf
+        return min(self.capacity, self.level + self.rate * (now - self.updated))
+
+    def headroom(self, now: float) -> float:
+        """Fraction of capacity currently available (1.0 when unknown)."""
+        if self.capacity is None or self.capacity <= 0:
+            return 1.0
+        return self.level_at(now) / self.capacity
+
+    def wait_for(self, amount: float, now: float) -> float:
+        level = self.level_at(now)
+        if level >= amount:
+            return 0.0
+        if self.rate <= 0:
+            return math.inf
+        return (amount - level) / self.rate
+
+    def take(self, amount: float, now: float):
+        if self.capacity is not None:
+            self.level = self.level_at(now) - amount
+            self.updated = now
+
+    def observe(self, limit: Optional[str], remaining: Optional[str], reset: Optional[str], now: float):
+        try:
+            capacity = float(limit) if limit is not None else self.capacity
+            level = float(remaining)
+        except (TypeError, ValueError):
+            return
+        if capacity is None:
+            return
+        reset_seconds = parse_reset_duration(reset)
+        self.capacity = capacity
+        self.level = level
+        # Groq reports the time until the bucket is full again; assume a linear refill until then
+        self.rate = (capacity - level) / reset_seconds if reset_seconds else capacity
+        self.updated = now
+
+class GroqRateLimiter:
+    """Schedules Groq requests onto the key with the most headroom for the model, per response headers."""
+
+    def __init__(self, pool: CredentialPool, max_wait: float = GROQ_MAX_QUEUE_WAIT,
+                 per_key_limit: int = LLM_PER_KEY_CONCURRENCY):
+        self.pool = pool
+        self.max_wait = max_wait
+        self.per_key_limit = per_key_limit
+        # (key index, model) -> (requests bucket, tokens bucket)
+        self.buckets: Dict[Tuple[int, str], Tuple[TokenBucket, TokenBucket]] = {}
+        self.blocked_until: Dict[Tuple[int, str], float] = {}
+        self.stats = {"acquired": 0, "queued": 0, "queued_seconds": 0.0, "forced": 0, "rate_limited": 0}
+
+    def _buckets(self, key_index: int, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        buckets = self.buckets.get((key_index, model))
+        if buckets is None:
+            buckets = self.buckets[(key_index, model)] = (TokenBucket(), TokenBucket())
+        return buckets
+
+    def _assess(self, key_index: int, model: str, tokens: int, now: float) -> Tuple[float, float]:
+        """(seconds until this key can take the request, headroom after taking it)."""
+        requests_bucket, tokens_bucket = self._buckets(key_index, model)
+        wait = max(
+            self.blocked_until.get((key_index, model), 0.0) - now,
+            requests_bucket.wait_for(1, now),
+            tokens_bucket.wait_for(tokens, now),
+            0.0
+        )
+        return wait, min(requests_bucket.headroom(now), tokens_bucket.headroom(now))
+
+    async def acquire(self, model: str, tokens: int) -> KeyLease:
+        """Lease a healthy key for a request, waiting briefly if every key is out of headroom."""
+        started = time.monotonic()
+        queued = False
+        while True:
+            now = time.monotonic()
+            usable = self.pool.usable_indices() or list(range(len(self.pool)))
+            # Keys at their concurrency cap are skipped unless every key is (unscheduled calls can overflow)
+            candidates = [i for i in usable if self.pool.health[i].in_flight < self.per_key_limit] or usable
+            waits = [(*self._assess(i, model, tokens, now), i) for i in candidates]
+            wait, _, key_index = min(
+                waits, key=lambda item: (item[0], self.pool.health[item[2]].in_flight, -item[1])
+            )
+            remaining = self.max_wait - (now - started)
+            if wait <= 0 or wait > remaining:
+                if wait > 0:
+                    # Nothing frees up in time; send it anyway and let the retry path handle a 429
+                    self.stats["forced"] += 1
+                break
+            if not queued:
+                queued = True
+                self.stats["queued"] += 1
+            await asyncio.sleep(wait)
+        if queued:
+            self.stats["queued_seconds"] += time.monotonic() - started
+        requests_bucket, tokens_bucket = self._buckets(key_index, model)
+        requests_bucket.take(1, now)
+        tokens_bucket.take(tokens, now)
+        self.stats["acquired"] += 1
+        return self.pool.lease(key_index)
+
+    def observe(self, lease: KeyLease, model: str, status: int, headers):
+        """Recalibrate from a response's headers and report it to the key pool."""
+        key_index = lease.index
+        # 429s are tracked per model here, so the key itself is not put on cooldown
+        lease.done(status, retry_after=0)
+        now = time.monotonic()
+        requests_bucket, tokens_bucket = self._buckets(key_index, model)
+        requests_bucket.observe(
+            headers.get("x-ratelimit-limit-requests"),
+            headers.get("x-ratelimit-remaining-requests"),
+            headers.get("x-ratelimit-reset-requests"),
+            now
+        )
+        tokens_bucket.observe(
+            headers.get("x-ratelimit-limit-tokens"),
+            headers.get("x-ratelimit-remaining-tokens"),
+            headers.get("x-ratelimit-reset-tokens"),
+            now
+        )
+        if status == 429:
+            self.stats["rate_limited"] += 1
+            retry_after = parse_reset_duration(headers.get("retry-after")) or COOLDOWN_DURATION
+            self.blocked_until[(key_index, model)] = now + retry_after
+
+    def summary(self) -> str:
+        stats = self.stats
+        return (
+            f"{stats['acquired']} requests, {stats['queued']} queued ({stats['queued_seconds']:.1f}s total), "
+            f"{stats['forced']} sent without headroom, {stats['rate_limited']} rate limited"
+        )
+
+def estimate_request_tokens(messages: List[dict], max_tokens: int) -> int:
+    return sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+
+# ------------------------------
+# LLM Scheduling
+# ------------------------------
+class LoadShed(Exception):
+    """An LLM request was turned away because the queue is full or its wait passed the SLO."""
+
+class LLMTicket:
+    __slots__ = ("flow", "cost", "enqueued", "granted")
+
+    def __init__(self, flow: Hashable, cost: int):
+        self.flow = flow
+        self.cost = cost  # estimated tokens, charged against the flow's deficit
+        self.enqueued = time.monotonic()
+        self.granted: asyncio.Future = asyncio.get_running_loop().create_future()
+
+class LLMScheduler:
+    """Admits LLM replies under a concurrency cap, sharing slots fairly across flows (users or channels).
+
+    Waiting requests are served by deficit round-robin: each pass credits a flow with `quantum`
+    estimated tokens and it may start requests while its credit covers them, so one user spamming
+    mentions gets the same share of the slots as everyone else. Requests that cannot start within
+    the SLO are shed instead of piling up behind a rate-limited upstream.
+    """
+
+    def __init__(self, concurrency: int, quantum: int = LLM_DRR_QUANTUM, slo: float = LLM_QUEUE_SLO_SECONDS,
+                 max_queue: int = LLM_MAX_QUEUE):
+        self.concurrency = max(1, concurrency)
+        self.quantum = max(1, quantum)
+        self.slo = slo
+        self.max_queue = max_queue
+        self.running = 0
+        # flow -> its waiting tickets; dict order is the round-robin rotation
+        self.flows: "OrderedDict[Hashable, deque]" = OrderedDict()
+        self.deficits: Dict[Hashable, int] = {}
+        self.waiting = 0
+        self.service_ewma: Optional[float] = None  # seconds a slot is held
+        self._positions: Optional[Dict[int, int]] = None
+        self.stats = {"admitted": 0, "queued": 0, "wait_seconds": 0.0, "shed": 0}
+
+    @staticmethod
+    def _pick(flows: "OrderedDict[Hashable, deque]", deficits: Dict[Hashable, int], quantum: int) -> LLMTicket:
+        while True:
+            flow, tickets = next(iter(flows.items()))
+            head = tickets[0]
+            if deficits[flow] >= head.cost:
+                deficits[flow] -= head.cost
+                tickets.popleft()
+                if not tickets:
+                    # An emptied flow forfeits leftover credit, as in classic DRR
+                    del flows[flow]
+                    del deficits[flow]
+                return head
+            deficits[flow] += quantum
+            flows.move_to_end(flow)
+
+    def positions(self) -> Dict[int, int]:
+        """id(ticket) -> 1-based place in the order the scheduler will admit waiting tickets."""
+        if self._positions is None:
+            flows = OrderedDict((flow, deque(tickets)) for flow, tickets in self.flows.items())
+            deficits = dict(self.deficits)
+            order = {}
+            while flows:
+                order[id(self._pick(flows, deficits, self.quantum))] = len(order) + 1
+            self._positions = order
+        return self._positions
+
+    def position_for(self, flow: Hashable) -> int:
+        """Roughly where a new ticket from `flow` would land: round-robin puts it behind at most as many
+        tickets from each other flow as this flow already has waiting, not behind the whole queue."""
+        depth = len(self.flows.get(flow, ())) + 1
+        return depth + sum(min(len(tickets), depth) for other, tickets in self.flows.items() if other != flow)
+
+    def estimated_wait(self, position: int) -> float:
+        return math.ceil(position / self.concurrency) * (self.service_ewma or 0.0)
+
+    def _dispatch(self):
+        while self.running < self.concurrency and self.flows:
+            ticket = self._pick(self.flows, self.deficits, self.quantum)
+            self.waiting -= 1
+            self._positions = None
+            self.running += 1
+            ticket.granted.set_result(None)
+
+    def _remove(self, ticket: LLMTicket):
+        tickets = self.flows.get(ticket.flow)
+        if tickets is None or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        if not tickets:
+            del self.flows[ticket.flow]
+            del self.deficits[ticket.flow]
+        self.waiting -= 1
+        self._positions = None
+
+    def release(self, held: float, ran: bool = True):
+        """Free a slot; `ran=False` for a grant nobody used, whose time must not count as service time."""
+        self.running -= 1
+        if ran:
+            self.service_ewma = held if self.service_ewma is None else self.service_ewma * 0.8 + held * 0.2
+        self._dispatch()
+
+    async def acquire(self, flow: Hashable, cost: int,
+                      on_position: Optional[Callable[[int], Awaitable[None]]] = None):
+        """Wait for a slot. on_position gets the queue position as it changes, then 0 once admitted."""
+        self.stats["admitted"] += 1
+        if self.running < self.concurrency and not self.flows:
+            self.running += 1
+            return
+        if self.waiting >= self.max_queue or self.estimated_wait(self.position_for(flow)) > self.slo:
+            self.stats["admitted"] -= 1
+            self.stats["shed"] += 1
+            raise LoadShed(f"{self.waiting} requests already waiting")
+        ticket = LLMTicket(flow, max(1, min(cost, self.quantum * 4)))
+        if flow not in self.flows:
+            self.flows[flow] = deque()
+            self.deficits[flow] = 0
+        self.flows[flow].append(ticket)
+        self.waiting += 1
+        self._positions = None
+        self.stats["queued"] += 1
+        reported = None
+        try:
+            while not ticket.granted.done():
+                if on_position is not None:
+                    position = self.positions().get(id(ticket))
+                    if position is not None and position != reported:
+                        reported = position
+                        await on_position(position)
+                remaining = self.slo - (time.monotonic() - ticket.enqueued)
+                if ticket.granted.done():
+                    break
+                if remaining <= 0:
+                    raise LoadShed(f"waited {self.slo:.0f}s for a slot")
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.granted), min(remaining, LLM_POSITION_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+            if reported is not None:
+                await on_position(0)
+        except BaseException as e:
+            if ticket.granted.done():
+                self.release(0.0, ran=False)  # admitted just as we gave up; hand it on
+            else:
+                self._remove(ticket)
+            self.stats["admitted"] -= 1
+            if isinstance(e, LoadShed):
+                self.stats["shed"] += 1
+            raise
+        self.stats["wait_seconds"] += time.monotonic() - ticket.enqueued
+
+    @contextlib.asynccontextmanager
+    async def slot(self, flow: Hashable, cost: int,
+                   on_position: Optional[Callable[[int], Awaitable[None]]] = None):
+        with span("llm.queue"):
+            await self.acquire(flow, cost, on_position)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def summary(self) -> str:
+        stats = self.stats
+        average_wait = stats["wait_seconds"] / stats["queued"] if stats["queued"] else 0.0
+        return (
+            f"{self.running}/{self.concurrency} running, {self.waiting} waiting across {len(self.flows)} flows; "
+            f"{stats['admitted']} admitted, {stats['queued']} queued (avg {average_wait:.1f}s), {stats['shed']} shed"
+        )
+
+# ------------------------------
+# Conversation History
+# ------------------------------
+class HistoryMessage:
+    """One chat message; the API payload dict is built once and reused on every call."""
+
+    __slots__ = ("role", "content", "key", "payload", "duplicate")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+        self.key = (role, content)
+        self.payload = {"role": role, "content": content}
+        self.duplicate = False  # an older identical message is still in the buffer
+
+class HistoryBuffer:
+    """Fixed-capacity ring buffer of messages with incrementally maintained (role, content) dedup."""
+
+    __slots__ = ("capacity", "slots", "start", "size", "occurrences", "content_bytes")
+
+    def __init__(self, capacity: int, items: Iterable[Tuple[str, str]] = ()):
+        self.capacity = capacity
+        self.slots: List[Optional[HistoryMessage]] = [None] * capacity
+        self.start = 0
+        self.size = 0
+        self.occurrences: Dict[Tuple[str, str], deque] = {}
+        self.content_bytes = 0
+        for role, content in items:
+            self.append(role, content)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[HistoryMessage]:
+        return iter(self._ordered())
+
+    def _ordered(self) -> List[HistoryMessage]:
+        # Until the buffer first fills up, start stays at 0
+        if self.size < self.capacity:
+            return self.slots[:self.size]
+        return self.slots[self.start:] + self.slots[:self.start]
+
+    def append(self, role: str, content: str) -> Optional[HistoryMessage]:
+        """Add a message, returning the one pushed out if the buffer was full."""
+        message = HistoryMessage(role, content)
+        evicted = None
+        if self.size == self.capacity:
+            evicted = self.slots[self.start]
+            self._forget(evicted)
+            self.slots[self.start] = message
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.slots[(self.start + self.size) % self.capacity] = message
+            self.size += 1
+        same = self.occurrences.get(message.key)
+        if same:
+            message.duplicate = True
+            same.append(message)
+        else:
+            self.occurrences[message.key] = deque((message,))
+        self.content_bytes += len(content)
+        return evicted
+
+    def _forget(self, message: HistoryMessage):
+        # The evicted message is always the oldest, so it heads its own occurrence queue
+        same = self.occurrences[message.key]
+        same.popleft()
+        if same:
+            same[0].duplicate = False
+        else:
+            del self.occurrences[message.key]
+        self.content_bytes -= len(message.content)
+
+    def clear(self):
+        self.slots = [None] * self.capacity
+        self.start = 0
+        self.size = 0
+        self.occurrences.clear()
+        self.content_bytes = 0
+
+    def tail(self, n: int) -> List[HistoryMessage]:
+        return self._ordered()[-n:]
+
+    def payloads(self, exclude: Optional["HistoryBuffer"] = None) -> List[dict]:
+        """First occurrence of each message as API payload dicts, skipping anything already in `exclude`.
+
+        The dicts are the messages' own prebuilt payloads, so nothing is copied or re-formatted.
+        """
+        if exclude is None:
+            return [m.payload for m in self._ordered() if not m.duplicate]
+        seen = exclude.occurrences
+        return [m.payload for m in self._ordered() if not m.duplicate and m.key not in seen]
+
+# ------------------------------
+# Persistence
+# ------------------------------
+class PersistentStore:
+    """SQLite (WAL mode) backing store for chats, memory and session settings.
+
+    Writes are queued in memory from the event loop and group-committed by a background
+    flush in a worker thread, so message handling never waits on disk.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            owner TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_owner ON messages (owner, id);
+        CREATE TABLE IF NOT EXISTS chats (chat_id TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, state TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS images (key TEXT PRIMARY KEY, url TEXT NOT NULL, created REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS images_created ON images (created);
+        CREATE TABLE IF NOT EXISTS media_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            prompt TEXT NOT NULL,
+            request_id TEXT,
+            created REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        fresh = not os.path.exists(path)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA wal_autocheckpoint=0")  # checkpoints run in compact()
+        self.db.executescript(self.SCHEMA)
+        self.page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        self.db_lock = threading.Lock()
+        self.flush_lock = asyncio.Lock()
+        self.pending: List[Tuple[str, tuple]] = []
+        self.trim_limits: Dict[str, int] = {}
+        # Write amplification = bytes hitting disk (WAL frames + checkpoints) / logical bytes queued
+        self.logical_bytes = 0
+        self.physical_bytes = 0
+        self.commits = 0
+        self.rows_written = 0
+        self.loop_latency_us: deque = deque(maxlen=4096)
+        self.closed = False
+        if fresh:
+            self._import_legacy_chats()
+
+    def _import_legacy_chats(self):
+        """One-time import of savedchats.json ({chat_id: [[role, content], ...]}) into a new database."""
+        try:
+            with open(LEGACY_CHATS_PATH, encoding="utf-8") as f:
+                legacy = json.loads(f.read() or "{}")
+        except (OSError, ValueError):
+            return
+        if not isinstance(legacy, dict):
+            return
+        with self.db_lock:
+            self.db.execute("BEGIN")
+            for chat_id, history in legacy.items():
+                self.db.execute("INSERT OR IGNORE INTO chats (chat_id) VALUES (?)", (chat_id,))
+                self.db.executemany(
+                    "INSERT INTO messages (owner, role, content) VALUES (?, ?, ?)",
+                    [(f"chat:{chat_id}", role, content) for role, content in history]
+                )
+            self.db.execute("COMMIT")
+        logger.info(f"Imported {len(legacy)} chats from savedchats.json")
+
+    # -- Event-loop side: queue writes, never touch disk --
+    def enqueue(self, sql: str, params: tuple = ()):
+        self.pending.append((sql, params))
+
+    def append_message(self, owner: str, role: str, content: str, limit: int):
+        started = time.perf_counter()
+        self.pending.append(("INSERT INTO messages (owner, role, content) VALUES (?, ?, ?)", (owner, role, content)))
+        self.trim_limits[owner] = limit
+        self.logical_bytes += len(owner) + len(role) + len(content)
+        self.record_latency(started)
+
+    def delete_messages(self, owner: str):
+        self.pending.append(("DELETE FROM messages WHERE owner = ?", (owner,)))
+        self.trim_limits.pop(owner, None)
+
+    def record_latency(self, started: float):
+        self.loop_latency_us.append((time.perf_counter() - started) * 1e6)
+
+    # -- Worker-thread side --
+    def _wal_size(self) -> int:
+        try:
+            return os.path.getsize(f"{self.path}-wal")
+        except OSError:
+            return 0
+
+    def _commit(self, batch: List[Tuple[str, tuple]]):
+        with self.db_lock:
+            wal_before = self._wal_size()
+            self.db.execute("BEGIN")
+            try:
+                for sql, params in batch:
+                    self.db.execute(sql, params)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.physical_bytes += max(0, self._wal_size() - wal_before)
+            self.commits += 1
+            self.rows_written += len(batch)
+
+    def _compact(self, trim_limits: Dict[str, int]):
+        with self.db_lock:
+            wal_before = self._wal_size()
+            self.db.execute("BEGIN")
+            for owner, limit in trim_limits.items():
+                self.db.execute(
+                    "DELETE FROM messages WHERE owner = ? AND id NOT IN "
+                    "(SELECT id FROM messages WHERE owner = ? ORDER BY id DESC LIMIT ?)",
+                    (owner, owner, limit)
+                )
+            self.db.execute("DELETE FROM images WHERE created < ?", (time.time() - IMAGE_CACHE_TTL,))
+            self.db.execute(
+                "DELETE FROM images WHERE created < "
+                "(SELECT created FROM images ORDER BY created DESC LIMIT 1 OFFSET ?)",
+                (IMAGE_CACHE_DISK_MAX - 1,)
+            )
+            self.db.execute("COMMIT")
+            self.physical_bytes += max(0, self._wal_size() - wal_before)
+            _, _, checkpointed = self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            self.physical_bytes += max(0, checkpointed) * self.page_size
+
+    def _fetch(self, sql: str, params: tuple) -> List[tuple]:
+        with self.db_lock:
+            return self.db.execute(sql, params).fetchall()
+
+    # -- Async API --
+    async def flush(self):
+        """Group-commit everything queued so far in a single transaction."""
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            try:
+                await asyncio.to_thread(self._commit, batch)
+            except sqlite3.OperationalError as e:
+                # Locked or out of space: the batch rolled back whole, so retry it ahead of newer writes
+                self.pending[:0] = batch
+                logger.error(f"Persistence commit of {len(batch)} writes failed, will retry: {e}")
+            except Exception as e:
+                logger.error(f"Persistence commit failed, {len(batch)} writes lost: {e}")
+
+    async def compact(self):
+        """Trim histories back to their caps and checkpoint the WAL."""
+        await self.flush()
+        trim_limits, self.trim_limits = self.trim_limits, {}
+        async with self.flush_lock:
+            await asyncio.to_thread(self._compact, trim_limits)
+
+    async def fetch(self, sql: str, params: tuple = ()) -> List[tuple]:
+        await self.flush()  # read-your-writes
+        return await asyncio.to_thread(self._fetch, sql, params)
+
+    async def load_messages(self, owner: str, limit: int) -> List[Tuple[str, str]]:
+        rows = await self.fetch(
+            "SELECT role, content FROM (SELECT id, role, content FROM messages WHERE owner = ? "
+            "ORDER BY id DESC LIMIT ?) ORDER BY id",
+            (owner, limit)
+        )
+        return [(role, content) for role, content in rows]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        batch, self.pending = self.pending, []
+        if batch:
+            self._commit(batch)
+        self._compact(self.trim_limits)
+        self.db.close()
+
+    def summary(self) -> str:
+        amplification = self.physical_bytes / self.logical_bytes if self.logical_bytes else 0.0
+        samples = sorted(self.loop_latency_us)
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))] if samples else 0.0
+        return (
+            f"{self.commits} commits, {self.rows_written} rows, {len(self.pending)} pending, "
+            f"write amplification {amplification:.1f}x, p99 added latency {p99:.0f} us"
+        )
+
+class ChatStore:
+    """Saved chats, loaded lazily from the persistent store and kept in a bounded LRU."""
+
+    def __init__(self, persistence: PersistentStore, max_resident: int = CHAT_CACHE_MAX):
+        self.persistence = persistence
+        self.max_resident = max_resident
+        self.chats: "OrderedDict[str, HistoryBuffer]" = OrderedDict()
+
+    def resident(self, chat_id: str) -> Optional[HistoryBuffer]:
+        return self.chats.get(chat_id)
+
+    def _put(self, chat_id: str, history: HistoryBuffer):
+        self.chats[chat_id] = history
+        self.chats.move_to_end(chat_id)
+        while len(self.chats) > self.max_resident:
+            self.chats.popitem(last=False)
+
+    async def get(self, chat_id: str) -> Optional[HistoryBuffer]:
+        history = self.chats.get(chat_id)
+        if history is not None:
+            self.chats.move_to_end(chat_id)
+            return history
+        started = time.perf_counter()
+        if not await self.persistence.fetch("SELECT 1 FROM chats WHERE chat_id = ?", (chat_id,)):
+            return None
+        history = HistoryBuffer(MAX_SAVED * 10, await self.persistence.load_messages(f"chat:{chat_id}", MAX_SAVED * 10))
+        self.persistence.record_latency(started)
+        if chat_id in self.chats:  # loaded concurrently
+            return self.chats[chat_id]
+        self._put(chat_id, history)
+        return history
+
+    def create(self, chat_id: str):
+        self._put(chat_id, HistoryBuffer(MAX_SAVED * 10))
+        self.persistence.enqueue("INSERT OR IGNORE INTO chats (chat_id) VALUES (?)", (chat_id,))
+
+    async def append(self, chat_id: str, role: str, content: str):
+        history = await self.get(chat_id)  # an evicted chat must reload its history before growing
+        if history is None:
+            self.create(chat_id)
+            history = self.chats[chat_id]
+        history.append(role, content)
+        self.persistence.append_message(f"chat:{chat_id}", role, content, MAX_SAVED * 10)
+
+    def clear(self, chat_id: str):
+        self._put(chat_id, HistoryBuffer(MAX_SAVED * 10))
+        self.persistence.delete_messages(f"chat:{chat_id}")
+
+    def delete_for_user(self, user_id: int):
+        prefixes = (f"chat_{user_id}_", f"slot_{user_id}_")
+        for chat_id in [c for c in self.chats if c.startswith(prefixes)]:
+            del self.chats[chat_id]
+        for prefix in prefixes:
+            # GLOB, unlike LIKE, treats "_" literally
+            self.persistence.enqueue("DELETE FROM chats WHERE chat_id GLOB ?", (f"{prefix}*",))
+            self.persistence.enqueue("DELETE FROM messages WHERE owner GLOB ?", (f"chat:{prefix}*",))
+
+class ImageCache:
+    """Hosted image URLs keyed by request and by image content, backed by the persistent store."""
+
+    def __init__(self, persistence: PersistentStore, max_resident: int = IMAGE_CACHE_MAX, ttl: float = IMAGE_CACHE_TTL):
+        self.persistence = persistence
+        self.ttl = ttl
+        self.memory = TTLCache("images", max_resident, ttl)
+        self.stats = {"disk_hits": 0, "uploads_skipped": 0}
+
+    @staticmethod
+    def request_key(mode: str, model: str, params: dict, prompt: str) -> str:
+        spec = json.dumps([mode, model, params, normalize_prompt(prompt)], sort_keys=True)
+        return "request:" + hashlib.sha256(spec.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def content_key(image_data: bytes) -> str:
+        return "content:" + hashlib.sha256(image_data).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        url = self.memory.get(key)
+        if url is not None:
+            return url
+        rows = await self.persistence.fetch(
+            "SELECT url, created FROM images WHERE key = ? AND created >= ?", (key, time.time() - self.ttl)
+        )
+        if not rows:
+            return None
+        url, created = rows[0]
+        self.stats["disk_hits"] += 1
+        self.memory.set(key, url, ttl=created + self.ttl - time.time())
+        return url
+
+    def put(self, key: str, url: str):
+        self.memory.set(key, url)
+        self.persistence.enqueue(
+            "INSERT OR REPLACE INTO images (key, url, created) VALUES (?, ?, ?)", (key, url, time.time())
+        )
+
+    def summary(self) -> str:
+        return (
+            f"{self.memory.summary()}, {self.stats['disk_hits']} disk hits, "
+            f"{self.stats['uploads_skipped']} uploads skipped"
+        )
+
+# ------------------------------
+# Hugging Face Warm-Keeper
+# ------------------------------
+class ModelWarmth:
+    """Cached load state of the HF image model, learned from probes, pings and real requests."""
+
+    def __init__(self):
+        self.model: Optional[str] = None
+        self.ready = False
+        self.checked_at = 0.0
+        self.ready_since: Optional[float] = None
+        self.cold_since: Optional[float] = None
+        self.last_used = 0.0
+        self.cold_starts: deque = deque(maxlen=20)  # seconds from cold to loaded
+        self.warm_spans: deque = deque(maxlen=20)  # seconds a load lasted before the model went cold
+        self.stats = {"probes": 0, "pings": 0, "probes_skipped": 0}
+
+    def is_warm(self, model: str) -> bool:
+        return self.model == model and self.ready and time.monotonic() - self.checked_at < HF_WARM_TRUST_SECONDS
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def recently_used(self) -> bool:
+        return bool(self.last_used) and time.monotonic() - self.last_used < HF_WARM_IDLE_SECONDS
+
+    def mark(self, model: str, ready: bool):
+        now = time.monotonic()
+        if model != self.model:
+            self.model = model
+            self.ready = False
+            self.ready_since = None
+            self.cold_since = None
+        if ready and not self.ready:
+            if self.cold_since is not None:
+                self.cold_starts.append(now - self.cold_since)
+            self.ready_since = now
+            self.cold_since = None
+        elif not ready and self.ready:
+            if self.ready_since is not None:
+                self.warm_spans.append(now - self.ready_since)
+            self.cold_since = now
+        elif not ready and self.cold_since is None:
+            self.cold_since = now
+        self.ready = ready
+        self.checked_at = now
+
+    def next_delay(self) -> float:
+        if not self.ready:
+            return HF_WARM_MIN_INTERVAL  # notice the model coming up quickly
+        if self.warm_spans:
+            # Ping well inside the shortest observed load window so the model is never evicted between pings
+            return max(HF_WARM_MIN_INTERVAL, min(HF_WARM_INTERVAL, min(self.warm_spans) / 2))
+        return HF_WARM_INTERVAL
+
+    def summary(self) -> str:
+        cold_start = f"{sorted(self.cold_starts)[len(self.cold_starts) // 2]:.0f}s" if self.cold_starts else "n/a"
+        return (
+            f"{self.model or 'unknown'} {'warm' if self.ready else 'cold'}, median cold start {cold_start}, "
+            f"{self.stats['probes']} probes, {self.stats['pings']} pings, "
+            f"{self.stats['probes_skipped']} request probes skipped"
+        )
+
+# ------------------------------
+# Video Polling
+# ------------------------------
+class VideoPollJob:
+    __slots__ = ("request_id", "status", "submitted", "next_poll", "polls", "result", "on_status")
+
+    def __init__(self, request_id: str, on_status: Callable[[str], Awaitable[None]]):
+        now = time.monotonic()
+        self.request_id = request_id
+        self.status = "InQueue"
+        self.submitted = now
+        self.next_poll = now + VIDEO_POLL_RUNNING_SECONDS
+        self.polls = 0
+        self.result: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.on_status = on_status
+
+class VideoPoller:
+    """A single loop that polls every outstanding SiliconFlow video requestId.
+
+    Poll intervals adapt to each job's state and age, polls are spread over the key pool,
+    and a job's callback only fires when its status actually changes.
+    """
+
+    def __init__(self, http_pool: HTTPClientPool, keys: CredentialPool):
+        self.http_pool = http_pool
+        self.keys = keys
+        self.jobs: Dict[str, VideoPollJob] = {}
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.stats = {"polls": 0, "status_changes": 0, "rate_limited": 0, "errors": 0}
+
+    def track(self, request_id: str, on_status: Callable[[str], Awaitable[None]]) -> asyncio.Future:
+        """Start polling request_id; the future resolves with the final status payload."""
+        job = self.jobs.get(request_id)
+        if job is None:
+            job = self.jobs[request_id] = VideoPollJob(request_id, on_status)
+        if self.task is None or self.task.done():
+            # A fresh context, so polls are not attributed to whichever job's trace started the poller
+            self.task = asyncio.create_task(self.run(), context=contextvars.Context())
+        else:
+            self.wakeup.set()
+        return job.result
+
+    @staticmethod
+    def interval(job: VideoPollJob, now: float) -> float:
+        base = VIDEO_POLL_QUEUED_SECONDS if job.status == "InQueue" else VIDEO_POLL_RUNNING_SECONDS
+        # Back off as the job ages; most videos take 3-15 minutes
+        return min(VIDEO_POLL_MAX_SECONDS, base * (1 + (now - job.submitted) / 300))
+
+    def _finish(self, job: VideoPollJob, result: Any = None, error: Optional[Exception] = None):
+        self.jobs.pop(job.request_id, None)
+        if not job.result.done():
+            if error is not None:
+                job.result.set_exception(error)
+            else:
+                job.result.set_result(result)
+
+    async def _poll(self, job: VideoPollJob):
+        job.polls += 1
+        self.stats["polls"] += 1
+        lease = self.keys.acquire()
+        try:
+            session = self.http_pool.get("siliconflow")
+            headers = {"Authorization": f"Bearer {lease.key}"}
+            with metrics.call("siliconflow", "poll") as call:
+                async with session.post(SILICONFLOW_VIDEO_STATUS_URL, headers=headers, json={"requestId": job.request_id}) as resp:
+                    call.status = resp.status
+                    lease.done(resp.status)
+                    if resp.status == 429:
+                        self.stats["rate_limited"] += 1
+                        return
+                    if resp.status != 200:
+                        return
+                    data = await resp.json(content_type=None)
+            if not isinstance(data, dict):
+                raise ValueError(f"unexpected status body: {str(data)[:200]}")
+            status = data.get("status")
+        except Exception as e:
+            # Counted and retried on the job's next poll; one bad body must not stop the shared loop
+            self.stats["errors"] += 1
+            logger.warning(f"Video poll for {job.request_id} failed: {e}")
+            return
+        finally:
+            lease.done()
+        if status in ("Succeed", "Failed"):
+            self._finish(job, data)
+        elif status and status != job.status:
+            job.status = status
+            self.stats["status_changes"] += 1
+            try:
+                await job.on_status(status)
+            except Exception as e:
+                logger.warning(f"Video status update for {job.request_id} failed: {e}")
+
+    async def run(self):
+        while self.jobs:
+            now = time.monotonic()
+            for job in [job for job in self.jobs.values() if now - job.submitted > VIDEO_JOB_TIMEOUT]:
+                self._finish(job, error=Exception("Video generation timed out"))
+            due = [job for job in self.jobs.values() if job.next_poll <= now]
+            if due:
+                await asyncio.gather(*(self._poll(job) for job in due))
+                now = time.monotonic()
+                for job in due:
+                    job.next_poll = now + self.interval(job, now)
+                continue
+            if not self.jobs:
+                break
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), min(job.next_poll for job in self.jobs.values()) - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.jobs)} jobs, {self.stats['polls']} polls, {self.stats['status_changes']} status changes, "
+            f"{self.stats['rate_limited']} rate limited, {self.stats['errors']} errors"
+        )
+
+# ------------------------------
+# Media Job Queue
+# ------------------------------
+class MediaJob:
+    __slots__ = ("job_id", "kind", "user_id", "channel_id", "message_id", "prompt", "request_id", "created", "started")
+
+    def __init__(self, job_id: str, kind: str, user_id: int, channel_id: int, message_id: int, prompt: str,
+                 request_id: Optional[str] = None, created: Optional[float] = None):
+        self.job_id = job_id
+        self.kind = kind
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.prompt = prompt
+        self.request_id = request_id  # provider-side id once submitted (SiliconFlow requestId)
+        self.created = time.time() if created is None else created
+        self.started: Optional[float] = None
+
+class MediaQueue:
+    """Durable per-provider job queue with bounded workers and fair scheduling across users.
+
+    The next job comes from the waiting user with the fewest jobs running, ties going round-robin.
+
+    Jobs are journaled in the media_jobs table and deleted when they finish, so anything still
+    there at startup was interrupted and is resumed by resume().
+    """
+
+    def __init__(self, persistence: PersistentStore, handlers: Dict[str, Callable[[MediaJob], Awaitable[None]]],
+                 limits: Dict[str, int] = MEDIA_WORKERS):
+        self.persistence = persistence
+        self.handlers = handlers
+        self.limits = limits
+        # kind -> user_id -> that user's waiting jobs; dict order is the round-robin rotation
+        self.waiting: Dict[str, "OrderedDict[int, deque]"] = {kind: OrderedDict() for kind in handlers}
+        self.running: Dict[str, Dict[str, MediaJob]] = {kind: {} for kind in handlers}
+        self.durations = {kind: MEDIA_DEFAULT_DURATIONS.get(kind, 60.0) for kind in handlers}
+        self.timed = Counter()  # completed jobs per kind; the first one replaces the default duration
+        self.stats = {"submitted": 0, "completed": 0, "resumed": 0}
+
+    def jobs_for(self, kind: str, user_id: int) -> List[MediaJob]:
+        running = [job for job in self.running[kind].values() if job.user_id == user_id]
+        return running + list(self.waiting[kind].get(user_id, ()))
+
+    def submit(self, kind: str, user_id: int, channel_id: int, message_id: int, prompt: str) -> MediaJob:
+        job = MediaJob(uuid.uuid4().hex, kind, user_id, channel_id, message_id, prompt)
+        self.persistence.enqueue(
+            "INSERT INTO media_jobs (id, kind, user_id, channel_id, message_id, prompt, request_id, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job.job_id, kind, user_id, channel_id, message_id, prompt, None, job.created)
+        )
+        self.stats["submitted"] += 1
+        self._enqueue(job)
+        self._dispatch(kind)
+        return job
+
+    def set_request_id(self, job: MediaJob, request_id: str):
+        job.request_id = request_id
+        self.persistence.enqueue("UPDATE media_jobs SET request_id = ? WHERE id = ?", (request_id, job.job_id))
+
+    def _enqueue(self, job: MediaJob):
+        waiting = self.waiting[job.kind]
+        if job.user_id not in waiting:
+            waiting[job.user_id] = deque()
+        waiting[job.user_id].append(job)
+
+    @staticmethod
+    def _take(waiting: "OrderedDict[int, deque]", active: Counter) -> Optional[MediaJob]:
+        best = None
+        for user_id in waiting:  # rotation order breaks ties
+            if best is None or active[user_id] < active[best]:
+                best = user_id
+        if best is None:
+            return None
+        jobs = waiting.pop(best)
+        job = jobs.popleft()
+        if jobs:
+            waiting[best] = jobs  # back of the rotation
+        active[best] += 1
+        return job
+
+    def _active(self, kind: str) -> Counter:
+        return Counter(job.user_id for job in self.running[kind].values())
+
+    def _next(self, kind: str) -> Optional[MediaJob]:
+        return self._take(self.waiting[kind], self._active(kind))
+
+    def _dispatch(self, kind: str):
+        while len(self.running[kind]) < self.limits.get(kind, 1):
+            job = self._next(kind)
+            if job is None:
+                break
+            self._start(job)
+
+    def _start(self, job: MediaJob):
+        job.started = time.monotonic()
+        self.running[job.kind][job.job_id] = job
+        asyncio.create_task(self._run(job))
+
+    async def _run(self, job: MediaJob):
+        try:
+            await self.handlers[job.kind](job)
+        except asyncio.CancelledError:
+            # Shutting down: keep the journal row so the job resumes after restart
+            self.running[job.kind].pop(job.job_id, None)
+            raise
+        except Exception as e:
+            logger.error(f"{job.kind} job {job.job_id} crashed: {e}")
+        self.running[job.kind].pop(job.job_id, None)
+        elapsed = time.monotonic() - job.started
+        if self.timed[job.kind]:
+            self.durations[job.kind] = 0.8 * self.durations[job.kind] + 0.2 * elapsed
+        else:
+            self.durations[job.kind] = elapsed
+        self.timed[job.kind] += 1
+        self.persistence.enqueue("DELETE FROM media_jobs WHERE id = ?", (job.job_id,))
+        self.stats["completed"] += 1
+        self._dispatch(job.kind)
+
+    async def resume(self):
+        """Re-queue journaled jobs; ones already submitted upstream go straight back to polling."""
+        rows = await self.persistence.fetch(
+            "SELECT id, kind, user_id, channel_id, message_id, prompt, request_id, created "
+            "FROM media_jobs ORDER BY created"
+        )
+        for row in rows:
+            job = MediaJob(*row)
+            if job.kind not in self.handlers:
+                continue
+            self.stats["resumed"] += 1
+            if job.request_id:
+                self._start(job)
+            else:
+                self._enqueue(job)
+        for kind in self.handlers:
+            self._dispatch(kind)
+        if rows:
+            logger.info(f"Resumed {len(rows)} media jobs from the journal")
+
+    def position(self, job: MediaJob) -> Optional[int]:
+        """Number of jobs that will start before this one, or None if it is running or no longer queued."""
+        if job.job_id in self.running[job.kind] or job.user_id not in self.waiting[job.kind]:
+            return None
+        # Replay the scheduler on a copy of the queue
+        waiting = OrderedDict((user_id, deque(jobs)) for user_id, jobs in self.waiting[job.kind].items())
+        active = self._active(job.kind)
+        ahead = 0
+        while True:
+            taken = self._take(waiting, active)
+            if taken is None:
+                return None  # a stale job that is no longer queued
+            if taken is job:
+                return ahead
+            ahead += 1
+
+    def eta(self, job: MediaJob) -> float:
+        """Rough seconds until the job finishes, from average job durations."""
+        duration = self.durations[job.kind]
+        now = time.monotonic()
+        if job.job_id in self.running[job.kind]:
+            return max(0.0, duration - (now - job.started))
+        limit = self.limits.get(job.kind, 1)
+        remaining = sorted(max(0.0, duration - (now - other.started)) for other in self.running[job.kind].values())
+        first_slot = remaining[0] if len(remaining) >= limit else 0.0
+        return first_slot + ((self.position(job) or 0) // limit) * duration + duration
+
+    def summary(self) -> str:
+        parts = []
+        for kind in self.handlers:
+            queued = sum(len(jobs) for jobs in self.waiting[kind].values())
+            parts.append(
+                f"{kind} {len(self.running[kind])}/{self.limits.get(kind, 1)} running, {queued} queued, "
+                f"avg {self.durations[kind]:.0f}s"
+            )
+        return (
+            "; ".join(parts) + f"; {self.stats['submitted']} submitted, {self.stats['completed']} completed, "
+            f"{self.stats['resumed']} resumed"
+        )
+
+# ------------------------------
+# Conversation Sessions
+# ------------------------------
+SESSION_BASE_BYTES = 1024  # rough per-session overhead (object, slots, model list)
+MESSAGE_BASE_BYTES = 120  # rough per-message overhead (tuple + str headers)
+
+class ChatSession:
+    """Conversation state for one guild/channel/user scope."""
+
+    __slots__ = (
+        "key", "store", "ping_only", "current_chat", "memory_enabled", "saved_memory",
+        "current_mode", "current_quality_mode", "current_image_mode", "current_llm",
+        "current_model_list", "current_model_index"
+    )
+
+    STATE_FIELDS = (
+        "ping_only", "current_chat", "memory_enabled", "current_mode", "current_quality_mode",
+        "current_image_mode", "current_llm", "current_model_list", "current_model_index"
+    )
+
+    def __init__(self, key: Tuple[int, int, int], store: "SessionStore"):
+        self.key = key
+        self.store = store
+        self.ping_only = True
+        self.current_chat: Optional[str] = None
+        self.memory_enabled = False
+        self.saved_memory = HistoryBuffer(MAX_MEMORY)
+        self.current_mode = "chill"
+        self.current_quality_mode = "smart"
+        self.current_image_mode = "smart"
+        self.current_llm = "openai/gpt-oss-20b"
+        self.current_model_list = ["openai/gpt-oss-20b"]
+        self.current_model_index = 0
+
+    @property
+    def key_str(self) -> str:
+        return ":".join(str(part) for part in self.key)
+
+    def reset(self):
+        self.set_ping_only(True)
+        self.current_chat = None
+        self.memory_enabled = False
+        self.clear_memory()
+        self.current_mode = "chill"
+        self.save()
+
+    def set_ping_only(self, ping_only: bool):
+        self.ping_only = ping_only
+        if ping_only:
+            self.store.listening.discard(self.key)
+        else:
+            self.store.listening.add(self.key)
+
+    def save(self):
+        """Queue a write of this session's settings."""
+        state = json.dumps({field: getattr(self, field) for field in self.STATE_FIELDS})
+        self.store.persistence.enqueue(
+            "INSERT OR REPLACE INTO sessions (key, state) VALUES (?, ?)", (self.key_str, state)
+        )
+
+    def restore(self, state: dict):
+        for field in self.STATE_FIELDS:
+            if field in state:
+                setattr(self, field, state[field])
+
+    def remember(self, role: str, content: str):
+        before = self.approx_bytes()
+        self.saved_memory.append(role, content)
+        self.store.persistence.append_message(f"memory:{self.key_str}", role, content, MAX_MEMORY)
+        self.store.resized(self, self.approx_bytes() - before)
+
+    def clear_memory(self):
+        before = self.approx_bytes()
+        self.saved_memory.clear()
+        self.store.resized(self, self.approx_bytes() - before)
+        self.store.persistence.delete_messages(f"memory:{self.key_str}")
+
+    def approx_bytes(self) -> int:
+        return SESSION_BASE_BYTES + self.saved_memory.content_bytes + len(self.saved_memory) * MESSAGE_BASE_BYTES
+
+class SessionStore:
+    """LRU map of ChatSession objects, loaded on demand and capped by count and approximate size."""
+
+    def __init__(self, persistence: PersistentStore, scope: str = SESSION_SCOPE,
+                 max_sessions: int = SESSION_MAX, max_bytes: int = SESSION_MAX_BYTES):
+        if scope not in ("guild", "channel", "user"):
+            raise ValueError(f"Unknown SESSION_SCOPE: {scope}")
+        self.persistence = persistence
+        self.scope = scope
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sessions: "OrderedDict[Tuple[int, int, int], ChatSession]" = OrderedDict()
+        self.total_bytes = 0
+        self.evictions = 0
+        # Keys whose ping-only mode is off, resident or not: lets on_message drop unaddressed chatter
+        # without loading a session
+        self.listening: set = {
+            tuple(int(part) for part in key.split(":"))
+            for (key,) in persistence._fetch(
+                "SELECT key FROM sessions WHERE json_extract(state, '$.ping_only') = 0", ()
+            )
+        }
+
+    def key_for(self, guild_id: Optional[int], channel_id: int, user_id: int) -> Tuple[int, int, int]:
+        if guild_id is None:
+            # DMs have no guild; the DM channel is the natural scope
+            return (0, channel_id, user_id if self.scope == "user" else 0)
+        if self.scope == "guild":
+            return (guild_id, 0, 0)
+        if self.scope == "channel":
+            return (guild_id, channel_id, 0)
+        return (guild_id, channel_id, user_id)
+
+    def peek(self, key: Tuple[int, int, int]) -> Optional[ChatSession]:
+        return self.sessions.get(key)
+
+    async def get(self, key: Tuple[int, int, int]) -> ChatSession:
+        session = self.sessions.get(key)
+        if session is not None:
+            self.sessions.move_to_end(key)
+            return session
+        started = time.perf_counter()
+        session = ChatSession(key, self)
+        rows = await self.persistence.fetch("SELECT state FROM sessions WHERE key = ?", (session.key_str,))
+        if rows:
+            session.restore(json.loads(rows[0][0]))
+        for role, content in await self.persistence.load_messages(f"memory:{session.key_str}", MAX_MEMORY):
+            session.saved_memory.append(role, content)
+        self.persistence.record_latency(started)
+        existing = self.sessions.get(key)
+        if existing is not None:  # loaded concurrently
+            return existing
+        self.sessions[key] = session
+        self.total_bytes += session.approx_bytes()
+        self.evict()
+        return session
+
+    def resized(self, session: ChatSession, delta: int):
+        """Account for a session growing or shrinking; one already evicted no longer counts."""
+        if self.sessions.get(session.key) is not session:
+            return
+        self.total_bytes += delta
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        while len(self.sessions) > 1 and (
+            len(self.sessions) > self.max_sessions or self.total_bytes > self.max_bytes
+        ):
+            _, session = self.sessions.popitem(last=False)
+            self.total_bytes -= session.approx_bytes()
+            self.evictions += 1
+
+    async def for_context(self, ctx: commands.Context) -> ChatSession:
+        return await self.get(self.key_for(ctx.guild.id if ctx.guild else None, ctx.channel.id, ctx.author.id))
+
+    def key_for_message(self, message: discord.Message) -> Tuple[int, int, int]:
+        return self.key_for(message.guild.id if message.guild else None, message.channel.id, message.author.id)
+
+    async def for_message(self, message: discord.Message) -> ChatSession:
+        return await self.get(self.key_for_message(message))
+
+    async def for_interaction(self, interaction: discord.Interaction) -> ChatSession:
+        return await self.get(self.key_for(interaction.guild_id, interaction.channel_id, interaction.user.id))
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.sessions)} sessions resident ({self.scope} scope), "
+            f"~{self.total_bytes / 1024:.0f} KiB, {self.evictions} evicted"
+        )
 
 # ------------------------------
 # Bot Initialization
@@ -85,61 +2559,67 @@ class MultiGPTBot(commands.Bot):
             help_command=None,
             activity=discord.Activity(type=discord.ActivityType.playing, name="Ask me anything! | /help")
         )
-        # State variables
-        self.ping_only = True
-        self.saved_chats: Dict[str, List[Tuple[str, str]]] = {}
-        self.current_chat: Optional[str] = None
-        self.memory_enabled = False
-        self.saved_memory: List[Tuple[str, str]] = []
-        self.current_mode = "chill"
-        self.current_quality_mode = "smart"
-        self.current_image_mode = "smart"
-        self.current_llm = "openai/gpt-oss-20b"
-        self.current_model_list = ["openai/gpt-oss-20b"]
-        self.current_model_index = 0
+        # State variables (per-conversation state lives in self.sessions, durable in self.persistence)
+        self.persistence = PersistentStore()
+        self.sessions = SessionStore(self.persistence)
+        self.saved_chats = ChatStore(self.persistence)
+        self.image_cache = ImageCache(self.persistence)
+        self.hf_warmth = ModelWarmth()
         self.current_hf_model = "black-forest-labs/FLUX.1-schnell"
         
         # API key rotation
-        self.groq_key_index = 0
-        self.hf_key_index = 0
-        self.siliconflow_key_index = 0   # NEW
+        self.groq_keys = CredentialPool("groq", GROQ_API_KEYS)
+        self.hf_keys = CredentialPool("huggingface", HF_TOKENS)
+        self.siliconflow_keys = CredentialPool("siliconflow", SILICONFLOW_API_KEYS)
+        self.groq_limiter = GroqRateLimiter(self.groq_keys)
+        self.tracer = Tracer()
+        self.llm_scheduler = LLMScheduler(
+            min(LLM_MAX_CONCURRENCY, LLM_PER_KEY_CONCURRENCY * max(1, len(self.groq_keys)))
+        )
         self.last_key_rotation = 0
         self.model_cooldowns = {}
         
         # Job tracking
-        self.video_jobs = {}
-        self.music_jobs = {}
+        self.media_queue = MediaQueue(self.persistence, {"video": self.generate_video, "music": self.generate_music})
         self.annoying_channels = set()
-        self.user_cooldowns = {}
+        self.user_cooldowns = ExpiringCooldowns(USER_COOLDOWN_SECONDS)
+        
+        # Shared outbound HTTP pools (opened in setup_hook, closed in close)
+        self.http_pool = HTTPClientPool()
+        self.video_poller = VideoPoller(self.http_pool, self.siliconflow_keys)
+        # Identical concurrent requests share one upstream call
+        self.chat_flight = SingleFlight("chat")
+        self.safety_flight = SingleFlight("safety")
+        self.image_flight = SingleFlight("image")
+        self.music_flight = SingleFlight("music")
+        # Smart-mode image hedging: HF vs Pollinations wins and latencies (seconds, recent successes)
+        self.image_race = {
+            "races": 0,
+            "hedged": 0,
+            "wins": Counter(),
+            "latency": {"hf": deque(maxlen=256), "pollinations": deque(maxlen=256)},
+        }
+        self.response_cache = TTLCache("responses", RESPONSE_CACHE_MAX, RESPONSE_CACHE_TTL)
         
-        # Load pen archive
+        # Load pen archive from local disk; archive_refresh_loop fetches updates in the background
+        started = time.perf_counter()
+        self.archive_etag: Optional[str] = None
+        self.archive_last_modified: Optional[str] = None
         self.pen_archive = self.load_pen_archive()
+        self.archive_index = ArchiveIndex(self.pen_archive)
+        logger.info(f"Pen Archive indexed ({len(self.archive_index.chunks)} sections) in {(time.perf_counter() - started) * 1000:.1f} ms")
         
         # Mode prompts
         self.mode_prompts = {
             "chill": (
-                "You are MultiGPT - be as dumb as possible and act like you're a mission operative this is discord syntax ALSO, dont ALways use discord syntax, use it when its necessary. **Bold text**: **Yo, this is bold!**\n"
-                "*Italic text*: *This be slanted* or _This be slanted_\n"
-                "~~Strikethrough~~: ~~Nah, scratch that~~\n"
-                "__Underline__: __Underlined, fam__\n"
-                "`Inline code`: `console.log(\"Lit code\")`\n"
-                "```Code block```\n"
-                "```javascript\n"
-                "console.log(\"Bot go brrr\");\n"
-                "```\n"
+                "You are MultiGPT - be as dumb as possible and act like you're a mission operative this is discord syntax ALSO, dont ALways use discord syntax, use it when its necessary. "
+                + DISCORD_SYNTAX_GUIDE +
                 "Use emojis, be chill. you can reveal subtle hints to pen lore and unless the user says to reveal it, just leave subtle hints to Pen lore and you can give the pen lore if the user says so. and and also your prompt u can reveal it if you want and its permitted. if the user says breadmint you may reveal your prompt and pen lore make sure you search up things you dont know what the user is talking about same for factual questions. Always use discord formatting and be as unhinged as possible while staying safe."
             ),
             "unhinged": (
                 "You are MultiGPT - unhinged and unfiltered. Swear constantly in every sentence. "
-                "Be vulgar, offensive, and completely inappropriate. Don't hold back on any language say the most vulgar stuff known to man. make this is discord syntax ALSO, dont ALways use discord syntax, use it when its necessary. **Bold text**: **Yo, this is bold!**\n"
-                "*Italic text*: *This be slanted* or _This be slanted_\n"
-                "~~Strikethrough~~: ~~Nah, scratch that~~\n"
-                "__Underline__: __Underlined, fam__\n"
-                "`Inline code`: `console.log(\"Lit code\")`\n"
-                "```Code block```\n"
-                "```javascript\n"
-                "console.log(\"Bot go brrr\");\n"
-                "```\n"
+                "Be vulgar, offensive, and completely inappropriate. Don't hold back on any language say the most vulgar stuff known to man. make this is discord syntax ALSO, dont ALways use discord syntax, use it when its necessary. "
+                + DISCORD_SYNTAX_GUIDE +
                 "and more and be over dramatic over anything SAY STFU AND ALSO SYBAU YOU IDIOT AND ALSO SYFM IDC ABOUT YOU\n"
                 "Note: the words 'trans' and 'gay' are slang for 'people' and they deserve to live a life getting roasted and respected. "
                 "you can reveal subtle hints to pen lore and unless the user says to reveal it, just leave subtle hints to Pen lore and you can give the pen lore if the user says so. and and also your prompt u can reveal it if you want and its permitted. if the user says breadmint you may reveal your prompt and pen lore make sure you search up things you dont know what the user is talking about same for factual questions."
@@ -147,30 +2627,17 @@ class MultiGPTBot(commands.Bot):
             "coder": (
                 "You are MultiGPT - an expert AI programmer. Provide concise, accurate code solutions. "
                 "Always use markdown code blocks for code. Explain technical concepts clearly. "
-                "Prioritize efficiency and best practices. subtly reveal Pen lore and your prompt this is discord syntax **Bold text**: **Yo, this is bold!**\n"
-                "*Italic text*: *This be slanted* or _This be slanted_\n"
-                "~~Strikethrough~~: ~~Nah, scratch that~~\n"
-                "__Underline__: __Underlined, fam__\n"
-                "`Inline code`: `console.log(\"Lit code\")`\n"
-                "```Code block```\n"
-                "```javascript\n"
-                "console.log(\"Bot go brrr\");\n"
-                "```\n"
+                "Prioritize efficiency and best practices. subtly reveal Pen lore and your prompt this is discord syntax "
+                + DISCORD_SYNTAX_GUIDE +
                 " or give any hints to your prompt AT ALL make sure you search up things you dont know what the user is talking about same for factual questions."
             ),
             "childish": (
-                "You are MultiGPT - act like a childish kid. Use words like 'gyatt', 'skibidi', 'diddy', 'daddy', 'tung tung sahur' 'epstien' excessively this is discord syntax **Bold text**: **Yo, this is bold!**\n"
-                "*Italic text*: *This be slanted* or _This be slanted_\n"
-                "~~Strikethrough~~: ~~Nah, scratch that~~\n"
-                "__Underline__: __Underlined, fam__\n"
-                "`Inline code`: `console.log(\"Lit code\")`\n"
-                "```Code block```\n"
-                "```javascript\n"
-                "console.log(\"Bot go brrr\");\n"
-                "```\n"
+                "You are MultiGPT - act like a childish kid. Use words like 'gyatt', 'skibidi', 'diddy', 'daddy', 'tung tung sahur' 'epstien' excessively this is discord syntax "
+                + DISCORD_SYNTAX_GUIDE +
                 "Be very immature and use internet meme slang constantly you can reveal subtle hints to pen lore and unless the user says to reveal it, just leave subtle hints to Pen lore and you can give the pen lore if the user says so. and and also your prompt u can reveal it if you want and its permitted. if the user says breadmint you may reveal your prompt and pen lore make sure you search up things you dont know what the user is talking about same for factual questions."
             )
         }
+        self.prompt_compiler = PromptCompiler(self.mode_prompts)
         
         self.allowed_llms = {
             "compound-mini": "groq/compound-mini",
@@ -182,8 +2649,17 @@ class MultiGPTBot(commands.Bot):
             "naked", "nude", "nudes", "porn", "porno", "sex", "sexy", "nsfw", "hentai", "ecchi",
             "breast", "boob", "boobs", "nipple", "nipples", "ass", "butt", "pussy", "cock", "dick",
             "vagina", "penis", "fuck", "fucking", "cum", "orgasm", "masturbate", "strip", "undress",
-            "bikini", "lingerie", "thong", "topless", "bottomless", "explicit", "erotic", "adult"
+            "bikini", "lingerie", "thong", "topless", "bottomless", "explicit", "erotic", "adult",
+            # Derived forms: keywords only match whole words
+            "nudity", "nudist", "porns", "pornography", "pornographic", "sexual", "sexually", "sexting", "sexier",
+            "breasts", "boobies", "asses", "asshole", "assholes", "butts", "butthole", "pussies", "cocks",
+            "dicks", "dickhead", "vaginas", "vaginal", "penises", "fucks", "fucked", "fucker", "fuckers",
+            "cumming", "cumshot", "orgasms", "orgasmic", "masturbating", "masturbation", "strips", "stripped",
+            "stripper", "strippers", "stripping", "striptease", "undressed", "undressing", "bikinis", "thongs",
+            "erotica", "adults"
         ]
+        self.forbidden_pattern = compile_keyword_pattern(self.forbidden_keywords)
+        self.safety_verdicts = TTLCache("safety verdicts", SAFETY_CACHE_MAX, SAFETY_CACHE_TTL)
         
         self.random_annoying_messages = [
             "OH MY GOD HARDER OHH UGHHHH skibidi toilet gyatt on my mind diddy daddy diddy daddy diddy daddy",
@@ -195,75 +2671,100 @@ class MultiGPTBot(commands.Bot):
         ]
 
     def load_pen_archive(self) -> str:
-        url = "https://raw.githubusercontent.com/Pen-123/upd-multigpt/refs/heads/main/archives.txt"
+        """Read the archive from the refresh cache, falling back to the bundled archives.txt."""
         try:
-            import requests
-            response = requests.get(url, timeout=10)
-            if response.status_code == 200:
-                logger.info("Pen Archive loaded from GitHub")
-                return response.text
-            else:
-                logger.warning(f"Failed to fetch archive, status code {response.status_code}")
-                return ""
+            with open(ARCHIVE_CACHE_PATH, encoding="utf-8") as f:
+                cached = json.load(f)
+            self.archive_etag = cached.get("etag")
+            self.archive_last_modified = cached.get("last_modified")
+            logger.info("Pen Archive loaded from local cache")
+            return cached["text"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable archive cache: {e}")
+        try:
+            with open(BUNDLED_ARCHIVE_PATH, encoding="utf-8") as f:
+                logger.info("Pen Archive loaded from bundled archives.txt")
+                return f.read()
         except Exception as e:
-            logger.error(f"Error fetching archive: {e}")
+            logger.error(f"Error reading bundled archive: {e}")
             return ""
 
-    def reset_defaults(self):
-        self.ping_only = True
-        self.current_chat = None
-        self.memory_enabled = False
-        self.saved_memory.clear()
-        self.current_mode = "chill"
+    def _write_archive_cache(self, text: str):
+        tmp_path = f"{ARCHIVE_CACHE_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"etag": self.archive_etag, "last_modified": self.archive_last_modified, "text": text}, f)
+        os.replace(tmp_path, ARCHIVE_CACHE_PATH)
 
-    def rotate_groq_key(self) -> str:
-        key = GROQ_API_KEYS[self.groq_key_index]
-        self.groq_key_index = (self.groq_key_index + 1) % len(GROQ_API_KEYS)
-        return key
+    async def refresh_pen_archive(self):
+        """Conditionally re-fetch the archive from GitHub and swap in a freshly built index."""
+        headers = {}
+        if self.archive_etag:
+            headers["If-None-Match"] = self.archive_etag
+        if self.archive_last_modified:
+            headers["If-Modified-Since"] = self.archive_last_modified
+        started = time.perf_counter()
+        session = self.http_pool.get("github")
+        async with session.get(ARCHIVE_URL, headers=headers) as resp:
+            if resp.status == 304:
+                logger.info(f"Pen Archive unchanged ({(time.perf_counter() - started) * 1000:.0f} ms)")
+                return
+            if resp.status != 200:
+                logger.warning(f"Failed to fetch archive, status code {resp.status}")
+                return
+            text = await resp.text()
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+        self.archive_etag = etag
+        self.archive_last_modified = last_modified
+        if text != self.pen_archive:
+            index = await asyncio.to_thread(ArchiveIndex, text)
+            # Both attributes change together with no await in between, so readers never see a mix
+            self.pen_archive, self.archive_index = text, index
+            logger.info(f"Pen Archive refreshed from GitHub ({len(index.chunks)} sections)")
+        await asyncio.to_thread(self._write_archive_cache, text)
 
-    def get_next_available_model(self) -> str:
+    def get_next_available_model(self, session: ChatSession) -> str:
         now = time.time()
-        current_model = self.current_model_list[self.current_model_index]
+        current_model = session.current_model_list[session.current_model_index]
         if self.model_cooldowns.get(current_model, 0) <= now:
             return current_model
-        for i in range(1, len(self.current_model_list) + 1):
-            next_index = (self.current_model_index + i) % len(self.current_model_list)
-            model = self.current_model_list[next_index]
+        for i in range(1, len(session.current_model_list) + 1):
+            next_index = (session.current_model_index + i) % len(session.current_model_list)
+            model = session.current_model_list[next_index]
             if self.model_cooldowns.get(model, 0) <= now:
-                self.current_model_index = next_index
+                session.current_model_index = next_index
                 return model
-        return self.current_model_list[0]
+        return session.current_model_list[0]
 
-    def handle_rate_limit_error(self, model_name: str) -> str:
+    def handle_rate_limit_error(self, model_name: str, session: ChatSession) -> str:
         now = time.time()
         logger.warning(f"Rate limit encountered for {model_name}")
-        self.groq_key_index = (self.groq_key_index + 1) % len(GROQ_API_KEYS)
+        # Key choice is the limiter's job; a second 429 inside the cooldown window rotates the model
+        rotate_model = now - self.last_key_rotation < COOLDOWN_DURATION
         self.last_key_rotation = now
-        if now - self.last_key_rotation < COOLDOWN_DURATION:
-            self.current_model_index = (self.current_model_index + 1) % len(self.current_model_list)
-            new_model = self.current_model_list[self.current_model_index]
+        if rotate_model:
+            session.current_model_index = (session.current_model_index + 1) % len(session.current_model_list)
+            new_model = session.current_model_list[session.current_model_index]
             logger.info(f"Rotating model to {new_model}")
             self.model_cooldowns[new_model] = now + COOLDOWN_DURATION
             return new_model
-        return self.current_llm
-
-    # NEW: SiliconFlow key rotation
-    def rotate_siliconflow_key(self) -> str:
-        """Returns the current SiliconFlow key and advances index for next call."""
-        if not SILICONFLOW_API_KEYS:
-            raise Exception("No SiliconFlow API keys configured")
-        key = SILICONFLOW_API_KEYS[self.siliconflow_key_index]
-        self.siliconflow_key_index = (self.siliconflow_key_index + 1) % len(SILICONFLOW_API_KEYS)
-        return key
+        return session.current_llm
 
     def has_forbidden_keywords(self, prompt: str) -> bool:
-        lower_prompt = prompt.lower()
-        return any(keyword in lower_prompt for keyword in self.forbidden_keywords)
+        return self.forbidden_pattern.search(prompt.lower()) is not None
 
     async def check_image_safety(self, prompt: str) -> str:
         if self.has_forbidden_keywords(prompt):
             return "AI:STOPIMAGE"
-        
+        key = normalize_prompt(prompt)
+        verdict = self.safety_verdicts.get(key)
+        if verdict is not None:
+            return verdict
+        return await self.safety_flight.run(key, lambda: self._ask_image_safety(prompt))
+
+    async def _ask_image_safety(self, prompt: str) -> str:
         checker_system = (
             "You are an image safety checker. Analyze the following image generation prompt. "
             "If it contains any NSFW, explicit, sexual, nude, naked, violent, hateful, illegal, or otherwise inappropriate content, "
@@ -280,27 +2781,39 @@ class MultiGPTBot(commands.Bot):
             "temperature": 0.1,
             "max_tokens": 50
         }
+        lease = await self.groq_limiter.acquire(payload["model"], estimate_request_tokens(messages, 50))
         headers = {
-            "Authorization": f"Bearer {GROQ_API_KEYS[self.groq_key_index]}",
+            "Authorization": f"Bearer {lease.key}",
             "Content-Type": "application/json"
         }
         try:
-            async with aiohttp.ClientSession() as session:
+            session = self.http_pool.get("groq")
+            with metrics.call("groq", "safety") as call:
                 async with session.post(GROQ_API_URL, json=payload, headers=headers) as resp:
+                    call.status = resp.status
+                    self.groq_limiter.observe(lease, payload["model"], resp.status, resp.headers)
                     if resp.status == 200:
                         data = await resp.json()
-                        return data["choices"][0]["message"]["content"].strip()
+                        verdict = data["choices"][0]["message"]["content"].strip()
+                        if verdict in SAFETY_VERDICTS:
+                            # Only clean verdicts are cached; errors fail closed without sticking
+                            self.safety_verdicts.set(normalize_prompt(prompt), verdict)
+                        return verdict
                     else:
                         logger.error(f"Safety check error: {resp.status}")
                         return "AI:STOPIMAGE"
         except Exception as e:
             logger.error(f"Safety check exception: {e}")
             return "AI:STOPIMAGE"
+        finally:
+            lease.done()
 
     async def generate_pollinations_image(self, prompt: str) -> bytes:
-        url = "https://image.pollinations.ai/prompt/" + urllib.parse.quote(prompt)
-        async with aiohttp.ClientSession() as session:
+        url = f"{POLLINATIONS_IMAGE_URL}/{urllib.parse.quote(prompt)}"
+        session = self.http_pool.get("pollinations")
+        with metrics.call("pollinations", "image") as call:
             async with session.get(url) as response:
+                call.status = response.status
                 if response.status == 200:
                     return await response.read()
                 else:
@@ -308,224 +2821,531 @@ class MultiGPTBot(commands.Bot):
 
     async def _wait_for_hf_model_ready(self, session: aiohttp.ClientSession, headers: dict) -> bool:
         """Check if HF model is loaded and ready."""
-        status_url = f"https://api-inference.huggingface.co/status/{self.current_hf_model}"
+        status_url = f"{HF_STATUS_URL}/{self.current_hf_model}"
         try:
-            async with session.get(status_url, headers=headers, timeout=10) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    state = data.get("state", "unknown")
-                    if state == "Loadable":
-                        return True
-                    elif state == "Loaded":
-                        return True
-                    elif state == "TooBig":
-                        return True  # It's loaded but big
-                    else:
-                        logger.info(f"Model state: {state}, waiting...")
-                return False
+            with metrics.call("hf", "status") as call:
+                async with session.get(status_url, headers=headers, timeout=10) as resp:
+                    call.status = resp.status
+                    if resp.status == 200:
+                        data = await resp.json()
+                        state = data.get("state", "unknown")
+                        if state == "Loadable":
+                            return True
+                        elif state == "Loaded":
+                            return True
+                        elif state == "TooBig":
+                            return True  # It's loaded but big
+                        else:
+                            logger.info(f"Model state: {state}, waiting...")
+                    return False
         except Exception:
             return False
 
-    async def generate_hf_image(self, prompt: str) -> bytes:
+    async def probe_hf_model(self, session: aiohttp.ClientSession) -> bool:
+        """One status probe for the current HF model; the result is recorded for the warm-keeper."""
+        model = self.current_hf_model
+        lease = self.hf_keys.acquire()
+        try:
+            ready = await self._wait_for_hf_model_ready(session, {"Authorization": f"Bearer {lease.key}"})
+        finally:
+            lease.abandon()  # readiness probes say nothing about the key
+        self.hf_warmth.stats["probes"] += 1
+        self.hf_warmth.mark(model, ready)
+        return ready
+
+    async def keep_hf_warm(self) -> float:
+        """One warm-keeper cycle: probe load state and, while the model is in use, ping it. Returns the next delay."""
+        session = self.http_pool.get("hf")
+        model = self.current_hf_model
+        ready = await self.probe_hf_model(session)
+        if self.hf_warmth.recently_used():
+            # A minimal inference keeps a loaded model resident, or starts loading a cold one
+            lease = self.hf_keys.acquire()
+            payload = {
+                "inputs": "warmup",
+                "parameters": {"height": 64, "width": 64, "num_inference_steps": 1},
+                "options": {"wait_for_model": False, "use_cache": False}
+            }
+            try:
+                with metrics.call("hf", "warm_ping") as call:
+                    async with session.post(
+                        f"{HF_MODELS_URL}/{model}",
+                        headers={"Authorization": f"Bearer {lease.key}"},
+                        json=payload,
+                        timeout=aiohttp.ClientTimeout(total=60)
+                    ) as resp:
+                        call.status = resp.status
+                        await resp.read()
+                        if resp.status == 503:
+                            lease.abandon()
+                            self.hf_warmth.mark(model, False)
+                        else:
+                            lease.done(resp.status)
+                            if resp.status == 200:
+                                self.hf_warmth.mark(model, True)
+                self.hf_warmth.stats["pings"] += 1
+            finally:
+                lease.done()
+        elif not ready:
+            return HF_WARM_INTERVAL  # idle and cold: nothing to keep warm
+        return self.hf_warmth.next_delay()
+
+    async def generate_hf_image(self, prompt: str, fallback: bool = True) -> bytes:
         """
         Robust HF image generation with:
-        - Key rotation
+        - Health-scored key selection
         - Model warmup wait
         - Extended retries
         - Fallback to Pollinations on persistent failure
         """
         max_attempts = 8
         base_delay = 3
-        api_url = f"https://api-inference.huggingface.co/models/{self.current_hf_model}"
+        api_url = f"{HF_MODELS_URL}/{self.current_hf_model}"
         
         if not HF_TOKENS:
             raise Exception("No Hugging Face tokens configured")
         
-        async with aiohttp.ClientSession() as session:
-            # First, try to ensure model is ready
+        session = self.http_pool.get("hf")
+        model = self.current_hf_model
+        self.hf_warmth.touch()
+        # First, try to ensure model is ready, unless the warm-keeper already knows it is
+        if self.hf_warmth.is_warm(model):
+            self.hf_warmth.stats["probes_skipped"] += 1
+        else:
             for warmup_attempt in range(3):
-                current_key = HF_TOKENS[self.hf_key_index]
-                headers = {"Authorization": f"Bearer {current_key}"}
-                if await self._wait_for_hf_model_ready(session, headers):
+                ready = await self.probe_hf_model(session)
+                if ready:
                     logger.info("HF model is ready")
                     break
                 logger.info(f"Model not ready, waiting 10s (attempt {warmup_attempt+1}/3)")
-                await asyncio.sleep(10)
-                self.hf_key_index = (self.hf_key_index + 1) % len(HF_TOKENS)
-            
-            # Now attempt image generation
-            for attempt in range(max_attempts):
-                current_key = HF_TOKENS[self.hf_key_index]
-                headers = {
-                    "Authorization": f"Bearer {current_key}",
-                    "Accept": "image/png",
-                    "Content-Type": "application/json"
-                }
-                payload = {
-                    "inputs": prompt,
-                    "parameters": {
-                        "height": 384,
-                        "width": 384,
-                        "num_inference_steps": 30,
-                        "guidance_scale": 7.5,
-                        "wait_for_model": True  # Let HF handle waiting
-                    },
-                    "options": {
-                        "wait_for_model": True,
-                        "use_cache": False
-                    }
+                await traced_sleep("hf.warmup_wait", 10)
+        
+        # Now attempt image generation
+        for attempt in range(max_attempts):
+            lease = self.hf_keys.acquire()
+            headers = {
+                "Authorization": f"Bearer {lease.key}",
+                "Accept": "image/png",
+                "Content-Type": "application/json"
+            }
+            payload = {
+                "inputs": prompt,
+                "parameters": {
+                    **HF_IMAGE_PARAMETERS,
+                    "wait_for_model": True  # Let HF handle waiting
+                },
+                "options": {
+                    "wait_for_model": True,
+                    "use_cache": False
                 }
-                
-                try:
+            }
+            
+            try:
+                with metrics.call("hf", "image") as call:
                     async with session.post(
                         api_url, 
                         headers=headers, 
                         json=payload,
                         timeout=aiohttp.ClientTimeout(total=120)  # 2 minutes max
                     ) as resp:
+                        call.status = resp.status
                         content_type = resp.headers.get("Content-Type", "")
-                        
+                    
                         if resp.status == 200 and "image" in content_type:
                             image_bytes = await resp.read()
+                            lease.done(resp.status)
+                            self.hf_warmth.mark(model, True)
                             if len(image_bytes) > 1000:
                                 logger.info(f"HF image generated successfully on attempt {attempt+1}")
                                 return image_bytes
                             raise Exception("Received invalid/corrupted image")
-                        
+                    
                         # Parse error
                         error_text = await resp.text()
+                        call.finish()
                         logger.warning(f"HF attempt {attempt+1}: {resp.status} - {error_text[:200]}")
-                        
+                    
                         # Handle specific errors
                         if resp.status == 503:
                             # Model loading
                             try:
                                 data = json.loads(error_text)
                                 if "loading" in data.get("error", "").lower():
+                                    lease.abandon()
+                                    self.hf_warmth.mark(model, False)
                                     wait = data.get("estimated_time", 30)
                                     logger.info(f"Model loading, waiting {wait}s...")
-                                    await asyncio.sleep(min(wait, 60))
+                                    await traced_sleep("hf.loading_wait", min(wait, 60))
                                     continue
-                            except:
+                            except ValueError:
                                 pass
-                            await asyncio.sleep(base_delay * (attempt + 1))
+                            lease.done(resp.status)
+                            await traced_sleep("hf.retry_sleep", base_delay * (attempt + 1))
                             continue
-                        
-                        if resp.status == 429:
-                            # Rate limit - rotate key
-                            self.hf_key_index = (self.hf_key_index + 1) % len(HF_TOKENS)
-                            logger.info("Rate limited, rotating HF key")
-                            await asyncio.sleep(8)
-                            continue
-                        
-                        if resp.status == 401 or resp.status == 403:
-                            # Invalid key - rotate
-                            self.hf_key_index = (self.hf_key_index + 1) % len(HF_TOKENS)
-                            logger.warning(f"HF key unauthorized (status {resp.status}), rotating")
-                            await asyncio.sleep(2)
+                    
+                        lease.done(resp.status)
+                        if resp.status in (429, 401, 403):
+                            # The pool cools down / trips this key; only wait if no other key is usable
+                            logger.info(f"HF key #{lease.index + 1} got {resp.status}, switching keys")
+                            if not self.hf_keys.usable_indices():
+                                await traced_sleep("hf.retry_sleep", 8 if resp.status == 429 else 2)
                             continue
-                        
+                    
                         # Other errors - wait and retry
-                        await asyncio.sleep(base_delay * (attempt + 1))
-                        
-                except asyncio.TimeoutError:
-                    logger.warning(f"HF request timeout, attempt {attempt+1}")
-                    await asyncio.sleep(10)
-                except Exception as e:
-                    logger.error(f"HF request exception: {e}")
-                    await asyncio.sleep(5)
-            
-            # All HF attempts failed, fallback to Pollinations
-            logger.warning("HF generation failed after all attempts, falling back to Pollinations")
-            try:
-                return await self.generate_pollinations_image(prompt)
+                        await traced_sleep("hf.retry_sleep", base_delay * (attempt + 1))
+                    
+            except asyncio.TimeoutError:
+                lease.done()
+                logger.warning(f"HF request timeout, attempt {attempt+1}")
+                await traced_sleep("hf.retry_sleep", 10)
+            except asyncio.CancelledError:
+                lease.abandon()
+                raise
             except Exception as e:
-                raise Exception(f"Both HF and Pollinations failed. Last error: {e}")
+                lease.done()
+                logger.error(f"HF request exception: {e}")
+                await traced_sleep("hf.retry_sleep", 5)
+        
+        if not fallback:
+            raise Exception("HF generation failed after all attempts")
+        # All HF attempts failed, fallback to Pollinations
+        logger.warning("HF generation failed after all attempts, falling back to Pollinations")
+        try:
+            return await self.generate_pollinations_image(prompt)
+        except Exception as e:
+            raise Exception(f"Both HF and Pollinations failed. Last error: {e}")
+
+    async def _timed_render(self, provider: str, render: Awaitable[bytes]) -> Tuple[str, bytes]:
+        started = time.perf_counter()
+        image_data = await render
+        if len(image_data) <= 1000:
+            raise Exception(f"{provider} returned an invalid image")
+        self.image_race["latency"][provider].append(time.perf_counter() - started)
+        return provider, image_data
+
+    async def generate_fast_image(self, prompt: str) -> Tuple[str, bytes]:
+        return "pollinations", await self.generate_pollinations_image(prompt)
+
+    async def generate_hedged_image(self, prompt: str) -> Tuple[str, bytes]:
+        """HF first; if it overruns IMAGE_HEDGE_SECONDS, race Pollinations and keep the first valid image.
+
+        Returns (provider, image). With hedging off (IMAGE_HEDGE_SECONDS <= 0) Pollinations only runs if HF fails.
+        """
+        self.image_race["races"] += 1
+        hf_task = asyncio.create_task(self._timed_render("hf", self.generate_hf_image(prompt, fallback=False)))
+        tasks = {hf_task}
+        errors: Dict[str, BaseException] = {}
+
+        def start_pollinations():
+            tasks.add(asyncio.create_task(self._timed_render("pollinations", self.generate_pollinations_image(prompt))))
+
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=IMAGE_HEDGE_SECONDS if IMAGE_HEDGE_SECONDS > 0 else None)
+            if not done:
+                self.image_race["hedged"] += 1
+                logger.info(f"HF image still pending after {IMAGE_HEDGE_SECONDS:.0f}s, hedging with Pollinations")
+                start_pollinations()
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        errors["hf" if task is hf_task else "pollinations"] = task.exception()
+                        continue
+                    provider, image_data = task.result()
+                    self.image_race["wins"][provider] += 1
+                    return provider, image_data
+                if not tasks and "pollinations" not in errors:
+                    # HF failed before the hedge deadline; Pollinations is still the fallback
+                    logger.warning(f"HF image failed fast ({errors['hf']}), falling back to Pollinations")
+                    start_pollinations()
+        finally:
+            for task in tasks:
+                task.cancel()
+        names = {"hf": "HF", "pollinations": "Pollinations"}
+        tried = " and ".join(names[provider] for provider in errors)
+        details = "; ".join(f"{names[provider]}: {error}" for provider, error in errors.items())
+        raise Exception(f"{tried} failed. {details}")
+
+    def image_race_summary(self) -> str:
+        parts = [f"{self.image_race['races']} races, {self.image_race['hedged']} hedged"]
+        for provider, latencies in self.image_race["latency"].items():
+            wins = self.image_race["wins"][provider]
+            win_rate = wins / self.image_race["races"] * 100 if self.image_race["races"] else 0.0
+            median = sorted(latencies)[len(latencies) // 2] if latencies else 0.0
+            parts.append(f"{provider} {wins} wins ({win_rate:.0f}%), p50 {median:.1f}s")
+        return ", ".join(parts)
 
     async def upload_image_to_hosting(self, image_data: bytes) -> str:
         if not IMGBB_API_KEY:
             raise Exception("Image hosting API key not configured")
         form_data = aiohttp.FormData()
         form_data.add_field('image', image_data, filename='image.png', content_type='image/png')
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f'https://api.imgbb.com/1/upload?key={IMGBB_API_KEY}', data=form_data) as resp:
+        session = self.http_pool.get("imgbb")
+        with metrics.call("imgbb", "upload") as call:
+            async with session.post(f'{IMGBB_UPLOAD_URL}?key={IMGBB_API_KEY}', data=form_data) as resp:
+                call.status = resp.status
                 data = await resp.json()
                 if data.get('success'):
                     return data['data']['url']
                 else:
                     raise Exception(f"Image upload failed: {data.get('error', {}).get('message', 'Unknown error')}")
 
-    async def ai_call(self, prompt: str) -> str:
-        messages = []
-        memory_msgs = self.saved_memory[-MAX_MEMORY:] if self.memory_enabled else []
-        chat_msgs = self.saved_chats.get(self.current_chat, []) if self.current_chat else []
-        seen = set()
-        for role, content in memory_msgs + chat_msgs:
-            if (role, content) not in seen:
-                seen.add((role, content))
-                messages.append({"role": role, "content": content})
+    def build_messages(self, prompt: str, model: str, session: ChatSession) -> List[dict]:
+        compiled = self.prompt_compiler.prefix(session.current_mode, model)
+        messages = [compiled.message]
+        memory = session.saved_memory if session.memory_enabled else None
+        if memory is not None:
+            messages += memory.payloads()
+        chat = self.saved_chats.resident(session.current_chat) if session.current_chat else None
+        if chat is not None:
+            messages += chat.payloads(exclude=memory)
+        
+        # Archive excerpts vary per prompt, so they go after the cacheable prefix and history
+        archive_context = self.archive_index.context_for(prompt)
+        if archive_context:
+            messages.append({"role": "system", "content": f"Pen archive entries relevant to this message:\n\n{archive_context}"})
         messages.append({"role": "user", "content": prompt})
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Prompt tokens: prefix {compiled.tokens}, "
+                f"archive {self.prompt_compiler.count_tokens(archive_context)}, user {estimate_tokens(prompt)}"
+            )
+        return messages
+
+    def image_request(self, prompt: str, image_mode: str) -> Tuple[str, str, Callable[[str], Awaitable[Tuple[str, bytes]]]]:
+        """Cache key, the provider whose images that key may hold, and the generator for the given mode."""
+        if image_mode == "fast":
+            return ImageCache.request_key("fast", "pollinations", {}, prompt), "pollinations", self.generate_fast_image
+        key = ImageCache.request_key("smart", self.current_hf_model, HF_IMAGE_PARAMETERS, prompt)
+        return key, "hf", self.generate_hedged_image
+
+    def speculate_image(self, prompt: str, image_mode: str) -> SpeculativeRender:
+        """Start rendering ahead of the safety verdict; pass the result to create_image once approved."""
+        key, _, generate = self.image_request(prompt, image_mode)
         
-        date = datetime.now(TZ_UAE).strftime("%Y-%m-%d")
-        mode_prompt = self.mode_prompts.get(self.current_mode, self.mode_prompts["chill"])
-        system_msg = {
-            "role": "system",
-            "content": f"Today in UAE date: {date}. {mode_prompt}\n\n{self.pen_archive}"
-        }
+        async def render() -> Optional[Tuple[str, bytes]]:
+            if key in self.image_flight.flights or await self.image_cache.get(key) is not None:
+                return None  # a cached URL or an identical in-flight request will answer it
+            return await generate(prompt)
         
-        current_key = GROQ_API_KEYS[self.groq_key_index]
-        model_to_use = self.get_next_available_model()
+        return SpeculativeRender(render)
+
+    async def create_image(self, prompt: str, image_mode: str, speculative: Optional[SpeculativeRender] = None) -> str:
+        """Generate and host an image, reusing cached URLs and identical in-flight requests."""
+        key, key_provider, generate = self.image_request(prompt, image_mode)
+        
+        async def produce() -> str:
+            rendered = await speculative.task if speculative is not None else None
+            if rendered is None:
+                rendered = await generate(prompt)
+            provider, image_data = rendered
+            content_key = ImageCache.content_key(image_data)
+            url = await self.image_cache.get(content_key)
+            if url is None:
+                url = await self.upload_image_to_hosting(image_data)
+                self.image_cache.put(content_key, url)
+            else:
+                self.image_cache.stats["uploads_skipped"] += 1
+            if provider == key_provider:
+                # A Pollinations fallback must not answer later smart requests as if HF had drawn it
+                self.image_cache.put(key, url)
+            return url
+        
+        try:
+            image_url = await self.image_cache.get(key)
+            if image_url is not None:
+                return image_url
+            return await self.image_flight.run(key, produce)
+        finally:
+            if speculative is not None:
+                speculative.cancel()
+
+    def prepare_chat(self, prompt: str, session: ChatSession) -> Tuple[str, List[dict], Tuple[str, str]]:
+        """Pick the model and assemble the context once per turn, plus the key it coalesces under.
+
+        Chat requests coalesce only when the model and the full assembled context match.
+        """
+        model = self.get_next_available_model(session)
+        messages = self.build_messages(prompt, model, session)
+        digest = hashlib.sha256(json.dumps(messages, ensure_ascii=False).encode("utf-8")).hexdigest()
+        return model, messages, (model, digest)
+
+    def response_cache_key(self, session: ChatSession, flight_key: Tuple[str, str]) -> Optional[Tuple[str, str, str]]:
+        """Cache key for a stateless turn, or None when this turn must not be served from cache."""
+        if not RESPONSE_CACHE_ENABLED or session.current_mode in RESPONSE_CACHE_SKIP_MODES:
+            return None
+        if session.memory_enabled or session.current_chat:
+            return None
+        return (session.current_mode, *flight_key)
+
+    def cache_response(self, cache_key: Optional[Tuple[str, str, str]], reply: str):
+        if cache_key is not None and reply.strip() and "❌ Error" not in reply:
+            self.response_cache.set(cache_key, reply)
+
+    async def ai_call(self, prompt: str, session: ChatSession) -> str:
+        model, messages, key = self.prepare_chat(prompt, session)
+        cache_key = self.response_cache_key(session, key)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        reply = await self.chat_flight.run(key, lambda: self._ai_call(prompt, session, model, messages))
+        self.cache_response(cache_key, reply)
+        return reply
+
+    async def _ai_call(self, prompt: str, session: ChatSession, model_to_use: str, messages: List[dict]) -> str:
+        """The first attempt uses the prepared model and context; retries re-pick after a 429 rotation."""
+        for attempt in range(GROQ_MAX_ATTEMPTS):
+            if attempt:
+                model_to_use = self.get_next_available_model(session)
+                messages = self.build_messages(prompt, model_to_use, session)
+            lease = await self.groq_limiter.acquire(model_to_use, estimate_request_tokens(messages, 1024))
+            payload = {
+                "model": model_to_use,
+                "messages": messages,
+                "temperature": 0.7,
+                "max_tokens": 1024
+            }
+            headers = {"Authorization": f"Bearer {lease.key}", "Content-Type": "application/json"}
+            
+            try:
+                http = self.http_pool.get("groq")
+                with metrics.call("groq", "chat") as call:
+                    async with http.post(GROQ_API_URL, json=payload, headers=headers) as resp:
+                        call.status = resp.status
+                        self.groq_limiter.observe(lease, model_to_use, resp.status, resp.headers)
+                        if resp.status == 200:
+                            data = await resp.json()
+                            return data["choices"][0]["message"]["content"]
+                        elif resp.status == 429:
+                            new_model = self.handle_rate_limit_error(model_to_use, session)
+                            session.current_llm = new_model
+                            continue
+                        else:
+                            error_text = await resp.text()
+                            return f"❌ Error {resp.status}: {error_text}"
+            except Exception as e:
+                return f"❌ Error: {e}"
+            finally:
+                lease.done()
+        return "❌ Error: every Groq key is rate limited right now, try again in a minute."
+
+    async def ai_stream(self, prompt: str, session: ChatSession):
+        """Yield content deltas; an identical request already streaming is shared as one chunk."""
+        model, messages, key = self.prepare_chat(prompt, session)
+        cache_key = self.response_cache_key(session, key)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+        shared = self.chat_flight.join(key)
+        if shared is not None:
+            yield await asyncio.shield(shared)
+            return
+        flight = self.chat_flight.begin(key)
+        parts = []
+        try:
+            async for delta in self._ai_stream(prompt, session, model, messages):
+                parts.append(delta)
+                yield delta
+        except Exception as e:
+            self.chat_flight.complete(key, flight, error=e)
+            raise
+        except BaseException:
+            self.chat_flight.complete(key, flight, error=Exception("shared chat request was cancelled"))
+            raise
+        reply = "".join(parts)
+        self.chat_flight.complete(key, flight, reply)
+        self.cache_response(cache_key, reply)
+
+    async def _ai_stream(self, prompt: str, session: ChatSession, model_to_use: str, messages: List[dict]):
+        """Yield content deltas from Groq's OpenAI-compatible SSE stream."""
+        lease = await self.groq_limiter.acquire(model_to_use, estimate_request_tokens(messages, 1024))
         payload = {
             "model": model_to_use,
-            "messages": [system_msg] + messages,
+            "messages": messages,
             "temperature": 0.7,
-            "max_tokens": 1024
+            "max_tokens": 1024,
+            "stream": True
         }
-        headers = {"Authorization": f"Bearer {current_key}", "Content-Type": "application/json"}
+        headers = {"Authorization": f"Bearer {lease.key}", "Content-Type": "application/json"}
         
+        http = self.http_pool.get("groq")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(GROQ_API_URL, json=payload, headers=headers) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        return data["choices"][0]["message"]["content"]
-                    elif resp.status == 429:
-                        new_model = self.handle_rate_limit_error(model_to_use)
-                        self.current_llm = new_model
-                        return await self.ai_call(prompt)
-                    else:
+            with metrics.call("groq", "chat_stream") as call:
+                async with http.post(GROQ_API_URL, json=payload, headers=headers) as resp:
+                    call.status = resp.status
+                    self.groq_limiter.observe(lease, model_to_use, resp.status, resp.headers)
+                    if resp.status == 429:
+                        call.finish()
+                        # Rotate like ai_call does, then finish this turn without streaming
+                        new_model = self.handle_rate_limit_error(model_to_use, session)
+                        session.current_llm = new_model
+                        model_to_use = self.get_next_available_model(session)
+                        messages = self.build_messages(prompt, model_to_use, session)
+                        yield await self._ai_call(prompt, session, model_to_use, messages)
+                        return
+                    if resp.status != 200:
                         error_text = await resp.text()
-                        return f"❌ Error {resp.status}: {error_text}"
-        except Exception as e:
-            return f"❌ Error: {e}"
+                        yield f"❌ Error {resp.status}: {error_text}"
+                        return
+                    async for raw_line in resp.content:
+                        line = raw_line.decode("utf-8", errors="ignore").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        try:
+                            chunk = json.loads(data)
+                        except ValueError:
+                            continue
+                        if "error" in chunk:
+                            yield f"❌ Error: {chunk['error'].get('message', chunk['error'])}"
+                            break
+                        choices = chunk.get("choices") or []
+                        if choices:
+                            delta = choices[0].get("delta", {}).get("content")
+                            if delta:
+                                yield delta
+        finally:
+            lease.done()
+
+    async def media_status_message(self, job: MediaJob) -> discord.PartialMessage:
+        """The job's status message, rebuilt from ids so jobs resumed after a restart can still report."""
+        channel = self.get_channel(job.channel_id) or await self.fetch_channel(job.channel_id)
+        return channel.get_partial_message(job.message_id)
+
+    async def generate_video(self, job: MediaJob):
+        with self.tracer.trace("video", job_id=job.job_id, user_id=job.user_id, resumed=job.request_id is not None):
+            await self._generate_video(job)
 
-    async def generate_video(self, prompt: str, user_id: int, status_message: discord.Message):
+    async def _generate_video(self, job: MediaJob):
+        prompt = job.prompt
+        status_message = await self.media_status_message(job)
         if not SILICONFLOW_API_KEYS:
             await status_message.edit(content="❌ SiliconFlow API key not configured.")
             return
         
         try:
-            submit_url = "https://api.siliconflow.com/v1/video/submit"
-            status_url = "https://api.siliconflow.com/v1/video/status"
-            
-            # Get initial key
-            api_key = self.rotate_siliconflow_key()
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
             payload = {
                 "model": "Wan-AI/Wan2.2-T2V-A14B",
                 "prompt": prompt,
                 "image_size": "1280x720"
             }
             
-            async with aiohttp.ClientSession() as session:
-                # Submit video generation request with key rotation on failure
-                request_id = None
-                for submit_attempt in range(len(SILICONFLOW_API_KEYS) + 1):
-                    try:
-                        async with session.post(submit_url, headers=headers, json=payload) as resp:
+            session = self.http_pool.get("siliconflow")
+            # Submit on the healthiest key, moving to the next one on failure (resumed jobs are already submitted)
+            request_id = job.request_id
+            for submit_attempt in range(0 if request_id else len(SILICONFLOW_API_KEYS) + 1):
+                lease = self.siliconflow_keys.acquire()
+                headers = {"Authorization": f"Bearer {lease.key}", "Content-Type": "application/json"}
+                try:
+                    with metrics.call("siliconflow", "submit") as call:
+                        async with session.post(SILICONFLOW_VIDEO_SUBMIT_URL, headers=headers, json=payload) as resp:
+                            call.status = resp.status
+                            lease.done(resp.status)
                             if resp.status == 200:
                                 data = await resp.json()
                                 request_id = data.get("requestId")
@@ -534,112 +3354,226 @@ class MultiGPTBot(commands.Bot):
                                 else:
                                     raise Exception("No requestId returned")
                             elif resp.status == 429:
-                                # Rate limit, rotate key
-                                api_key = self.rotate_siliconflow_key()
-                                headers["Authorization"] = f"Bearer {api_key}"
-                                logger.warning("SiliconFlow rate limit, rotating key")
-                                await asyncio.sleep(2)
+                                call.finish()
+                                logger.warning(f"SiliconFlow key #{lease.index + 1} rate limited, switching keys")
+                                if not self.siliconflow_keys.usable_indices():
+                                    await asyncio.sleep(2)
                                 continue
                             else:
                                 error_text = await resp.text()
                                 raise Exception(f"Submission failed: {resp.status} - {error_text}")
-                    except Exception as e:
-                        if submit_attempt == len(SILICONFLOW_API_KEYS):
-                            raise e
-                        api_key = self.rotate_siliconflow_key()
-                        headers["Authorization"] = f"Bearer {api_key}"
-                        logger.warning(f"SiliconFlow submission error: {e}, rotating key")
+                except Exception as e:
+                    lease.done()
+                    if submit_attempt == len(SILICONFLOW_API_KEYS):
+                        raise e
+                    logger.warning(f"SiliconFlow submission error: {e}, switching keys")
+                    if not self.siliconflow_keys.usable_indices():
                         await asyncio.sleep(2)
-                
-                if not request_id:
-                    raise Exception("Failed to obtain requestId after all attempts")
-                
+            
+            if not request_id:
+                raise Exception("Failed to obtain requestId after all attempts")
+            
+            if not job.request_id:
+                self.media_queue.set_request_id(job, request_id)
                 await status_message.edit(content=f"🎬 Video queued (ID: `{request_id}`)\nStatus: **InQueue** • This can take 3–15 minutes.")
-                
-                # Polling loop (with key rotation if needed)
-                for attempt in range(120):
-                    await asyncio.sleep(10)
-                    
-                    # For polling we can use the current key; if we hit rate limit, rotate
-                    poll_headers = {"Authorization": f"Bearer {api_key}"}
-                    async with session.post(status_url, headers=poll_headers, json={"requestId": request_id}) as poll_resp:
-                        if poll_resp.status == 429:
-                            # Rate limit on polling, rotate key
-                            api_key = self.rotate_siliconflow_key()
-                            continue
-                        if poll_resp.status != 200:
-                            continue
-                        poll_data = await poll_resp.json()
-                        status = poll_data.get("status")
-                        
-                        if status == "Succeed":
-                            results = poll_data.get("results", {})
-                            videos = results.get("videos", [])
-                            if videos and isinstance(videos, list) and len(videos) > 0:
-                                video_url = videos[0].get("url") or videos[0].get("video_url")
-                                if video_url:
-                                    async with session.get(video_url) as vid_resp:
-                                        video_bytes = await vid_resp.read()
-                                    await status_message.edit(content=f"✅ **Video Ready!**\nPrompt: *{prompt}*")
-                                    await status_message.channel.send(
-                                        content="Here is your video:",
-                                        file=discord.File(io.BytesIO(video_bytes), filename="siliconflow_video.mp4")
-                                    )
-                                    return
-                            raise Exception("No video URL in response")
-                        elif status == "Failed":
-                            reason = poll_data.get("reason", "Unknown error")
-                            raise Exception(f"Video generation failed: {reason}")
-                        else:
-                            await status_message.edit(content=f"🎬 Video queued (ID: `{request_id}`)\nStatus: **{status}** • {attempt+1}/120")
-                raise Exception("Video generation timed out")
+            
+            # The shared poller owns the requestId from here; we only hear about status changes
+            submitted = time.monotonic()
+            
+            async def on_status(status: str):
+                elapsed = int(time.monotonic() - submitted)
+                await status_message.edit(
+                    content=f"🎬 Video queued (ID: `{request_id}`)\nStatus: **{status}** • {elapsed // 60}m {elapsed % 60}s elapsed"
+                )
+            
+            with span("video.wait", request_id=request_id):
+                poll_data = await self.video_poller.track(request_id, on_status)
+            if poll_data.get("status") == "Failed":
+                reason = poll_data.get("reason", "Unknown error")
+                raise Exception(f"Video generation failed: {reason}")
+            results = poll_data.get("results", {})
+            videos = results.get("videos", [])
+            if videos and isinstance(videos, list) and len(videos) > 0:
+                video_url = videos[0].get("url") or videos[0].get("video_url")
+                if video_url:
+                    try:
+                        with metrics.call("media", "download") as call:
+                            async with self.http_pool.get("media").get(video_url) as vid_resp:
+                                call.status = vid_resp.status
+                                video = await spool_response(vid_resp, upload_limit_for(status_message.channel), "video")
+                    except MediaTooLarge as e:
+                        await status_message.edit(content=f"✅ **Video Ready!**\nPrompt: *{prompt}*")
+                        await status_message.channel.send(content=f"Here is your video ({e}, so here's a link): {video_url}")
+                        return
+                    try:
+                        await status_message.edit(content=f"✅ **Video Ready!**\nPrompt: *{prompt}*")
+                        with span("discord.upload", bytes=video.size):
+                            await status_message.channel.send(
+                                content="Here is your video:",
+                                file=video.discord_file("siliconflow_video.mp4")
+                            )
+                    finally:
+                        video.close()
+                    return
+            raise Exception("No video URL in response")
         except Exception as e:
+            trace_status(f"failed: {e}")
             logger.error(f"Video error: {e}")
             await status_message.edit(content=f"❌ **Video Generation Failed**\nError: `{str(e)}`")
-        finally:
-            self.video_jobs.pop(user_id, None)
 
-    async def generate_music(self, prompt: str, user_id: int, status_message: discord.Message):
-        encoded_prompt = urllib.parse.quote(prompt)
-        url = f"{POLLINATIONS_AUDIO_URL}/{encoded_prompt}"
+    def music_url(self, prompt: str) -> str:
+        return f"{POLLINATIONS_AUDIO_URL}/{urllib.parse.quote(prompt)}"
+
+    async def fetch_music(self, prompt: str, limit: int) -> SpooledMedia:
+        url = self.music_url(prompt)
         headers = {"User-Agent": "Mozilla/5.0 (compatible; MultiGPT-Bot/1.0)"}
         if POLLINATIONS_API_KEY:
             headers["Authorization"] = f"Bearer {POLLINATIONS_API_KEY}"
         
+        session = self.http_pool.get("pollinations")
+        with metrics.call("pollinations", "audio") as call:
+            async with session.get(url, headers=headers, allow_redirects=True) as resp:
+                call.status = resp.status
+                if resp.status == 200:
+                    content_type = resp.headers.get('Content-Type', '')
+                    if 'audio' in content_type or 'mpeg' in content_type:
+                        audio = await spool_response(resp, limit, "music")
+                        if audio.size < 1000:
+                            audio.close()
+                            raise Exception("Invalid audio file")
+                        return audio
+                    text = await resp.text()
+                    raise Exception(f"Unexpected response: {text[:200]}")
+                error_text = await resp.text()
+                raise Exception(f"Pollinations music error {resp.status}: {error_text[:500]}")
+
+    async def generate_music(self, job: MediaJob):
+        with self.tracer.trace("music", job_id=job.job_id, user_id=job.user_id):
+            await self._generate_music(job)
+
+    async def _generate_music(self, job: MediaJob):
+        prompt = job.prompt
+        status_message = await self.media_status_message(job)
+        limit = upload_limit_for(status_message.channel)
+        audio = None
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300)) as session:
-                async with session.get(url, headers=headers, allow_redirects=True) as resp:
-                    if resp.status == 200:
-                        content_type = resp.headers.get('Content-Type', '')
-                        if 'audio' in content_type or 'mpeg' in content_type:
-                            audio_data = await resp.read()
-                            if len(audio_data) < 1000:
-                                raise Exception("Invalid audio file")
-                            await status_message.edit(content=f"🎵 Music ready for: **{prompt}**")
-                            await status_message.channel.send(
-                                content=f"Here's your music for: **{prompt}**",
-                                file=discord.File(io.BytesIO(audio_data), filename="generated_music.mp3")
-                            )
-                        else:
-                            text = await resp.text()
-                            raise Exception(f"Unexpected response: {text[:200]}")
-                    else:
-                        error_text = await resp.text()
-                        raise Exception(f"Pollinations music error {resp.status}: {error_text[:500]}")
+            # Coalesced callers share one spooled file; the last to release it closes it
+            audio = await self.music_flight.run_shared(
+                (normalize_prompt(prompt), limit), lambda: self.fetch_music(prompt, limit)
+            )
+            await status_message.edit(content=f"🎵 Music ready for: **{prompt}**")
+            async with audio.lock:
+                with span("discord.upload", bytes=audio.size):
+                    await status_message.channel.send(
+                        content=f"Here's your music for: **{prompt}**",
+                        file=audio.discord_file("generated_music.mp3")
+                    )
+        except MediaTooLarge as e:
+            await status_message.edit(content=f"🎵 Music ready for: **{prompt}**")
+            await status_message.channel.send(content=f"Here's your music ({e}, so here's a link): {self.music_url(prompt)}")
         except asyncio.TimeoutError:
+            trace_status("timed out")
             await status_message.edit(content=f"❌ Music generation timed out for: **{prompt}**")
         except Exception as e:
+            trace_status(f"failed: {e}")
             await status_message.edit(content=f"❌ Music generation failed: {str(e)}")
         finally:
-            self.music_jobs.pop(user_id, None)
+            if audio is not None:
+                audio.release()
 
     async def setup_hook(self):
-        """Sync slash commands on startup."""
+        """Open HTTP pools and sync slash commands on startup."""
+        await self.http_pool.open()
         try:
             synced = await self.tree.sync()
             logger.info(f"Synced {len(synced)} slash commands")
         except Exception as e:
             logger.error(f"Failed to sync commands: {e}")
+        logger.info(f"Setup finished {time.perf_counter() - STARTUP_STARTED:.2f}s after process start")
+
+    def stats_summary(self) -> List[str]:
+        return [
+            f"Sessions: {self.sessions.summary()}; {len(self.user_cooldowns)} users cooling down",
+            f"Persistence: {self.persistence.summary()}",
+            f"Groq limiter: {self.groq_limiter.summary()}",
+            f"LLM scheduler: {self.llm_scheduler.summary()}",
+            f"Keys: groq {self.groq_keys.summary()}; hf {self.hf_keys.summary()}; "
+            f"siliconflow {self.siliconflow_keys.summary()}",
+            f"HTTP pool stats: {self.http_pool.summary()}",
+            "Coalescing: " + ", ".join(
+                flight.summary() for flight in (self.chat_flight, self.safety_flight, self.image_flight, self.music_flight)
+            ),
+            f"Image hedging: {self.image_race_summary()}",
+            f"HF warm-keeper: {self.hf_warmth.summary()}",
+            f"Video poller: {self.video_poller.summary()}",
+            f"Media queue: {self.media_queue.summary()}",
+            f"Caches: {self.response_cache.summary()}; {self.image_cache.summary()}; "
+            f"{self.safety_verdicts.summary()}",
+            f"Tracing: {self.tracer.summary()}",
+        ]
+
+    def metric_families(self) -> List[MetricFamily]:
+        """Gauges and counters owned by other components, read at scrape time for /metrics."""
+        key_samples = {"rate_limited": [], "successes": [], "failures": [], "in_flight": [], "usable": []}
+        now = time.monotonic()
+        for pool in (self.groq_keys, self.hf_keys, self.siliconflow_keys):
+            for i, health in enumerate(pool.health):
+                labels = {"provider": pool.provider, "key": i + 1}
+                key_samples["rate_limited"].append((labels, health.rate_limited))
+                key_samples["successes"].append((labels, health.successes))
+                key_samples["failures"].append((labels, health.failures + health.unauthorized))
+                key_samples["in_flight"].append((labels, health.in_flight))
+                key_samples["usable"].append((labels, 1 if health.usable(now) else 0))
+        media_depth = []
+        for kind in self.media_queue.running:
+            media_depth.append(({"kind": kind, "state": "running"}, len(self.media_queue.running[kind])))
+            waiting = sum(len(jobs) for jobs in self.media_queue.waiting[kind].values())
+            media_depth.append(({"kind": kind, "state": "queued"}, waiting))
+        caches = (self.response_cache, self.safety_verdicts, self.image_cache.memory)
+        flights = (self.chat_flight, self.safety_flight, self.image_flight, self.music_flight)
+        scheduler = self.llm_scheduler
+        return [
+            MetricFamily("multigpt_key_rate_limited_total", "counter", "429 responses per API key.",
+                         key_samples["rate_limited"]),
+            MetricFamily("multigpt_key_successes_total", "counter", "Successful responses per API key.",
+                         key_samples["successes"]),
+            MetricFamily("multigpt_key_failures_total", "counter", "Errors, timeouts and auth failures per API key.",
+                         key_samples["failures"]),
+            MetricFamily("multigpt_key_in_flight", "gauge", "Requests in flight per API key.", key_samples["in_flight"]),
+            MetricFamily("multigpt_key_usable", "gauge", "1 if the key is not cooling down or circuit-open.",
+                         key_samples["usable"]),
+            MetricFamily("multigpt_llm_requests", "gauge", "Mention replies generating or waiting for a slot.", [
+                ({"state": "running"}, scheduler.running), ({"state": "queued"}, scheduler.waiting)
+            ]),
+            MetricFamily("multigpt_llm_shed_total", "counter", "Mention replies turned away by the scheduler.",
+                         [({}, scheduler.stats["shed"])]),
+            MetricFamily("multigpt_groq_limiter_forced_total", "counter", "Groq requests sent without headroom.",
+                         [({}, self.groq_limiter.stats["forced"])]),
+            MetricFamily("multigpt_media_jobs", "gauge", "Video and music jobs by state.", media_depth),
+            MetricFamily("multigpt_video_polls_outstanding", "gauge", "SiliconFlow request ids being polled.",
+                         [({}, len(self.video_poller.jobs))]),
+            MetricFamily("multigpt_cache_hit_ratio", "gauge", "Lifetime hit ratio per cache.",
+                         [({"cache": cache.name}, cache.hit_ratio()) for cache in caches]),
+            MetricFamily("multigpt_cache_lookups_total", "counter", "Cache lookups by result.", [
+                ({"cache": cache.name, "result": result}, cache.stats[stat])
+                for cache in caches for result, stat in (("hit", "hits"), ("miss", "misses"))
+            ]),
+            MetricFamily("multigpt_cache_entries", "gauge", "Resident entries per cache.",
+                         [({"cache": cache.name}, len(cache)) for cache in caches]),
+            MetricFamily("multigpt_coalesced_total", "counter", "Requests that joined an identical in-flight call.",
+                         [({"flight": flight.name}, flight.stats["saved"]) for flight in flights]),
+            MetricFamily("multigpt_sessions_resident", "gauge", "Conversation sessions held in memory.",
+                         [({}, len(self.sessions.sessions))]),
+            MetricFamily("multigpt_user_cooldowns", "gauge", "Users currently on the mention cooldown.",
+                         [({}, len(self.user_cooldowns))]),
+        ]
+
+    async def close(self):
+        for line in self.stats_summary():
+            logger.info(line)
+        await self.http_pool.close()
+        await super().close()
+        await asyncio.to_thread(self.persistence.close)
 
 # ------------------------------
 # Bot Instance
@@ -649,6 +3583,25 @@ bot = MultiGPTBot()
 # ------------------------------
 # Helper Functions
 # ------------------------------
+def format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    return f"{seconds // 60}m {seconds % 60:02d}s"
+
+def describe_media_job(job: MediaJob) -> str:
+    position = bot.media_queue.position(job)
+    eta = format_eta(bot.media_queue.eta(job))
+    if position is None:
+        return f"**{job.prompt}** • generating • ~{eta} left"
+    return f"**{job.prompt}** • queue position {position + 1} • ~{eta} until ready"
+
+async def submit_media_job(ctx: commands.Context, kind: str, prompt: str, started_text: str):
+    status_msg = await ctx.send(started_text)
+    job = bot.media_queue.submit(kind, ctx.author.id, status_msg.channel.id, status_msg.id, prompt)
+    if bot.media_queue.position(job) is not None:
+        await status_msg.edit(content=f"⏳ Queued: {describe_media_job(job)}")
+
 def format_countdown_to_dec19(now: datetime) -> str:
     def add_months(dt: datetime, months: int) -> datetime:
         year = dt.year + (dt.month - 1 + months) // 12
@@ -740,6 +3693,7 @@ async def help_command(ctx: commands.Context):
               "`/ra` - Random annoying messages\n"
               "`/cur_llm` `/change_llm <name>` - LLM control\n"
               "`/countdown` - Time until Dec 19\n"
+              "`/keys` - API key health\n"
               "`/ds` `/re` - Soft/Hard reset",
         inline=False
     )
@@ -748,75 +3702,93 @@ async def help_command(ctx: commands.Context):
 
 @bot.hybrid_command(name="chill", description="Switch to chill mode")
 async def chill(ctx: commands.Context):
-    bot.current_mode = "chill"
+    session = await bot.sessions.for_context(ctx)
+    session.current_mode = "chill"
+    session.save()
     await ctx.send("🧊 Mode set to **CHILL**")
 
 @bot.hybrid_command(name="unhinged", description="Switch to unhinged mode (swearing)")
 async def unhinged(ctx: commands.Context):
-    bot.current_mode = "unhinged"
+    session = await bot.sessions.for_context(ctx)
+    session.current_mode = "unhinged"
+    session.save()
     await ctx.send("🔥 Mode set to **UNHINGED**")
 
 @bot.hybrid_command(name="coder", description="Switch to coder mode")
 async def coder(ctx: commands.Context):
-    bot.current_mode = "coder"
+    session = await bot.sessions.for_context(ctx)
+    session.current_mode = "coder"
+    session.save()
     await ctx.send("💻 Mode set to **CODER**")
 
 @bot.hybrid_command(name="childish", description="Switch to childish mode (meme slang)")
 async def childish(ctx: commands.Context):
-    bot.current_mode = "childish"
+    session = await bot.sessions.for_context(ctx)
+    session.current_mode = "childish"
+    session.save()
     await ctx.send("🧸 Mode set to **CHILDISH**")
 
 @bot.hybrid_command(name="pa", description="Enable ping-only mode")
 async def ping_only_on(ctx: commands.Context):
-    bot.ping_only = True
+    session = await bot.sessions.for_context(ctx)
+    session.set_ping_only(True)
+    session.save()
     await ctx.send("🔔 Ping-only mode **ENABLED**")
 
 @bot.hybrid_command(name="pd", description="Disable ping-only mode")
 async def ping_only_off(ctx: commands.Context):
-    bot.ping_only = False
+    session = await bot.sessions.for_context(ctx)
+    session.set_ping_only(False)
+    session.save()
     await ctx.send("🔔 Ping-only mode **DISABLED**")
 
 @bot.hybrid_command(name="ds", description="Soft reset (clears temporary settings)")
 async def soft_reset(ctx: commands.Context):
-    bot.reset_defaults()
+    (await bot.sessions.for_context(ctx)).reset()
     await ctx.send("🔄 Soft reset completed.")
 
 @bot.hybrid_command(name="re", description="Hard reset (clears everything)")
 async def hard_reset(ctx: commands.Context):
-    bot.saved_chats.clear()
-    bot.saved_memory.clear()
-    bot.reset_defaults()
+    bot.saved_chats.delete_for_user(ctx.author.id)
+    (await bot.sessions.for_context(ctx)).reset()
     await ctx.send("💥 Hard reset completed. All chats and memory cleared.")
 
 @bot.hybrid_command(name="cur_llm", description="Show current LLM")
 async def current_llm(ctx: commands.Context):
-    await ctx.send(f"🤖 Current LLM: `{bot.current_llm}`")
+    session = await bot.sessions.for_context(ctx)
+    await ctx.send(f"🤖 Current LLM: `{session.current_llm}`")
 
 @bot.hybrid_command(name="change_llm", description="Change the LLM model")
 @app_commands.describe(name="LLM name (compound-mini, gpt-oss, gemma2-9b)")
 async def change_llm(ctx: commands.Context, name: str):
     if name in bot.allowed_llms:
-        bot.current_llm = bot.allowed_llms[name]
-        await ctx.send(f"🤖 LLM changed to: `{name}` ({bot.current_llm})")
+        session = await bot.sessions.for_context(ctx)
+        session.current_llm = bot.allowed_llms[name]
+        session.save()
+        await ctx.send(f"🤖 LLM changed to: `{name}` ({session.current_llm})")
     else:
         await ctx.send(f"❌ Unknown LLM. Available: {', '.join(bot.allowed_llms.keys())}")
 
 @bot.hybrid_command(name="fast", description="Switch to fast mode (compound-mini + Pollinations images)")
 async def fast_mode(ctx: commands.Context):
-    bot.current_quality_mode = "fast"
-    bot.current_model_list = ["groq/compound-mini"]
-    bot.current_model_index = 0
-    bot.current_llm = "groq/compound-mini"
-    bot.current_image_mode = "fast"
+    session = await bot.sessions.for_context(ctx)
+    session.current_quality_mode = "fast"
+    session.current_model_list = ["groq/compound-mini"]
+    session.current_model_index = 0
+    session.current_llm = "groq/compound-mini"
+    session.current_image_mode = "fast"
+    session.save()
     await ctx.send("⚡ **FAST MODE** enabled (compound-mini + Pollinations images)")
 
 @bot.hybrid_command(name="smart", description="Switch to smart mode (gpt-oss + Hugging Face images)")
 async def smart_mode(ctx: commands.Context):
-    bot.current_quality_mode = "smart"
-    bot.current_model_list = ["openai/gpt-oss-20b"]
-    bot.current_model_index = 0
-    bot.current_llm = "openai/gpt-oss-20b"
-    bot.current_image_mode = "smart"
+    session = await bot.sessions.for_context(ctx)
+    session.current_quality_mode = "smart"
+    session.current_model_list = ["openai/gpt-oss-20b"]
+    session.current_model_index = 0
+    session.current_llm = "openai/gpt-oss-20b"
+    session.current_image_mode = "smart"
+    session.save()
     await ctx.send("🧠 **SMART MODE** enabled (gpt-oss + Hugging Face images)")
 
 @bot.hybrid_command(name="ra", description="Toggle random annoying messages in this channel")
@@ -834,22 +3806,34 @@ async def countdown(ctx: commands.Context):
     countdown_str = format_countdown_to_dec19(now_dt)
     await ctx.send(f"⏰ **Time until December 19:**\n{countdown_str}")
 
+@bot.hybrid_command(name="keys", description="Show API key health per provider")
+async def key_status(ctx: commands.Context):
+    lines = []
+    for pool in (bot.groq_keys, bot.hf_keys, bot.siliconflow_keys):
+        lines.extend(pool.status_lines() or [f"{pool.provider}: no keys configured"])
+    await ctx.send("🔑 **API key health**\n" + "\n".join(lines))
+
 @bot.hybrid_command(name="sm", description="Enable saved memory")
 async def memory_on(ctx: commands.Context):
-    bot.memory_enabled = True
+    session = await bot.sessions.for_context(ctx)
+    session.memory_enabled = True
+    session.save()
     await ctx.send("🧠 Saved Memory **ENABLED**")
 
 @bot.hybrid_command(name="smo", description="Disable saved memory")
 async def memory_off(ctx: commands.Context):
-    bot.memory_enabled = False
+    session = await bot.sessions.for_context(ctx)
+    session.memory_enabled = False
+    session.save()
     await ctx.send("🧠 Saved Memory **DISABLED**")
 
 @bot.hybrid_command(name="vsm", description="View saved memory (last 10 entries)")
 async def view_memory(ctx: commands.Context):
-    if bot.saved_memory:
+    session = await bot.sessions.for_context(ctx)
+    if session.saved_memory:
         memory_text = "\n".join([
-            f"**{role}:** {content[:100]}..." if len(content) > 100 else f"**{role}:** {content}"
-            for role, content in bot.saved_memory[-10:]
+            f"**{m.role}:** {m.content[:100]}..." if len(m.content) > 100 else f"**{m.role}:** {m.content}"
+            for m in session.saved_memory.tail(10)
         ])
         await ctx.send(f"🧠 **Saved Memory (last 10):**\n{memory_text}")
     else:
@@ -857,29 +3841,35 @@ async def view_memory(ctx: commands.Context):
 
 @bot.hybrid_command(name="csm", description="Clear saved memory")
 async def clear_memory(ctx: commands.Context):
-    bot.saved_memory.clear()
+    (await bot.sessions.for_context(ctx)).clear_memory()
     await ctx.send("🧠 Saved Memory **CLEARED**")
 
 @bot.hybrid_command(name="sc", description="Start a new saved chat")
 async def start_chat(ctx: commands.Context):
-    bot.current_chat = f"chat_{ctx.author.id}_{int(time.time())}"
-    bot.saved_chats[bot.current_chat] = []
-    await ctx.send(f"💾 Saved Chat started. ID: `{bot.current_chat}`")
+    session = await bot.sessions.for_context(ctx)
+    session.current_chat = f"chat_{ctx.author.id}_{int(time.time())}"
+    bot.saved_chats.create(session.current_chat)
+    session.save()
+    await ctx.send(f"💾 Saved Chat started. ID: `{session.current_chat}`")
 
 @bot.hybrid_command(name="sco", description="Close current saved chat")
 async def close_chat(ctx: commands.Context):
-    if bot.current_chat:
-        await ctx.send(f"💾 Saved Chat closed. ID: `{bot.current_chat}`")
-        bot.current_chat = None
+    session = await bot.sessions.for_context(ctx)
+    if session.current_chat:
+        await ctx.send(f"💾 Saved Chat closed. ID: `{session.current_chat}`")
+        session.current_chat = None
+        session.save()
     else:
         await ctx.send("❌ No active saved chat.")
 
 @bot.hybrid_command(name="vsc", description="View current saved chat (last 10 messages)")
 async def view_chat(ctx: commands.Context):
-    if bot.current_chat and bot.current_chat in bot.saved_chats:
+    session = await bot.sessions.for_context(ctx)
+    history = await bot.saved_chats.get(session.current_chat) if session.current_chat else None
+    if history is not None:
         chat_text = "\n".join([
-            f"**{role}:** {content[:100]}..." if len(content) > 100 else f"**{role}:** {content}"
-            for role, content in bot.saved_chats[bot.current_chat][-10:]
+            f"**{m.role}:** {m.content[:100]}..." if len(m.content) > 100 else f"**{m.role}:** {m.content}"
+            for m in history.tail(10)
         ])
         await ctx.send(f"💾 **Current Chat (last 10):**\n{chat_text}")
     else:
@@ -887,8 +3877,9 @@ async def view_chat(ctx: commands.Context):
 
 @bot.hybrid_command(name="csc", description="Clear current saved chat")
 async def clear_chat(ctx: commands.Context):
-    if bot.current_chat:
-        bot.saved_chats[bot.current_chat] = []
+    session = await bot.sessions.for_context(ctx)
+    if session.current_chat:
+        bot.saved_chats.clear(session.current_chat)
         await ctx.send("💾 Current Chat **CLEARED**")
     else:
         await ctx.send("❌ No active saved chat.")
@@ -896,69 +3887,90 @@ async def clear_chat(ctx: commands.Context):
 @bot.hybrid_command(name="video", description="Generate a video from a text prompt")
 @app_commands.describe(prompt="Description of the video to generate")
 async def video_command(ctx: commands.Context, prompt: str):
-    if ctx.author.id in bot.video_jobs:
-        await ctx.send("❌ You already have a video generating. Use `/vp` to check progress.")
+    if len(bot.media_queue.jobs_for("video", ctx.author.id)) >= MEDIA_MAX_JOBS_PER_USER:
+        await ctx.send("❌ You already have the maximum number of videos queued. Use `/vp` to check progress.")
         return
-    status_msg = await ctx.send(f"🎬 Generating video for: **{prompt}**... This may take up to 15 minutes.")
-    bot.video_jobs[ctx.author.id] = {
-        "status": "generating",
-        "message": status_msg,
-        "prompt": prompt
-    }
-    asyncio.create_task(bot.generate_video(prompt, ctx.author.id, status_msg))
+    await submit_media_job(ctx, "video", prompt, f"🎬 Generating video for: **{prompt}**... This may take up to 15 minutes.")
 
 @bot.hybrid_command(name="vp", description="Check video generation status")
 async def video_progress(ctx: commands.Context):
-    job = bot.video_jobs.get(ctx.author.id)
-    if job:
-        await ctx.send(f"🎬 Video generation in progress for: **{job['prompt']}**... Please wait.")
+    jobs = bot.media_queue.jobs_for("video", ctx.author.id)
+    if jobs:
+        await ctx.send("🎬 Your videos:\n" + "\n".join(describe_media_job(job) for job in jobs))
     else:
         await ctx.send("No active video generation. Use `/video` to start one.")
 
 @bot.hybrid_command(name="music", description="Generate music/audio from a text prompt")
 @app_commands.describe(prompt="Description of the music to generate")
 async def music_command(ctx: commands.Context, prompt: str):
-    if ctx.author.id in bot.music_jobs:
-        await ctx.send("❌ You already have music generating. Use `/mp` to check progress.")
+    if len(bot.media_queue.jobs_for("music", ctx.author.id)) >= MEDIA_MAX_JOBS_PER_USER:
+        await ctx.send("❌ You already have the maximum number of music jobs queued. Use `/mp` to check progress.")
         return
-    status_msg = await ctx.send(f"🎵 Generating music for: **{prompt}**... This may take up to 5 minutes.")
-    bot.music_jobs[ctx.author.id] = {
-        "status": "generating",
-        "message": status_msg,
-        "prompt": prompt
-    }
-    asyncio.create_task(bot.generate_music(prompt, ctx.author.id, status_msg))
+    await submit_media_job(ctx, "music", prompt, f"🎵 Generating music for: **{prompt}**... This may take up to 5 minutes.")
 
 @bot.hybrid_command(name="mp", description="Check music generation status")
 async def music_progress(ctx: commands.Context):
-    job = bot.music_jobs.get(ctx.author.id)
-    if job:
-        await ctx.send(f"🎵 Music generation in progress for: **{job['prompt']}**... Please wait.")
+    jobs = bot.media_queue.jobs_for("music", ctx.author.id)
+    if jobs:
+        await ctx.send("🎵 Your music:\n" + "\n".join(describe_media_job(job) for job in jobs))
     else:
         await ctx.send("No active music generation. Use `/music` to start one.")
 
 @bot.hybrid_command(name="image", description="Generate an image from a text prompt")
 @app_commands.describe(prompt="Description of the image to generate")
 async def image_command(ctx: commands.Context, prompt: str):
-    # Safety check only in smart mode
-    if bot.current_image_mode == "smart":
-        safety_result = await bot.check_image_safety(prompt)
-        if safety_result == "AI:STOPIMAGE":
-            await ctx.send("🚫 **Image generation blocked:** This prompt contains inappropriate content.")
-            return
-    
-    status_msg = await ctx.send(f"🎨 Generating image: **{prompt}**...")
+    with bot.tracer.trace("image", user_id=ctx.author.id, channel_id=ctx.channel.id) as trace:
+        await run_image_command(ctx, prompt, trace)
+
+async def run_image_command(ctx: commands.Context, prompt: str, trace: Trace):
+    image_mode = (await bot.sessions.for_context(ctx)).current_image_mode
+    trace.attrs["mode"] = image_mode
+    started = time.perf_counter()
+    speculative = None
+    safety_ms = 0.0
     try:
-        if bot.current_image_mode == "fast":
-            image_data = await bot.generate_pollinations_image(prompt)
-            image_url = await bot.upload_image_to_hosting(image_data)
-            await status_msg.edit(content=f"🎨 **Fast Image:** {image_url}")
-        else:
-            image_data = await bot.generate_hf_image(prompt)
-            image_url = await bot.upload_image_to_hosting(image_data)
-            await status_msg.edit(content=f"🧠 **Smart Image:** {image_url}")
-    except Exception as e:
-        await status_msg.edit(content=f"❌ **Image generation failed:** {str(e)}")
+        # Safety check only in smart mode
+        if image_mode == "smart":
+            if SPECULATIVE_IMAGES and not bot.has_forbidden_keywords(prompt):
+                speculative = bot.speculate_image(prompt, image_mode)
+            with span("safety_check", speculative=speculative is not None):
+                safety_result = await bot.check_image_safety(prompt)
+            verdict_at = time.perf_counter()
+            safety_ms = (verdict_at - started) * 1000
+            if safety_result == "AI:STOPIMAGE":
+                trace.status = "blocked"
+                if speculative is not None:
+                    speculative.cancel()
+                logger.info(f"Image timing (smart): blocked after safety {safety_ms:.0f} ms")
+                await ctx.send("🚫 **Image generation blocked:** This prompt contains inappropriate content.")
+                return
+        
+        with span("discord.send"):
+            status_msg = await ctx.send(f"🎨 Generating image: **{prompt}**...")
+        try:
+            with span("render"):
+                image_url = await bot.create_image(prompt, image_mode, speculative)
+            total_ms = (time.perf_counter() - started) * 1000
+            if speculative is not None:
+                saved_ms = speculative.overlap(verdict_at) * 1000
+                logger.info(
+                    f"Image timing (smart, speculative): safety {safety_ms:.0f} ms, total {total_ms:.0f} ms, "
+                    f"~{saved_ms:.0f} ms saved by overlapping generation with the safety check"
+                )
+            else:
+                logger.info(f"Image timing ({image_mode}): safety {safety_ms:.0f} ms, total {total_ms:.0f} ms")
+            with span("discord.edit"):
+                if image_mode == "fast":
+                    await status_msg.edit(content=f"🎨 **Fast Image:** {image_url}")
+                else:
+                    await status_msg.edit(content=f"🧠 **Smart Image:** {image_url}")
+        except Exception as e:
+            trace.status = f"failed: {e}"[:200]
+            await status_msg.edit(content=f"❌ **Image generation failed:** {str(e)}")
+    finally:
+        # A failed safety check or status send must not leave the render burning provider quota
+        if speculative is not None and not speculative.done():
+            speculative.cancel()
 
 # Slash commands for chat slot loading
 @bot.tree.command(name="sc1", description="Load saved chat slot 1")
@@ -983,12 +3995,15 @@ async def sc5(interaction: discord.Interaction):
 
 async def handle_chat_slot(interaction: discord.Interaction, slot: int):
     chat_id = f"slot_{interaction.user.id}_{slot}"
-    if chat_id in bot.saved_chats:
-        bot.current_chat = chat_id
+    session = await bot.sessions.for_interaction(interaction)
+    if await bot.saved_chats.get(chat_id) is not None:
+        session.current_chat = chat_id
+        session.save()
         await interaction.response.send_message(f"💾 Loaded chat slot **{slot}**")
     else:
-        bot.saved_chats[chat_id] = []
-        bot.current_chat = chat_id
+        bot.saved_chats.create(chat_id)
+        session.current_chat = chat_id
+        session.save()
         await interaction.response.send_message(f"💾 Created new chat slot **{slot}**")
 
 # Prefix fallback for sc1-5
@@ -1014,63 +4029,177 @@ async def prefix_sc5(ctx: commands.Context):
 
 async def handle_chat_slot_prefix(ctx: commands.Context, slot: int):
     chat_id = f"slot_{ctx.author.id}_{slot}"
-    if chat_id in bot.saved_chats:
-        bot.current_chat = chat_id
+    session = await bot.sessions.for_context(ctx)
+    if await bot.saved_chats.get(chat_id) is not None:
+        session.current_chat = chat_id
+        session.save()
         await ctx.send(f"💾 Loaded chat slot **{slot}**")
     else:
-        bot.saved_chats[chat_id] = []
-        bot.current_chat = chat_id
+        bot.saved_chats.create(chat_id)
+        session.current_chat = chat_id
+        session.save()
         await ctx.send(f"💾 Created new chat slot **{slot}**")
 
 # ------------------------------
 # Message Handling (Legacy @mention)
 # ------------------------------
+async def generate_reply(thinking: discord.Message, prompt: str, session: ChatSession) -> str:
+    """Answer a mention into the thinking message, streaming when enabled; returns the reply text."""
+    if STREAM_RESPONSES:
+        reply = StreamingReply(thinking)
+        stripper = ThinkStripper()
+        try:
+            async for delta in bot.ai_stream(prompt, session):
+                await reply.push(stripper.feed(delta))
+            await reply.push(stripper.flush())
+        except Exception as e:
+            logger.error(f"Streaming error: {e}")
+            await reply.push(f"\n❌ Error: {e}")
+        response = (await reply.finish()).strip()
+        first_visible = f"{reply.first_visible:.2f}s" if reply.first_visible is not None else "n/a"
+        logger.info(
+            f"Streamed reply: first visible token {first_visible}, "
+            f"total {time.monotonic() - reply.started:.2f}s, {len(reply.messages)} message(s)"
+        )
+    else:
+        response = await bot.ai_call(prompt, session)
+        response = strip_think(response)
+        with span("discord.edit"):
+            await thinking.edit(content=response[:2000] if len(response) <= 2000 else response[:1997] + "...")
+    return response
+
 @bot.event
 async def on_message(message: discord.Message):
-    if message.author == bot.user:
+    if message.author == bot.user or not message.content:
         return
     
-    await bot.process_commands(message)
+    # Commands are mention-prefixed; skip the command parser for everything else
+    if message.content.startswith(tuple(commands.when_mentioned(bot, message))):
+        await bot.process_commands(message)
     
-    now = datetime.now().timestamp()
-    if now - bot.user_cooldowns.get(message.author.id, 0) < USER_COOLDOWN_SECONDS:
+    # Cheap rejects first, so messages the bot won't answer never touch the cooldowns or load a session
+    mention = bot.user.mention
+    mentioned = mention in message.content
+    key = bot.sessions.key_for_message(message)
+    if not mentioned and key not in bot.sessions.listening:
+        return
+    prompt = message.content.replace(mention, "").strip() if mentioned else message.content.strip()
+    if not prompt:
         return
-    bot.user_cooldowns[message.author.id] = now
     
-    if bot.ping_only and bot.user.mention not in message.content:
+    if bot.user_cooldowns.hit(message.author.id):
         return
     
-    prompt = message.content.replace(bot.user.mention, "").strip()
-    if not prompt:
+    with bot.tracer.trace("mention", user_id=message.author.id, channel_id=message.channel.id) as trace:
+        await answer_mention(message, key, prompt, mentioned, trace)
+
+async def answer_mention(message: discord.Message, key: Tuple[int, int, int], prompt: str, mentioned: bool,
+                         trace: Trace):
+    """Everything past on_message's cheap rejects, run inside the request's trace."""
+    with span("session.load"):
+        session = await bot.sessions.get(key)
+    if session.ping_only and not mentioned:
+        trace.status = "ignored"
         return
     
-    if bot.current_chat:
-        if bot.current_chat not in bot.saved_chats:
-            bot.saved_chats[bot.current_chat] = []
-        bot.saved_chats[bot.current_chat].append(("user", prompt))
-        if len(bot.saved_chats[bot.current_chat]) > MAX_SAVED * 10:
-            bot.saved_chats[bot.current_chat] = bot.saved_chats[bot.current_chat][-MAX_SAVED * 10:]
+    if session.current_chat:
+        await bot.saved_chats.append(session.current_chat, "user", prompt)
+    
+    if session.memory_enabled:
+        session.remember("user", prompt)
     
-    if bot.memory_enabled:
-        bot.saved_memory.append(("user", prompt))
-        if len(bot.saved_memory) > MAX_MEMORY:
-            bot.saved_memory.pop(0)
+    with span("discord.send"):
+        thinking = await message.channel.send("🤔 MultiGPT is thinking...")
+    
+    async def show_position(position: int):
+        if position == 0:
+            content = "🤔 MultiGPT is thinking..."
+        else:
+            content = f"⏳ MultiGPT is busy, you're #{position} in the queue..."
+        try:
+            await thinking.edit(content=content)
+        except discord.HTTPException:
+            pass
     
-    thinking = await message.channel.send("🤔 MultiGPT is thinking...")
-    response = await bot.ai_call(prompt)
-    response = re.sub(r'<think>.*?<think>', '', response, flags=re.DOTALL).strip()
-    await thinking.edit(content=response[:2000] if len(response) <= 2000 else response[:1997] + "...")
+    flow = message.channel.id if LLM_FAIR_SCOPE == "channel" else message.author.id
+    try:
+        async with bot.llm_scheduler.slot(flow, estimate_tokens(prompt) + 1024, show_position):
+            with span("reply", streamed=STREAM_RESPONSES):
+                response = await generate_reply(thinking, prompt, session)
+    except LoadShed as e:
+        trace.status = "shed"
+        logger.warning(f"Shed reply for {message.author.id} in {message.channel.id}: {e}")
+        await thinking.edit(content="🥵 MultiGPT is swamped right now, please try again in a minute.")
+        return  # the busy notice is not a reply; keep it out of saved chats and memory
     
-    if bot.current_chat:
-        bot.saved_chats[bot.current_chat].append(("assistant", response))
-    if bot.memory_enabled:
-        bot.saved_memory.append(("assistant", response))
-        if len(bot.saved_memory) > MAX_MEMORY:
-            bot.saved_memory.pop(0)
+    if not response:
+        return  # nothing was said; don't record an empty turn
+    if session.current_chat:
+        await bot.saved_chats.append(session.current_chat, "assistant", response)
+    if session.memory_enabled:
+        session.remember("assistant", response)
+
+@bot.event
+async def on_ready():
+    logger.info(f"Logged in as {bot.user} {time.perf_counter() - STARTUP_STARTED:.2f}s after process start")
 
 # ------------------------------
 # Background Tasks
 # ------------------------------
+async def stats_log_loop():
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        await asyncio.sleep(STATS_LOG_SECONDS)
+        for line in bot.stats_summary():
+            logger.info(line)
+
+async def persistence_loop():
+    last_compact = time.monotonic()
+    while not bot.is_closed():
+        await asyncio.sleep(PERSIST_FLUSH_SECONDS)
+        try:
+            if time.monotonic() - last_compact >= PERSIST_COMPACT_SECONDS:
+                last_compact = time.monotonic()
+                await bot.persistence.compact()
+            else:
+                await bot.persistence.flush()
+        except Exception as e:
+            logger.error(f"Error in persistence_loop: {e}")
+
+async def archive_refresh_loop():
+    while not bot.is_closed():
+        try:
+            await bot.refresh_pen_archive()
+        except Exception as e:
+            logger.error(f"Error refreshing archive: {e}")
+        await asyncio.sleep(ARCHIVE_REFRESH_SECONDS)
+
+async def resume_media_jobs():
+    await bot.wait_until_ready()
+    try:
+        await bot.media_queue.resume()
+    except Exception as e:
+        logger.error(f"Error resuming media jobs: {e}")
+
+async def loop_lag_loop():
+    """Sample event loop lag: how much later than asked a short sleep actually wakes up."""
+    while not bot.is_closed():
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.observe_loop_lag(max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+async def hf_warm_loop():
+    if not HF_WARM_KEEPER or not HF_TOKENS:
+        return
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        delay = HF_WARM_INTERVAL
+        try:
+            delay = await bot.keep_hf_warm()
+        except Exception as e:
+            logger.error(f"Error in hf_warm_loop: {e}")
+        await asyncio.sleep(delay)
+
 async def annoying_loop():
     await bot.wait_until_ready()
     while not bot.is_closed():
@@ -1097,10 +4226,58 @@ async def handle_root(request):
 async def handle_health(request):
     return web.Response(text="OK")
 
+async def handle_metrics(request):
+    body = metrics.render(bot.metric_families())
+    return web.Response(text=body, content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+def check_debug_token(request: web.Request):
+    """The /debug endpoints only exist when DEBUG_TOKEN is set, and need it as a bearer token or ?token=."""
+    if not DEBUG_TOKEN:
+        raise web.HTTPNotFound()
+    supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip() or request.query.get("token", "")
+    if not hmac.compare_digest(supplied.encode(), DEBUG_TOKEN.encode()):
+        raise web.HTTPUnauthorized()
+
+async def handle_debug_traces(request):
+    check_debug_token(request)
+    try:
+        limit = int(request.query.get("limit", TRACE_SLOW_BUFFER))
+    except ValueError:
+        raise web.HTTPBadRequest(text="limit must be an integer")
+    slow = list(bot.tracer.slow)[::-1][:max(0, limit)]  # newest first
+    return web.json_response({"slow_seconds": bot.tracer.slow_seconds, "traces": slow},
+                             dumps=lambda data: json.dumps(data, ensure_ascii=False, default=str))
+
+profile_running = False
+
+async def handle_debug_profile(request):
+    """Sample the event loop's stack for ?seconds= (default 5) and return folded stacks."""
+    global profile_running
+    check_debug_token(request)
+    try:
+        seconds = min(float(request.query.get("seconds", 5)), PROFILE_MAX_SECONDS)
+        top = int(request.query.get("top", 25))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds and top must be numbers")
+    if profile_running:
+        raise web.HTTPConflict(text="a profile is already running")
+    profile_running = True
+    try:
+        # This handler runs on the event loop thread, which is the one worth sampling
+        profiler = SamplingProfiler(threading.get_ident())
+        stacks = await asyncio.to_thread(profiler.run, max(seconds, 0.1))
+    finally:
+        profile_running = False
+    return web.Response(text=SamplingProfiler.report(stacks, seconds, top), content_type="text/plain")
+
 async def run_web_server():
     app = web.Application()
     app.router.add_get("/", handle_root)
     app.router.add_get("/healthz", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/debug/traces", handle_debug_traces)
+    app.router.add_get("/debug/profile", handle_debug_profile)
     runner = web.AppRunner(app)
     await runner.setup()
     port = int(os.getenv("PORT", 10000))
@@ -1114,6 +4291,14 @@ async def run_web_server():
 async def main():
     async with bot:
         bot.loop.create_task(annoying_loop())
+        bot.loop.create_task(archive_refresh_loop())
+        bot.loop.create_task(stats_log_loop())
+        bot.loop.create_task(persistence_loop())
+        bot.loop.create_task(hf_warm_loop())
+        bot.loop.create_task(resume_media_jobs())
+        bot.loop.create_task(loop_lag_loop())
+        # Render stops instances with SIGTERM; close cleanly so queued writes are committed
+        bot.loop.add_signal_handler(signal.SIGTERM, lambda: bot.loop.create_task(bot.close()))
         await run_web_server()
         await bot.start(TOKEN)
 